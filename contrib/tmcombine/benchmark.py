@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark for tmcombine.py: generates synthetic Moses models, and measures time, throughput and peak memory
+# of phrase table combination with given weights (modes interpolate and counts, also in low memory mode),
+# combination with weights that are optimized on a tuning set, and reordering table combination.
+#
+# for usage information, run
+# python benchmark.py -h
+#
+# Some general things to note:
+#  - The synthetic models have Zipfian word and phrase distributions, and a noisy one-to-one "translation" of source words.
+#    Features, lexical tables and counts are computed from the generated phrase pair frequencies, like Moses does, so that all modes of tmcombine can be used.
+#  - Each benchmark case runs in a separate process, so that the peak memory of one case doesn't affect the next.
+#  - Results can be stored as a baseline (--save-baseline FILE), and later runs compared against it (--baseline FILE).
+#    Timings are only comparable between runs on the same machine, with the same models.
+
+from __future__ import division, unicode_literals
+import sys
+import os
+import gzip
+import json
+import random
+import shutil
+import subprocess
+import time
+import argparse
+from bisect import bisect_right
+from collections import defaultdict
+from tempfile import mkdtemp
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+import tmcombine
+
+
+# benchmark cases: name, method of Combine_TMs, and its configuration
+CASES = [('interpolate','combine_given_weights',{'mode':'interpolate'}),
+         ('interpolate-normalized','combine_given_weights',{'mode':'interpolate','normalized':True,'normalize_s_given_t':'t','recompute_lexweights':True}),
+         ('counts','combine_given_weights',{'mode':'counts'}),
+         ('counts-lowmem','combine_given_weights',{'mode':'counts','lowmem':True}),
+         ('tuning','combine_given_tuning_set',{'mode':'interpolate'}),
+         ('tuning-counts','combine_given_tuning_set',{'mode':'counts'}),
+         ('reordering','combine_reordering_tables',{'mode':'interpolate','number_of_features':6})]
+
+
+class ZipfSampler():
+    """draw ranks 0 ... size-1, with a probability proportional to 1/(rank+1)**exponent"""
+
+    def __init__(self,size,exponent,rng):
+        self.cumulative = []
+        total = 0
+        for rank in range(size):
+            total += 1/(rank+1)**exponent
+            self.cumulative.append(total)
+        self.total = total
+        self.rng = rng
+
+    def __call__(self):
+        return min(bisect_right(self.cumulative,self.rng.random()*self.total),len(self.cumulative)-1)
+
+
+def _word(rank):
+    """word string of a rank (frequent words are short): 0 -> 'a', 25 -> 'z', 26 -> 'ba' ..."""
+
+    letters = []
+    while True:
+        rank,letter = divmod(rank,26)
+        letters.append(chr(ord('a')+letter))
+        if not rank:
+            break
+    return ''.join(reversed(letters))
+
+
+def _alignment(source_length,target_length):
+    """monotone word alignment in which every source and target word is aligned"""
+
+    length = max(source_length,target_length)
+    return sorted(set((i*source_length//length,i*target_length//length) for i in range(length)))
+
+
+def _phrase_pair(rng,sample_word,translations,max_length):
+    """draw a phrase pair (two tuples of word ranks). Each target word is the translation of a source word (or, with some probability, a random word),
+       and target phrases are sometimes one word shorter or longer than source phrases
+    """
+
+    source = tuple(sample_word() for i in range(rng.randint(1,max_length)))
+    target = [translations[word] if rng.random() < 0.8 else sample_word() for word in source]
+
+    r = rng.random()
+    if r < 0.1 and len(target) > 1:
+        target.pop()
+    elif r < 0.2:
+        target.append(sample_word())
+
+    return source,tuple(target)
+
+
+def _open_output(filename,compress=False):
+    if compress:
+        return gzip.open(filename + '.gz','wb')
+    return open(filename,'wb')
+
+
+def _write_sorted(filename,lines,compress=False):
+    """write lines in C locale order (as required by tmcombine)"""
+
+    lines = sorted(line.encode('utf-8') for line in lines)
+    fobj = _open_output(filename,compress)
+    fobj.writelines(lines)
+    fobj.close()
+
+
+def generate_model(directory,pairs=100000,number_of_features=4,zipf=1.0,vocabulary=10000,max_length=4,seed=1,compress=False):
+    """write a synthetic Moses model to directory/model: phrase table (with word alignment and counts), reordering table, and lexical tables (probabilities and counts).
+       pairs: number of distinct phrase pairs. Phrase pairs are drawn until there are this many (or until a limit of draws is reached in a small vocabulary).
+       number_of_features: number of phrase table features (without phrase penalty). The first four are the standard Moses features, computed from the counts;
+                           further features are random.
+       zipf: exponent of the Zipfian word distribution.
+       compress: write gzipped tables.
+    """
+
+    rng = random.Random(seed)
+    sample_word = ZipfSampler(vocabulary,zipf,rng)
+
+    # all models share the same "translation" of each source word
+    translations = list(range(vocabulary))
+    random.Random(vocabulary).shuffle(translations)
+
+    counts = defaultdict(int)
+    draws = 0
+    while len(counts) < pairs and draws < pairs*100:
+        counts[_phrase_pair(rng,sample_word,translations,max_length)] += 1
+        draws += 1
+    if len(counts) < pairs:
+        sys.stderr.write('Warning: only {0} distinct phrase pairs after {1} draws\n'.format(len(counts),draws))
+
+    source_counts = defaultdict(int)
+    target_counts = defaultdict(int)
+    link_counts = defaultdict(int)
+    source_word_counts = defaultdict(int)
+    target_word_counts = defaultdict(int)
+
+    for (source,target),count in counts.items():
+        source_counts[source] += count
+        target_counts[target] += count
+        for i,j in _alignment(len(source),len(target)):
+            link_counts[source[i],target[j]] += count
+            source_word_counts[source[i]] += count
+            target_word_counts[target[j]] += count
+
+    def lexical_weight(x_phrase,y_phrase,links,probability):
+        """Moses lexical weight lex(x|y): product over x words of the average probability w(x|y) of the y words they are aligned to"""
+
+        aligned = defaultdict(list)
+        for i,j in links:
+            aligned[i].append(j)
+
+        weight = 1
+        for i,x in enumerate(x_phrase):
+            weight *= sum(probability(x,y_phrase[j]) for j in aligned[i])/len(aligned[i])
+        return weight
+
+    phrase_table = []
+    reordering_table = []
+    for (source,target),count in counts.items():
+        links = _alignment(len(source),len(target))
+        inverse_links = [(j,i) for (i,j) in links]
+
+        features = [count/target_counts[target],
+                    lexical_weight(source,target,links,lambda s,t: link_counts[s,t]/target_word_counts[t]),
+                    count/source_counts[source],
+                    lexical_weight(target,source,inverse_links,lambda t,s: link_counts[s,t]/source_word_counts[s])]
+        features += [rng.uniform(0.001,1) for i in range(number_of_features-4)]
+
+        source_string = ' '.join(_word(word) for word in source)
+        target_string = ' '.join(_word(word) for word in target)
+
+        phrase_table.append('{0} ||| {1} ||| {2} 2.718 ||| {3} ||| {4} {5} {6}\n'.format(source_string,target_string,
+                            ' '.join('{0:.6g}'.format(feature) for feature in features),
+                            ' '.join('{0}-{1}'.format(i,j) for (i,j) in links),
+                            target_counts[target],source_counts[source],count))
+
+        orientations = [rng.uniform(0.01,1) for i in range(6)]
+        orientations = [p/sum(orientations[:3]) for p in orientations[:3]] + [p/sum(orientations[3:]) for p in orientations[3:]]
+        reordering_table.append('{0} ||| {1} ||| {2}\n'.format(source_string,target_string,' '.join('{0:.6g}'.format(p) for p in orientations)))
+
+    e2f = []
+    f2e = []
+    counts_e2f = []
+    counts_f2e = []
+    for (x,y),count in link_counts.items():
+        x_string,y_string = _word(x),_word(y)
+        e2f.append('{0} {1} {2:.7g}\n'.format(x_string,y_string,count/target_word_counts[y]))
+        f2e.append('{0} {1} {2:.7g}\n'.format(y_string,x_string,count/source_word_counts[x]))
+        counts_e2f.append('{0} {1} {2} {3}\n'.format(x_string,y_string,count,target_word_counts[y]))
+        counts_f2e.append('{0} {1} {2} {3}\n'.format(y_string,x_string,count,source_word_counts[x]))
+
+    model_dir = os.path.join(directory,'model')
+    if not os.path.isdir(model_dir):
+        os.makedirs(model_dir)
+
+    _write_sorted(os.path.join(model_dir,'phrase-table'),phrase_table,compress)
+    _write_sorted(os.path.join(model_dir,'reordering-table.wbe-msd-bidirectional-fe'),reordering_table,compress)
+    _write_sorted(os.path.join(model_dir,'lex.e2f'),e2f,compress)
+    _write_sorted(os.path.join(model_dir,'lex.f2e'),f2e,compress)
+    _write_sorted(os.path.join(model_dir,'lex.counts.e2f'),counts_e2f,compress)
+    _write_sorted(os.path.join(model_dir,'lex.counts.f2e'),counts_f2e,compress)
+
+    return len(counts)
+
+
+def generate_reference(filename,pairs=2000,zipf=1.0,vocabulary=10000,max_length=4,seed=0):
+    """write a synthetic reference set (in the format of Moses' extract file) for tuning. It is drawn from the same distribution as the models,
+       so that most (but not all) phrase pairs are known to them
+    """
+
+    rng = random.Random(seed)
+    sample_word = ZipfSampler(vocabulary,zipf,rng)
+    translations = list(range(vocabulary))
+    random.Random(vocabulary).shuffle(translations)
+
+    fobj = open(filename,'wb')
+    for k in range(pairs):
+        source,target = _phrase_pair(rng,sample_word,translations,max_length)
+        fobj.write('{0} ||| {1} ||| {2}\n'.format(' '.join(_word(word) for word in source),' '.join(_word(word) for word in target),
+                   ' '.join('{0}-{1}'.format(i,j) for (i,j) in _alignment(len(source),len(target)))).encode('utf-8'))
+    fobj.close()
+
+
+def generate(directory,models=2,pairs=100000,number_of_features=4,zipf=1.0,vocabulary=10000,max_length=4,reference_pairs=2000,seed=1,compress=False):
+    """generate synthetic models (directory/model0, directory/model1 ...) and a reference set (directory/extract).
+       The configuration is stored in directory/benchmark.json, and returned.
+    """
+
+    config = {'models':models,'pairs':pairs,'number_of_features':number_of_features,'zipf':zipf,'vocabulary':vocabulary,
+              'max_length':max_length,'reference_pairs':reference_pairs,'seed':seed,'compress':compress}
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    config['model_pairs'] = []
+    for m in range(models):
+        sys.stderr.write('Generating model {0}...'.format(m))
+        config['model_pairs'].append(generate_model(os.path.join(directory,'model{0}'.format(m)),pairs,number_of_features,zipf,vocabulary,max_length,seed+m,compress))
+        sys.stderr.write('done\n')
+
+    generate_reference(os.path.join(directory,'extract'),reference_pairs,zipf,vocabulary,max_length,seed+models)
+
+    fobj = open(os.path.join(directory,'benchmark.json'),'w')
+    fobj.write(json.dumps(config,sort_keys=True) + '\n')
+    fobj.close()
+
+    return config
+
+
+def _load_config(directory):
+    """configuration of the models in directory, or None if they haven't been generated"""
+
+    filename = os.path.join(directory,'benchmark.json')
+    if not os.path.exists(filename):
+        return None
+    fobj = open(filename)
+    config = json.load(fobj)
+    fobj.close()
+    return config
+
+
+def run_case(case,directory,output_dir,processes=1,block_size=1000):
+    """run a benchmark case in this process, and return its statistics (time, throughput, peak memory, and time per phase)"""
+
+    for name,action,options in CASES:
+        if name == case:
+            break
+    else:
+        raise ValueError('unknown benchmark case: {0}'.format(case))
+
+    config = _load_config(directory)
+    options = dict(options)
+    mode = options.pop('mode')
+    number_of_features = options.pop('number_of_features',config['number_of_features'])
+    output_file = os.path.join(output_dir,case)
+
+    records = []
+    start,start_cpu = time.time(),tmcombine._cpu_time()
+
+    combiner = tmcombine.Combine_TMs([(os.path.join(directory,'model{0}'.format(m)),'primary') for m in range(config['models'])],
+                                     mode=mode,
+                                     output_file=output_file,
+                                     reference_file=os.path.join(directory,'extract'),
+                                     number_of_features=number_of_features,
+                                     tempdir=output_dir,
+                                     processes=processes,
+                                     block_size=block_size,
+                                     stats_callback=records.append,
+                                     **options)
+    getattr(combiner,action)()
+
+    result = {'wall':time.time()-start,
+              'cpu':tmcombine._cpu_time()-start_cpu,
+              'peak_rss':tmcombine._peak_rss(),
+              'temp_bytes':tmcombine._temp_bytes[0],
+              'input_pairs':sum(config['model_pairs']),
+              'phases':defaultdict(float)}
+
+    fobj = open(output_file,'rb')
+    result['output_lines'] = sum(1 for line in fobj)
+    fobj.close()
+    os.remove(output_file)
+
+    for record in records:
+        if record['phase'] == 'optimizer-iteration':
+            result['optimizer_iterations'] = result.get('optimizer_iterations',0) + 1
+        else:
+            result['phases'][record['phase']] += record['wall']
+
+    result['pairs_per_second'] = result['input_pairs']/result['wall']
+    result['lines_per_second'] = result['output_lines']/result['wall']
+
+    return result
+
+
+def _run_case_process(case,directory,output_dir,log,processes=1,block_size=1000):
+    """run a benchmark case in a new process (so that its peak memory is measured independently), and return its statistics"""
+
+    command = [sys.executable,os.path.abspath(__file__),'_case',json.dumps([case,directory,output_dir,processes,block_size])]
+    process = subprocess.Popen(command,stdout=subprocess.PIPE,stderr=log)
+    output = process.communicate()[0]
+    if process.returncode:
+        sys.stderr.write('Error: benchmark case {0} failed (see {1})\n'.format(case,log.name))
+        sys.exit(1)
+
+    return json.loads(output.decode('utf-8'))
+
+
+def run(directory,cases,repeat=1,processes=1,block_size=1000):
+    """run benchmark cases on the models in directory. Each case is run repeat times; the fastest run is reported.
+       returns dictionary of results, with the configuration of the models and the run.
+    """
+
+    output_dir = mkdtemp(prefix='benchmark',dir=directory)
+    log = open(os.path.join(directory,'benchmark.log'),'w')
+
+    results = {}
+    for case in cases:
+        sys.stderr.write('Running {0}...'.format(case))
+        runs = [_run_case_process(case,directory,output_dir,log,processes,block_size) for i in range(repeat)]
+        results[case] = min(runs,key=lambda result: result['wall'])
+        sys.stderr.write('done ({0:.2f}s)\n'.format(results[case]['wall']))
+
+    log.close()
+    os.rmdir(output_dir)
+
+    return {'config':_load_config(directory),
+            'options':{'processes':processes,'block_size':block_size},
+            'repeat':repeat,
+            'python':sys.version.split()[0],
+            'numpy':tmcombine.numpy is not None,
+            'scipy':tmcombine.optimizer == 'l-bfgs',
+            'results':results}
+
+
+def report(benchmark,baseline=None,tolerance=None):
+    """print results (and relative change to baseline). Returns False if a case is slower, or uses more memory, than the baseline by more than tolerance (a fraction)"""
+
+    ok = True
+
+    if baseline and (baseline['config'] != benchmark['config'] or baseline['options'] != benchmark['options']):
+        sys.stdout.write('Warning: baseline was measured with a different configuration; results may not be comparable\n')
+
+    header = '{0:<24}{1:>10}{2:>10}{3:>14}{4:>14}{5:>12}'.format('case','wall (s)','cpu (s)','pairs/s','lines/s','peak MB')
+    if baseline:
+        header += '{0:>10}{1:>10}'.format('wall','memory')
+    sys.stdout.write(header + '\n')
+
+    for case,action,options in CASES:
+        if case not in benchmark['results']:
+            continue
+        result = benchmark['results'][case]
+        peak_mb = result['peak_rss']/1024/1024 if result['peak_rss'] else float('nan')
+        line = '{0:<24}{1:>10.2f}{2:>10.2f}{3:>14.0f}{4:>14.0f}{5:>12.1f}'.format(case,result['wall'],result['cpu'],result['pairs_per_second'],result['lines_per_second'],peak_mb)
+
+        if baseline and case in baseline['results']:
+            reference = baseline['results'][case]
+            wall_change = result['wall']/reference['wall'] - 1
+            line += '{0:>+10.1%}'.format(wall_change)
+            memory_change = None
+            if result['peak_rss'] and reference['peak_rss']:
+                memory_change = result['peak_rss']/reference['peak_rss'] - 1
+                line += '{0:>+10.1%}'.format(memory_change)
+            if tolerance is not None and (wall_change > tolerance or memory_change is not None and memory_change > tolerance):
+                line += '  REGRESSION'
+                ok = False
+
+        sys.stdout.write(line + '\n')
+
+    return ok
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description='Benchmark tmcombine.py on synthetic models. Action "generate" writes synthetic Moses models to DIRECTORY; action "run" runs the benchmark on the models in DIRECTORY (and generates them first if they don\'t exist, or if they were generated with different options).')
+
+    parser.add_argument('action', metavar='ACTION', choices=['generate','run'],
+                    help='What you want to do. One of %(choices)s.')
+
+    parser.add_argument('directory', metavar='DIRECTORY', nargs='?', default=None,
+                    help='Directory of the synthetic models. Default for "run": a temporary directory that is removed afterwards.')
+
+    group1 = parser.add_argument_group('Model options')
+    group2 = parser.add_argument_group('Benchmark options')
+
+    group1.add_argument('--models', type=int, default=2, metavar='N',
+                    help='Number of models. (default: %(default)s)')
+
+    group1.add_argument('--pairs', type=int, default=100000, metavar='N',
+                    help='Number of distinct phrase pairs per model. (default: %(default)s)')
+
+    group1.add_argument('--number_of_features', type=int, default=4, metavar='N',
+                    help='Number of phrase table features (at least 4; without phrase penalty). (default: %(default)s)')
+
+    group1.add_argument('--zipf', type=float, default=1.0, metavar='S',
+                    help='Exponent of the Zipfian word distribution. (default: %(default)s)')
+
+    group1.add_argument('--vocabulary', type=int, default=10000, metavar='N',
+                    help='Vocabulary size. (default: %(default)s)')
+
+    group1.add_argument('--max-length', type=int, default=4, metavar='N',
+                    help='Maximum phrase length. (default: %(default)s)')
+
+    group1.add_argument('--reference-pairs', type=int, default=2000, metavar='N',
+                    help='Number of phrase pairs in the reference set. (default: %(default)s)')
+
+    group1.add_argument('--seed', type=int, default=1,
+                    help='Random seed. (default: %(default)s)')
+
+    group1.add_argument('--gzip', action='store_true',
+                    help='Write gzipped tables.')
+
+    group2.add_argument('--cases', type=str, default=','.join(case for (case,action,options) in CASES),
+                    help='Comma-separated list of benchmark cases. (default: %(default)s)')
+
+    group2.add_argument('--repeat', type=int, default=1, metavar='N',
+                    help='Run each case N times, and report the fastest run. (default: %(default)s)')
+
+    group2.add_argument('--processes', type=int, default=1, metavar='N',
+                    help='Number of processes used by tmcombine. (default: %(default)s)')
+
+    group2.add_argument('--block-size', type=int, default=1000, metavar='N',
+                    help='Block size of tmcombine. (default: %(default)s)')
+
+    group2.add_argument('--save-baseline', type=str, default=None, metavar='FILE',
+                    help='Store results as baseline in FILE.')
+
+    group2.add_argument('--baseline', type=str, default=None, metavar='FILE',
+                    help='Compare results with the baseline in FILE.')
+
+    group2.add_argument('--tolerance', type=float, default=None, metavar='X',
+                    help='With --baseline: exit with an error if a case is slower, or uses more memory, than the baseline by more than a fraction X (e.g. 0.1).')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1 and sys.argv[1] == '_case':
+        # internal: run a single benchmark case (in a process started by _run_case_process)
+        result = run_case(*json.loads(sys.argv[2]))
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.exit(0)
+
+    args = parse_command_line()
+
+    generation = {'models':args.models,'pairs':args.pairs,'number_of_features':args.number_of_features,'zipf':args.zipf,'vocabulary':args.vocabulary,
+                  'max_length':args.max_length,'reference_pairs':args.reference_pairs,'seed':args.seed,'compress':args.gzip}
+
+    if args.action == 'generate':
+        if not args.directory:
+            sys.stderr.write('Error: action "generate" requires a directory\n')
+            sys.exit(1)
+        generate(args.directory,**generation)
+        sys.exit(0)
+
+    cases = args.cases.split(',')
+    for case in cases:
+        if case not in [name for (name,action,options) in CASES]:
+            sys.stderr.write('Error: unknown benchmark case: {0}\n'.format(case))
+            sys.exit(1)
+
+    directory = args.directory
+    temporary = directory is None
+    if temporary:
+        directory = mkdtemp(prefix='tmcombine-benchmark')
+
+    config = _load_config(directory)
+    if config is None or dict((key,value) for (key,value) in config.items() if key != 'model_pairs') != generation:
+        generate(directory,**generation)
+
+    benchmark = run(directory,cases,args.repeat,args.processes,args.block_size)
+
+    baseline = None
+    if args.baseline:
+        fobj = open(args.baseline)
+        baseline = json.load(fobj)
+        fobj.close()
+
+    ok = report(benchmark,baseline,args.tolerance)
+
+    if args.save_baseline:
+        fobj = open(args.save_baseline,'w')
+        fobj.write(json.dumps(benchmark,indent=1,sort_keys=True) + '\n')
+        fobj.close()
+
+    if temporary:
+        shutil.rmtree(directory)
+
+    if not ok:
+        sys.exit(1)
@@ -18,7 +18,7 @@
 #  - Different combination algorithms require different statistics. To be on the safe side, use the option `-write-lexical-counts` when training models.
 #  - The script assumes that phrase tables are sorted (to allow incremental, more memory-friendly processing). sort with LC_ALL=C.
 #  - Some configurations require additional statistics that are loaded in memory (lexical tables; complete list of target phrases). If memory consumption is a problem, use the option --lowmem (slightly slower and writes temporary files to disk), or consider pruning your phrase table before combining (e.g. using Johnson et al. 2007).
-#  - The script can read/write gzipped files, but the Python implementation is slow. You're better off unzipping the files on the command line and working with the unzipped files.
+#  - The script can read/write gzipped files; (de)compression runs in background threads. Parallel combination (--processes) requires uncompressed or indexed phrase tables, though (see index_tables).
 #  - The cross-entropy estimation assumes that phrase tables contain true probability distributions (i.e. a probability mass of 1 for each conditional probability distribution). If this is not true, the results are skewed.
 #  - Unknown phrase pairs are not considered for the cross-entropy estimation. A comparison of models with different vocabularies may be misleading.
 #  - Don't directly compare cross-entropies obtained from a combination with different modes. Depending on how some corner cases are treated, linear interpolation does not distribute full probability mass and thus shows higher (i.e. worse) cross-entropies.
@@ -31,16 +31,49 @@ import gzip
 import argparse
 import copy
 import re
+import shutil
+import time
+import hashlib
+import multiprocessing
+import threading
+import zlib
+import mmap
+import struct
+import json
+import socket
+import subprocess
 from math import log, exp
 from collections import defaultdict
+from heapq import heapify, heappush, heappop, heapreplace, nlargest
 from operator import mul
-from tempfile import NamedTemporaryFile
-from subprocess import Popen
+from bisect import bisect_left, bisect_right
+from array import array
+from tempfile import NamedTemporaryFile, mkdtemp
+from multiprocessing.pool import ThreadPool
 try:
     from itertools import izip
 except:
     izip = zip
 
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+try:
+    import queue
+except:
+    import Queue as queue
+
+try:
+    from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+    import xmlrpc.client as xmlrpclib
+    import http.client as httplib
+except:
+    from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+    import xmlrpclib
+    import httplib
+
 try:
     from lxml import etree as ET
 except:
@@ -52,6 +85,532 @@ try:
 except:
     optimizer = 'hillclimb'
 
+try:
+    import numpy
+except:
+    numpy = None
+
+try:
+    import resource
+except:
+    resource = None
+
+try:
+    from moses.dictree import PhraseDictionaryTree
+except:
+    PhraseDictionaryTree = None
+
+class PhrasePairStore():
+    """compact storage of the feature values of phrase pairs.
+       All values are stored in one flat float array with the layout (pairs x features x models);
+       the alignment and comment sections of each pair are stored in a single byte buffer, with offsets per pair.
+       The source phrase index maps each source phrase to a dictionary {target phrase: row}; target phrases are interned.
+       With NumPy, matrix() gives direct access to the values as an array of shape (pairs,features,models).
+    """
+
+    def __init__(self,number_of_features,number_of_models):
+
+        self.number_of_features = number_of_features
+        self.number_of_models = number_of_models
+        self.row_size = number_of_features*number_of_models
+
+        self.index = {}
+        self.target_keys = {}
+        self.size = 0
+
+        self.values = array('d')
+        self.zero_row = array('d',[0])*self.row_size
+
+        # alignment and comment section: offset into info_data, and length (-1 if not set)
+        self.info_data = bytearray()
+        self.info_start = array('l')
+        self.info_length = array('l')
+
+
+    def __len__(self):
+        return self.size
+
+
+    def __contains__(self,pair):
+        src,target = pair
+        return src in self.index and target in self.index[src]
+
+
+    def clear(self):
+        """remove all phrase pairs"""
+
+        self.index.clear()
+        self.target_keys.clear()
+        self.size = 0
+        del self.values[:]
+        del self.info_data[:]
+        del self.info_start[:]
+        del self.info_length[:]
+
+
+    def sources(self):
+        return self.index.keys()
+
+
+    def targets(self,src):
+        return self.index[src].keys()
+
+
+    def row(self,src,target):
+        """row of phrase pair, or None if it is unknown"""
+
+        try:
+            return self.index[src][target]
+        except KeyError:
+            return None
+
+
+    def add(self,src,target):
+        """return row of phrase pair; create empty entry (all values 0) if it is unknown"""
+
+        try:
+            translations = self.index[src]
+        except KeyError:
+            translations = self.index[src] = {}
+
+        try:
+            return translations[target]
+        except KeyError:
+            pass
+
+        row = self.size
+        target = self.target_keys.setdefault(target,target)
+        translations[target] = row
+        self.size += 1
+
+        self.values.extend(self.zero_row)
+        self.info_start.append(0)
+        self.info_length.append(-1)
+
+        return row
+
+
+    def set_model_values(self,row,i,model_values):
+        """set values of all features for model i"""
+
+        values = self.values
+        m = self.number_of_models
+        pos = row*self.row_size + i
+        for p in model_values:
+            values[pos] = p
+            pos += m
+
+
+    def get_values(self,row):
+        """values as list of lists: one list per feature, with one value per model"""
+
+        m = self.number_of_models
+        base = row*self.row_size
+        values = self.values[base:base+self.row_size].tolist()
+        return [values[j:j+m] for j in range(0,self.row_size,m)]
+
+
+    def get(self,src,target):
+        """values of phrase pair, or None if it is unknown"""
+
+        row = self.row(src,target)
+        if row is None:
+            return None
+        return self.get_values(row)
+
+
+    def matrix(self):
+        """NumPy view of all values, with shape (pairs,features,models). Only valid until the next pair is added."""
+
+        return numpy.frombuffer(self.values,dtype=numpy.float64).reshape(self.size,self.number_of_features,self.number_of_models)
+
+
+    def has_info(self,row):
+        return self.info_length[row] >= 0
+
+
+    def set_info(self,row,entries):
+        """store the additional sections of the phrase table line (alignment, counts, ...)"""
+
+        data = b' ||| '.join(entries)
+        self.info_start[row] = len(self.info_data)
+        self.info_length[row] = len(data)
+        self.info_data.extend(data)
+
+
+    def get_info(self,row):
+        """additional sections of phrase table line as a (new) list. Empty if they were never set"""
+
+        length = self.info_length[row]
+        if length < 0:
+            return []
+        start = self.info_start[row]
+        return bytes(self.info_data[start:start+length]).split(b' ||| ')
+
+
+    def save(self,prefix):
+        """write store to binary files (the index is pickled; values and additional sections are stored as raw arrays)"""
+
+        _dump_pickle((self.number_of_features,self.number_of_models,self.size,self.index),prefix + '.index')
+        _save_array(self.values,prefix + '.values')
+        _save_array(self.info_start,prefix + '.info_start')
+        _save_array(self.info_length,prefix + '.info_length')
+        _save_array(self.info_data,prefix + '.info')
+
+
+    def load(self,prefix):
+        """replace contents of store with data written by save()"""
+
+        number_of_features,number_of_models,self.size,self.index = _load_pickle(prefix + '.index')
+        if (number_of_features,number_of_models) != (self.number_of_features,self.number_of_models):
+            raise ValueError('cached phrase pairs have {0} features and {1} models'.format(number_of_features,number_of_models))
+
+        self.target_keys = {}
+        for translations in self.index.values():
+            for target in translations:
+                self.target_keys.setdefault(target,target)
+
+        self.values = _load_array('d',prefix + '.values')
+        self.info_start = _load_array('l',prefix + '.info_start')
+        self.info_length = _load_array('l',prefix + '.info_length')
+        self.info_data = _load_array(None,prefix + '.info')
+
+
+    def get_alignment(self,row):
+        """first additional section (word alignment), or None if it was never set"""
+
+        length = self.info_length[row]
+        if length < 0:
+            return None
+        start = self.info_start[row]
+        end = self.info_data.find(b' ||| ',start,start+length)
+        if end < 0:
+            end = start+length
+        return bytes(self.info_data[start:end])
+
+
+class PhraseCountStore():
+    """compact storage of one value per model for each phrase (e.g. phrase counts), in a flat float array.
+       looking up an unknown phrase returns zeros.
+    """
+
+    def __init__(self,number_of_models):
+
+        self.number_of_models = number_of_models
+        self.index = {}
+        self.values = array('d')
+        self.zero_row = array('d',[0])*number_of_models
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def __contains__(self,key):
+        return key in self.index
+
+
+    def __iter__(self):
+        return iter(self.index)
+
+
+    def __getitem__(self,key):
+        """values of key as a (new) list, with one value per model"""
+
+        try:
+            row = self.index[key]
+        except KeyError:
+            return [0]*self.number_of_models
+
+        m = self.number_of_models
+        return self.values[row*m:(row+1)*m].tolist()
+
+
+    def clear(self):
+
+        self.index.clear()
+        del self.values[:]
+
+
+    def matrix(self,keys):
+        """NumPy array with the values of a list of keys, with shape (keys,models). zeros for unknown keys"""
+
+        m = self.number_of_models
+        result = numpy.zeros((len(keys),m))
+
+        if self.index:
+            rows = numpy.array([self.index.get(key,-1) for key in keys],dtype=numpy.intp)
+            known = rows >= 0
+            result[known] = numpy.frombuffer(self.values,dtype=numpy.float64).reshape(-1,m)[rows[known]]
+
+        return result
+
+
+    def save(self,prefix):
+        """write store to binary files (pickled index, and raw array of values)"""
+
+        _dump_pickle((self.number_of_models,self.index),prefix + '.index')
+        _save_array(self.values,prefix + '.values')
+
+
+    def load(self,prefix):
+        """replace contents of store with data written by save()"""
+
+        number_of_models,self.index = _load_pickle(prefix + '.index')
+        if number_of_models != self.number_of_models:
+            raise ValueError('cached phrase counts have {0} models'.format(number_of_models))
+        self.values = _load_array('d',prefix + '.values')
+
+
+    def set(self,key,i,value):
+
+        try:
+            row = self.index[key]
+        except KeyError:
+            row = self.index[key] = len(self.index)
+            self.values.extend(self.zero_row)
+
+        self.values[row*self.number_of_models+i] = value
+
+
+class Vocabulary():
+    """interned words: maps each word to an integer ID"""
+
+    def __init__(self):
+
+        self.ids = {}
+        self.words = []
+
+
+    def __len__(self):
+        return len(self.words)
+
+
+    def get_id(self,word):
+        """ID of word; new ID if it is unknown"""
+
+        try:
+            return self.ids[word]
+        except KeyError:
+            word_id = self.ids[word] = len(self.words)
+            self.words.append(word)
+            return word_id
+
+
+    def save(self,prefix):
+
+        _dump_pickle(self.words,prefix + '.vocabulary')
+
+
+    def load(self,prefix):
+        """replace vocabulary with one written by save()"""
+
+        self.words = _load_pickle(prefix + '.vocabulary')
+        self.ids = dict((word,word_id) for (word_id,word) in enumerate(self.words))
+
+
+def _word_pair_key(x_id,y_id):
+    """single integer key of word pair (ID of x in high bits, ID of y in low bits).
+       the low bits are mixed with the ID of x; dictionary lookups only use the low bits of the hash, and would otherwise collide for all pairs with the same y.
+    """
+    return x_id << 32 | (y_id ^ x_id*2654435761) & 0xffffffff
+
+
+def _split_word_pair_key(key):
+    """inverse of _word_pair_key"""
+    x_id = key >> 32
+    return x_id,(key ^ x_id*2654435761) & 0xffffffff
+
+
+class WordPairStore():
+    """compact storage of a lexical table (one value per model for each word pair).
+       Words are interned in a Vocabulary, and each word pair is identified by a single integer key (see _word_pair_key).
+       The values are stored in one flat float array, with the layout (pairs x models). Unknown word pairs have the value 0 for all models.
+    """
+
+    def __init__(self,vocabulary,number_of_models):
+
+        self.vocabulary = vocabulary
+        self.number_of_models = number_of_models
+        self.index = {}
+        self.values = array('d')
+        self.zero_row = array('d',[0])*number_of_models
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def __contains__(self,pair):
+        return self.row(*pair) is not None
+
+
+    def row(self,x,y):
+        """row of word pair, or None if it is unknown"""
+
+        ids = self.vocabulary.ids
+        try:
+            return self.index[_word_pair_key(ids[x],ids[y])]
+        except KeyError:
+            return None
+
+
+    def get(self,x,y):
+        """values of word pair as a (new) list, with one value per model"""
+
+        ids = self.vocabulary.ids
+        m = self.number_of_models
+        try:
+            row = self.index[_word_pair_key(ids[x],ids[y])]
+        except KeyError:
+            return [0]*m
+
+        return self.values[row*m:(row+1)*m].tolist()
+
+
+    def set(self,x,y,i,value):
+
+        ids = self.vocabulary.ids
+        try:
+            key = _word_pair_key(ids[x],ids[y])
+        except KeyError:
+            key = _word_pair_key(self.vocabulary.get_id(x),self.vocabulary.get_id(y))
+
+        index = self.index
+        row = index.get(key)
+        if row is None:
+            row = index[key] = len(index)
+            self.values.extend(self.zero_row)
+
+        self.values[row*self.number_of_models+i] = value
+
+
+    def items(self):
+        """all word pairs and their rows, as a list of (x,y,row), sorted by x and y"""
+
+        words = self.vocabulary.words
+        pairs = []
+        for key,row in self.index.items():
+            x_id,y_id = _split_word_pair_key(key)
+            pairs.append((words[x_id],words[y_id],row))
+        return sorted(pairs)
+
+
+    def get_row(self,row):
+        """values of row as a (new) list"""
+
+        m = self.number_of_models
+        return self.values[row*m:(row+1)*m].tolist()
+
+
+    def matrix(self,pairs):
+        """NumPy array with the values of a list of word pairs (x,y), with shape (pairs,models). zeros for unknown word pairs"""
+
+        m = self.number_of_models
+        result = numpy.zeros((len(pairs),m))
+
+        if self.index:
+            ids = self.vocabulary.ids
+            index = self.index
+            rows = numpy.array([index.get(_word_pair_key(ids[x],ids[y]),-1) if x in ids and y in ids else -1 for (x,y) in pairs],dtype=numpy.intp)
+            known = rows >= 0
+            result[known] = numpy.frombuffer(self.values,dtype=numpy.float64).reshape(-1,m)[rows[known]]
+
+        return result
+
+
+    def save(self,prefix):
+        """write store to binary files (pickled index, and raw array of values). The vocabulary is saved separately"""
+
+        _dump_pickle((self.number_of_models,self.index),prefix + '.index')
+        _save_array(self.values,prefix + '.values')
+
+
+    def load(self,prefix):
+        """replace contents of store with data written by save()"""
+
+        number_of_models,self.index = _load_pickle(prefix + '.index')
+        if number_of_models != self.number_of_models:
+            raise ValueError('cached word pairs have {0} models'.format(number_of_models))
+        self.values = _load_array('d',prefix + '.values')
+
+
+class WordCountStore(PhraseCountStore):
+    """compact storage of one value per model for each word (e.g. word counts). Words are interned in a Vocabulary.
+       looking up an unknown word returns zeros.
+    """
+
+    def __init__(self,vocabulary,number_of_models):
+
+        PhraseCountStore.__init__(self,number_of_models)
+        self.vocabulary = vocabulary
+
+
+    def __contains__(self,word):
+        return self.vocabulary.ids.get(word) in self.index
+
+
+    def __iter__(self):
+        words = self.vocabulary.words
+        return (words[word_id] for word_id in self.index)
+
+
+    def __getitem__(self,word):
+        return PhraseCountStore.__getitem__(self,self.vocabulary.ids.get(word))
+
+
+    def matrix(self,words):
+        ids = self.vocabulary.ids
+        return PhraseCountStore.matrix(self,[ids.get(word) for word in words])
+
+
+    def set(self,word,i,value):
+        try:
+            word_id = self.vocabulary.ids[word]
+        except KeyError:
+            word_id = self.vocabulary.get_id(word)
+        PhraseCountStore.set(self,word_id,i,value)
+
+
+def _save_array(data,filename):
+    """write array (or bytearray) to a binary file"""
+
+    fobj = open(filename,'wb')
+    if isinstance(data,bytearray):
+        fobj.write(data)
+    else:
+        data.tofile(fobj)
+    fobj.close()
+
+
+def _load_array(typecode,filename):
+    """read array with given typecode from a binary file written by _save_array. If typecode is None, read a bytearray"""
+
+    fobj = open(filename,'rb')
+    if typecode is None:
+        data = bytearray(fobj.read())
+    else:
+        data = array(typecode)
+        data.fromfile(fobj,os.path.getsize(filename)//data.itemsize)
+    fobj.close()
+    return data
+
+
+def _dump_pickle(data,filename):
+
+    fobj = open(filename,'wb')
+    pickle.dump(data,fobj,2)
+    fobj.close()
+
+
+def _load_pickle(filename):
+
+    fobj = open(filename,'rb')
+    data = pickle.load(fobj)
+    fobj.close()
+    return data
+
+
 class Moses():
     """Moses interface for loading/writing models
     to support other phrase table formats, subclass this and overwrite the relevant functions
@@ -62,32 +621,81 @@ class Moses():
         self.number_of_features = number_of_features
         self.models = models
 
-        #example item (assuming mode=='counts' and one feature): phrase_pairs['the house']['das haus'] = [[[10,100]],['0-0 1-1']]
-        self.phrase_pairs = defaultdict(lambda: defaultdict(lambda: [[[0]*len(self.models) for i in range(self.number_of_features)],[]]))
-        self.phrase_source = defaultdict(lambda: [0]*len(self.models))
-        self.phrase_target =  defaultdict(lambda: [0]*len(self.models))
+        #example item (assuming mode=='counts' and one feature): phrase_pairs.get('the house','das haus') = [[10,100]] ; phrase_pairs.get_info(row) = ['0-0 1-1']
+        self.phrase_pairs = PhrasePairStore(self.number_of_features,len(self.models))
+        self.phrase_source = PhraseCountStore(len(self.models))
+        self.phrase_target = PhraseCountStore(len(self.models))
         
-        self.reordering_pairs = defaultdict(lambda: defaultdict(lambda: [[0]*len(self.models) for i in range(self.number_of_features)]))
+        self.reordering_pairs = defaultdict(self._new_reordering_translations)
         
-        self.word_pairs_e2f = defaultdict(lambda: defaultdict(lambda: [0]*len(self.models)))
-        self.word_pairs_f2e = defaultdict(lambda: defaultdict(lambda: [0]*len(self.models)))
-        self.word_source = defaultdict(lambda: [0]*len(self.models))
-        self.word_target = defaultdict(lambda: [0]*len(self.models))
+        #example item (assuming mode=='counts'): word_pairs_e2f.get('haus','house') = [10,15] ; word_target['house'] = [12,20]
+        self.vocabulary = Vocabulary()
+        self.word_pairs_e2f = WordPairStore(self.vocabulary,len(self.models))
+        self.word_pairs_f2e = WordPairStore(self.vocabulary,len(self.models))
+        self.word_source = WordCountStore(self.vocabulary,len(self.models))
+        self.word_target = WordCountStore(self.vocabulary,len(self.models))
+
+        #lexical weight steps for the current weights (see compute_lexicalweight); the steps depend on the lexical table, so each direction has its own cache
+        self.lexical_cache_e2f = {}
+        self.lexical_cache_f2e = {}
         
         self.require_alignment = False
-        
 
-    def open_table(self,model,table,mode='r'):
+
+    # factory functions for the nested data structures. Defined once (instead of lambdas) so that we don't create new function objects for each phrase.
+    def _new_model_values(self):
+        return [0]*len(self.models)
+
+    def _new_reordering_pair(self):
+        return [[0]*len(self.models) for i in range(self.number_of_features)]
+
+    def _new_reordering_translations(self):
+        return defaultdict(self._new_reordering_pair)
+
+
+    def table_path(self,model,table):
         """define which paths to open for lexical tables and phrase tables.
             we assume canonical Moses structure, but feel free to overwrite this
         """
-        
+
         if table == 'reordering-table':
             table = 'reordering-table.wbe-msd-bidirectional-fe'
+
+        return os.path.join(model,'model',table)
+
+
+    def open_table(self,model,table,mode='r'):
+        """open a table of a model (see table_path)"""
         
-        filename = os.path.join(model,'model',table)
+        filename = self.table_path(model,table)
         fileobj = handle_file(filename,'open',mode)
         return fileobj
+
+
+    def filtered_phrase_table(self,model,sources,mode='interpolate',flags=None):
+        """phrase table lines of model that are (possibly) relevant for a set of source phrases (e.g. those of a reference set).
+           a text table without index has to be read completely; with an index (see TableIndex), only the parts of the table that contain the source phrases are read.
+           interfaces with random access to the table (see Moses_Binary) only return the lines of the given source phrases.
+        """
+
+        fileobj = self.open_table(model,'phrase-table')
+        if self._needs_all_targets(mode,flags):
+            return fileobj
+
+        index = TableIndex.load(fileobj.name)
+        if index is None:
+            return fileobj
+
+        fileobj.close()
+        return index.lookup(sources)
+
+
+    def _needs_all_targets(self,mode,flags):
+        """whether loading the data for a reference set requires the lines of all source phrases, not only of those in the reference set:
+           counts of target phrases (mode 'counts'), and normalization that checks which models contain a target phrase, are stored on lines with any source phrase.
+        """
+
+        return mode == 'counts' or bool(flags and flags['normalized'] and flags['normalize_s_given_t'] == 't')
         
         
     def load_phrase_features(self,line,priority,i,mode='interpolate',store='pairs',filter_by=None,filter_by_src=None,filter_by_target=None,inverted=False,flags=None):
@@ -99,9 +707,10 @@ class Moses():
         if inverted:
             src,target = target,src
         
-        if (store == 'all' or store == 'pairs') and (priority < 10 or (src in self.phrase_pairs and target in self.phrase_pairs[src])) and not (filter_by and not (src in filter_by and target in filter_by[src])):
+        if (store == 'all' or store == 'pairs') and (priority < 10 or (src,target) in self.phrase_pairs) and not (filter_by and not (src in filter_by and target in filter_by[src])):
             
-                self.store_info(src,target,line)
+                row = self.phrase_pairs.add(src,target)
+                self.store_info(src,target,line,row)
                 
                 scores = line[2].split()
                 if len(scores) <self.number_of_features:
@@ -110,7 +719,6 @@ class Moses():
                     
                 scores = scores[:self.number_of_features]
                 model_probabilities = list(map(float,scores))
-                phrase_probabilities = self.phrase_pairs[src][target][0]
                 
                 if mode == 'counts' and not priority == 2: #priority 2 is MAP
                     try:
@@ -137,32 +745,31 @@ class Moses():
                     model_probabilities[i_e2f] = joint_count_e2f
                     model_probabilities[i_f2e] = joint_count_f2e
                         
-                for j,p in enumerate(model_probabilities):
-                    phrase_probabilities[j][i] = p
+                self.phrase_pairs.set_model_values(row,i,model_probabilities)
                 
         # mark that the src/target phrase has been seen.
         # needed for re-normalization during linear interpolation
         if (store == 'all' or store == 'source') and not (filter_by_src and not src in filter_by_src):
             if mode == 'counts' and not priority == 2: #priority 2 is MAP
                 try:
-                    self.phrase_source[src][i] = float(line[4].split()[1])
+                    self.phrase_source.set(src,i,float(line[4].split()[1]))
                 except:
                     sys.stderr.write(str(line)+'\n')
                     sys.stderr.write('ERROR: Counts are missing or misformatted. Maybe your phrase table is from an older Moses version that doesn\'t store counts or word alignment?\n')
                     raise
             else:
-                self.phrase_source[src][i] = 1
+                self.phrase_source.set(src,i,1)
                 
         if (store == 'all' or store == 'target') and not (filter_by_target and not target in filter_by_target):
             if mode == 'counts' and not priority == 2: #priority 2 is MAP
                 try:
-                    self.phrase_target[target][i] = float(line[4].split()[0])
+                    self.phrase_target.set(target,i,float(line[4].split()[0]))
                 except:
                     sys.stderr.write(str(line)+'\n')
                     sys.stderr.write('ERROR: Counts are missing or misformatted. Maybe your phrase table is from an older Moses version that doesn\'t store counts or word alignment?\n')
                     raise
             else:
-                self.phrase_target[target][i] = 1
+                self.phrase_target.set(target,i,1)
 
 
     def load_reordering_probabilities(self,line,priority,i,**unused):
@@ -181,53 +788,58 @@ class Moses():
             sys.stderr.write('\nIndexError: Did you correctly specify the number of reordering features? (--number_of_features N in command line)\n')
             exit(1)
 
-    def traverse_incrementally(self,table,models,load_lines,store_flag,mode='interpolate',inverted=False,lowmem=False,flags=None):
-        """hack-ish way to find common phrase pairs in multiple models in one traversal without storing it all in memory
-            relies on alphabetical sorting of phrase table.
+
+    def load_reordering_features(self,line,priority,i,**unused):
+        """same as load_reordering_probabilities, but stores the probabilities in self.phrase_pairs (for scoring in blocks)"""
+
+        model_probabilities = list(map(float,line[2].split()))
+
+        if len(model_probabilities) > self.number_of_features:
+            sys.stderr.write('\nIndexError: Did you correctly specify the number of reordering features? (--number_of_features N in command line)\n')
+            exit(1)
+
+        row = self.phrase_pairs.add(line[0],line[1])
+        self.phrase_pairs.set_model_values(row,i,model_probabilities)
+
+    def traverse_incrementally(self,table,models,load_lines,store_flag,mode='interpolate',inverted=False,lowmem=False,flags=None,block_size=1):
+        """find common phrase pairs in multiple models in one traversal without storing it all in memory.
+           yields once per block_size source phrases, after the entries of all models have been loaded (into self.phrase_pairs, self.reordering_pairs etc.)
+           relies on alphabetical sorting of phrase table.
         """
         
-        increment = -1
-        stack = ['']*len(self.models)
+        n = 0
+        last_key = None
         
-        while increment:
+        for block in merge_tables(models):
             
-            self.phrase_pairs = defaultdict(lambda: defaultdict(lambda: [[[0]*len(self.models) for i in range(self.number_of_features)],[]]))
-            self.reordering_pairs = defaultdict(lambda: defaultdict(lambda: [[0]*len(self.models) for i in range(self.number_of_features)]))
-            self.phrase_source = defaultdict(lambda: [0]*len(self.models))
+            # a source phrase that re-appears in unsorted tables is processed separately (as with block_size 1)
+            key = block[0][0][0][0] + b' |'
+            if n and key <= last_key:
+                n = 0
+                yield 1
+            last_key = key
             
-            if lowmem:
-                self.phrase_target = defaultdict(lambda: [0]*len(self.models))
-    
-            for model,priority,i in models:
-                
-                if stack[i]:
-                    if increment != stack[i][0]:
-                        continue
-                    else:
-                        load_lines(stack[i],priority,i,mode=mode,store=store_flag,inverted=inverted,flags=flags)
-                        stack[i] = ''
-                    
-                for line in model:
-
-                    line = line.rstrip().split(b' ||| ')
-                    if line[-1].endswith(b' |||'):
-                      line[-1] = line[-1][:-4]
-                      line.append(b'')
+            # the per-phrase data structures are reused for each block
+            if not n:
+                self.phrase_pairs.clear()
+                self.reordering_pairs.clear()
+                self.phrase_source.clear()
                 
-                    if increment != line[0]:
-                        stack[i] = line
-                        break
-                        
+                if lowmem:
+                    self.phrase_target.clear()
+    
+            for lines,priority,i in block:
+                for line in lines:
                     load_lines(line,priority,i,mode=mode,store=store_flag,inverted=inverted,flags=flags)
-                
+            
+            n += 1
+            # close to the memory limit, blocks are ended early (after a multiple of 100 source phrases)
+            if n == block_size or not n % 100 and _near_memory_limit(flags):
+                n = 0
+                yield 1
+        
+        if n:
             yield 1
-
-            #calculate which source phrase to process next
-            lines = [line[0] + b' |' for line in stack if line]
-            if lines:
-                increment = min(lines)[:-2]
-            else:
-                increment = None
     
     
     def load_word_probabilities(self,line,side,i,priority,e2f_filter=None,f2e_filter=None):
@@ -237,11 +849,11 @@ class Moses():
         
         if side == 'e2f' and (not e2f_filter or a in e2f_filter and b in e2f_filter[a]):
             
-            self.word_pairs_e2f[a][b][i] = float(prob)
+            self.word_pairs_e2f.set(a,b,i,float(prob))
             
         elif side == 'f2e' and (not f2e_filter or a in f2e_filter and b in f2e_filter[a]):
             
-            self.word_pairs_f2e[a][b][i] = float(prob)
+            self.word_pairs_f2e.set(a,b,i,float(prob))
     
 
     def load_word_counts(self,line,side,i,priority,e2f_filter=None,f2e_filter=None,flags=None):
@@ -254,30 +866,33 @@ class Moses():
             if priority == 2: #MAP
                 if not e2f_filter or a in e2f_filter:
                     if not e2f_filter or b in e2f_filter[a]:
-                        self.word_pairs_e2f[a][b][i] = float(ab_count)/float(b_count)
-                    self.word_target[b][i] = 1
+                        self.word_pairs_e2f.set(a,b,i,float(ab_count)/float(b_count))
+                    self.word_target.set(b,i,1)
             else:
                 if not e2f_filter or a in e2f_filter:
                     if not e2f_filter or b in e2f_filter[a]:
-                        self.word_pairs_e2f[a][b][i] = float(ab_count)
-                    self.word_target[b][i] = float(b_count)
+                        self.word_pairs_e2f.set(a,b,i,float(ab_count))
+                    self.word_target.set(b,i,float(b_count))
 
         elif side == 'f2e':
             
             if priority == 2: #MAP
-                if not f2e_filter or a in f2e_filter and b in f2e_filter[a]:
+                if not f2e_filter or a in f2e_filter:
                     if not f2e_filter or b in f2e_filter[a]:
-                        self.word_pairs_f2e[a][b][i] = float(ab_count)/float(b_count)
-                    self.word_source[b][i] = 1
+                        self.word_pairs_f2e.set(a,b,i,float(ab_count)/float(b_count))
+                    self.word_source.set(b,i,1)
             else:
-                if not f2e_filter or a in f2e_filter and b in f2e_filter[a]:
+                if not f2e_filter or a in f2e_filter:
                     if not f2e_filter or b in f2e_filter[a]:
-                        self.word_pairs_f2e[a][b][i] = float(ab_count)
-                    self.word_source[b][i] = float(b_count)
+                        self.word_pairs_f2e.set(a,b,i,float(ab_count))
+                    self.word_source.set(b,i,float(b_count))
 
 
     def load_lexical_tables(self,models,mode,e2f_filter=None,f2e_filter=None):
         """open and load lexical tables into data structure"""
+
+        self.lexical_cache_e2f.clear()
+        self.lexical_cache_f2e.clear()
         
         if mode == 'counts':
             files = ['lex.counts.e2f','lex.counts.f2e']
@@ -300,12 +915,54 @@ class Moses():
                     load_lines(line,f[-3:],i,priority,e2f_filter=e2f_filter,f2e_filter=f2e_filter)
                 
 
-    def store_info(self,src,target,line):
+    def save_phrase_data(self,prefix):
+        """write phrase pairs and phrase counts to binary files (see load_phrase_data)"""
+        
+        self.phrase_pairs.save(prefix + '.pairs')
+        self.phrase_source.save(prefix + '.source')
+        self.phrase_target.save(prefix + '.target')
+
+
+    def load_phrase_data(self,prefix):
+        """replace phrase pairs and phrase counts with data written by save_phrase_data"""
+        
+        self.phrase_pairs.load(prefix + '.pairs')
+        self.phrase_source.load(prefix + '.source')
+        self.phrase_target.load(prefix + '.target')
+
+
+    def save_lexical_data(self,prefix):
+        """write vocabulary and lexical tables to binary files (see load_lexical_data)"""
+        
+        self.vocabulary.save(prefix)
+        self.word_pairs_e2f.save(prefix + '.e2f')
+        self.word_pairs_f2e.save(prefix + '.f2e')
+        self.word_source.save(prefix + '.source')
+        self.word_target.save(prefix + '.target')
+
+
+    def load_lexical_data(self,prefix):
+        """replace vocabulary and lexical tables with data written by save_lexical_data"""
+
+        self.lexical_cache_e2f.clear()
+        self.lexical_cache_f2e.clear()
+        
+        self.vocabulary.load(prefix)
+        self.word_pairs_e2f.load(prefix + '.e2f')
+        self.word_pairs_f2e.load(prefix + '.f2e')
+        self.word_source.load(prefix + '.source')
+        self.word_target.load(prefix + '.target')
+
+
+    def store_info(self,src,target,line,row=None):
         """store alignment info and comment section for re-use in output"""
         
+        if row is None:
+            row = self.phrase_pairs.add(src,target)
+        
         if len(line) >= 5:
-            if not self.phrase_pairs[src][target][1]:
-                self.phrase_pairs[src][target][1] = line[3:]
+            if not self.phrase_pairs.has_info(row):
+                self.phrase_pairs.set_info(row,line[3:])
         
         # assuming that alignment is empty
         elif len(line) == 4:
@@ -313,7 +970,7 @@ class Moses():
                 sys.stderr.write('Error: unexpected phrase table format. Your current configuration requires alignment information. Make sure you trained your model with -phrase-word-alignment (default in newer Moses versions)\n')
                 exit(1)
             
-            self.phrase_pairs[src][target][1] = [b'',line[3].lstrip(b'| ')]
+            self.phrase_pairs.set_info(row,[b'',line[3].lstrip(b'| ')])
    
         else:
             sys.stderr.write('Error: unexpected phrase table format. Are you using a very old/new version of Moses with different formatting?\n')
@@ -329,9 +986,11 @@ class Moses():
             if (src,target) in mycache:
                 return mycache[(src,target)]
         
-        try:
-            alignment = self.phrase_pairs[src][target][1][0]
-        except:
+        row = self.phrase_pairs.row(src,target)
+        if row is None:
+            return None,None
+        alignment = self.phrase_pairs.get_alignment(row)
+        if alignment is None:
             return None,None
         
         src_list = src.split(b' ')
@@ -377,7 +1036,8 @@ class Moses():
             return b''
         
         # information specific to Moses model: alignment info and comment section with target and source counts
-        additional_entries = self.phrase_pairs[src][target][1]
+        row = self.phrase_pairs.row(src,target)
+        additional_entries = self.phrase_pairs.get_info(row)
         alignment = additional_entries[0]
         if alignment:
             extra_space = b' '
@@ -394,7 +1054,7 @@ class Moses():
         features = b' '.join([b'%.6g' %(f) for f in features])
         
         if flags['add_origin_features']:
-            origin_features = list(map(lambda x: 2.718**bool(x),self.phrase_pairs[src][target][0][0])) # 1 if phrase pair doesn't occur in model, 2.718 if it does
+            origin_features = list(map(lambda x: 2.718**bool(x),self.phrase_pairs.get_values(row)[0])) # 1 if phrase pair doesn't occur in model, 2.718 if it does
             origin_features = b' '.join([b'%.4f' %(f) for f in origin_features]) + ' '
         else:
             origin_features = b''
@@ -407,6 +1067,63 @@ class Moses():
         
         
 
+    def write_phrase_table_block(self,pairs,rows,weights,scores,mode,flags):
+        """convert a block of phrase pairs to strings in Moses phrase table format.
+           same as write_phrase_table, but takes a NumPy array of scores (one row per phrase pair) and returns a list of lines
+        """
+        
+        # phrase pairs with a feature value of 0 are not written (see write_phrase_table)
+        keep = (scores != 0).all(axis=1).tolist()
+        scores = scores.tolist()
+        
+        if mode == 'counts':
+            i_e2f = flags['i_e2f']
+            i_f2e = flags['i_f2e']
+            srccounts = _dot_columns(self.phrase_source.matrix([src for (src,target) in pairs]),weights[i_f2e])
+            targetcounts = _dot_columns(self.phrase_target.matrix([target for (src,target) in pairs]),weights[i_e2f])
+            # counts are written with str(); keep the type that dot_product would return (NumPy floats if the weights are NumPy floats)
+            srccounts = _scalar_list(srccounts,weights[i_f2e])
+            targetcounts = _scalar_list(targetcounts,weights[i_e2f])
+        
+        if flags['add_origin_features']:
+            # 1 if phrase pair doesn't occur in model, 2.718 if it does
+            origin = (self.phrase_pairs.matrix()[rows,0,:] != 0).tolist()
+            origin_strings = {True:b'%.4f' %(2.718), False:b'%.4f' %(1)}
+        else:
+            origin_features = b''
+        if flags['write_phrase_penalty']:
+          phrase_penalty = b' 2.718'
+        else:
+          phrase_penalty = b''
+        
+        lines = []
+        
+        for idx,(src,target) in enumerate(pairs):
+            
+            if not keep[idx]:
+                continue
+            
+            row = rows[idx]
+            additional_entries = self.phrase_pairs.get_info(row)
+            alignment = additional_entries[0]
+            if alignment:
+                extra_space = b' '
+            else:
+                extra_space = b''
+            
+            if mode == 'counts':
+                additional_entries[1] = b"%s %s" %(targetcounts[idx],srccounts[idx])
+            
+            features = b' '.join([b'%.6g' %(f) for f in scores[idx]])
+            
+            if flags['add_origin_features']:
+                origin_features = b' '.join([origin_strings[x] for x in origin[idx]]) + b' '
+            
+            lines.append(b"%s ||| %s ||| %s%s %s||| %s%s||| %s\n" %(src,target,features,origin_features,phrase_penalty,alignment,extra_space,b' ||| '.join(additional_entries[1:])))
+        
+        return lines
+
+
     def write_lexical_file(self,direction, path, weights,mode):
         
         if mode == 'counts':
@@ -425,15 +1142,14 @@ class Moses():
             word_pairs = self.word_pairs_f2e
             marginal = self.word_source
     
-        for x in sorted(word_pairs):
-            for y in sorted(word_pairs[x]):
-                xy = dot_product(word_pairs[x][y],weights)
-                fobj.write(b"%s %s %s" %(x,y,xy))
-    
-                if mode == 'counts':
-                    fobj.write(b" %s\n" %(dot_product(marginal[y],weights)))
-                else:
-                    fobj.write(b'\n')
+        for x,y,row in word_pairs.items():
+            xy = dot_product(word_pairs.get_row(row),weights)
+            fobj.write(b"%s %s %s" %(x,y,xy))
+
+            if mode == 'counts':
+                fobj.write(b" %s\n" %(dot_product(marginal[y],weights)))
+            else:
+                fobj.write(b'\n')
 
         handle_file("{0}{1}.{2}".format(path,bridge,direction),'close',fobj,mode='w')
         
@@ -453,39 +1169,54 @@ class Moses():
         return line
 
 
-    def create_inverse(self,fobj,tempdir=None):
+    def write_reordering_table_block(self,pairs,scores):
+        """same as write_reordering_table, but for a list of phrase pairs and an array of their scores (one row per pair). Returns list of lines"""
+
+        lines = []
+
+        for (src,target),features in zip(pairs,scores.tolist()):
+
+            if 0 in features:
+                continue
+
+            features = b' '.join([b'%.6g' %(f) for f in features])
+            lines.append(b"%s ||| %s ||| %s\n" %(src,target,features))
+
+        return lines
+
+
+    def create_inverse(self,fobj,tempdir=None,buffer_size=1024,processes=1):
         """swap source and target phrase in the phrase table, and then sort (by target phrase)"""
         
-        inverse = NamedTemporaryFile(prefix='inv_unsorted',delete=False,dir=tempdir)        
+        sorter = ExternalSort(tempdir=tempdir,buffer_size=buffer_size,processes=processes)
         swap = re.compile(b'(.+?) \|\|\| (.+?) \|\|\|')
         
         # just swap source and target phrase, and leave order of scores etc. intact. 
         # For better compatibility with existing codebase, we swap the order of the phrases back for processing
         for line in fobj:
-            inverse.write(swap.sub(b'\\2 ||| \\1 |||',line,1))
-        inverse.close()
+            sorter.write(swap.sub(b'\\2 ||| \\1 |||',line,1))
         
-        inverse_sorted = sort_file(inverse.name,tempdir=tempdir)
-        os.remove(inverse.name)
-        
-        return inverse_sorted
+        return sorter.finish()
 
 
-    def merge(self,pt_normal, pt_inverse, pt_out, mode='interpolate'):
+    def merge(self,pt_normal, pt_inverse, pt_out, mode='interpolate', limit=0, feature=None):
         """merge two phrasetables (the latter having been inverted to calculate p(s|t) and lex(s|t) in sorted order)
-           Assumes that p(s|t) and lex(s|t) are in first table half, p(t|s) and lex(t|s) in second"""
+           Assumes that p(s|t) and lex(s|t) are in first table half, p(t|s) and lex(t|s) in second
+           If limit is given, only the limit translations of each source phrase with the highest value of feature (as written) are kept."""
         
+        translations = []
+
         for line,line2 in izip(pt_normal,pt_inverse):
             
             line = line.split(b' ||| ')
             if line[-1].endswith(b' |||'):
                 line[-1] = line[-1][:-4]
-                line.append('')
+                line.append(b'')
 
             line2 = line2.split(b' ||| ')
             if line2[-1].endswith(b' |||'):
                 line2[-1] = line2[-1][:-4]
-                line2.append('')
+                line2.append(b'')
 
             #scores
             mid = int(self.number_of_features/2)
@@ -499,17 +1230,129 @@ class Moses():
                 target_count = line2[-1].split()[0]
                 line[4] = b' '.join([target_count,src_count])
             
+            if limit:
+                if translations and translations[0][0] != line[0]:
+                    self._write_top_translations(translations,pt_out,limit,feature)
+                    translations = []
+                translations.append(line)
+                continue
+
             pt_out.write(b' ||| '.join(line)+ b'\n')
             
+        if translations:
+            self._write_top_translations(translations,pt_out,limit,feature)
+
         pt_normal.close()
         pt_inverse.close()
         pt_out.close()
 
 
+    def _write_top_translations(self,translations,pt_out,limit,feature):
+        """write the (at most) limit translations of a source phrase (split lines, as in merge) with the highest value of a feature"""
+
+        values = [float(line[2].split()[feature]) for line in translations]
+        for j in _top_translations(list(range(len(translations))),values,limit):
+            pt_out.write(b' ||| '.join(translations[j])+ b'\n')
+
+
+
+class Moses_Binary(Moses):
+    """Moses interface that reads the data relevant for a reference set (for tuning and cross-entropy computation) from binary phrase tables
+       (model/phrase-table.binphr.*, as created by processPhraseTable), with one lookup per source phrase of the reference set instead of a pass over the whole table.
+       Requires the Python interface to Moses (moses.dictree in contrib/python). All other operations (e.g. the combination of tables) read the text tables, like Moses.
+       Binary tables don't store phrase counts, so mode 'counts' reads the text tables, as does normalization over the models that contain a target phrase (normalize_s_given_t 't'), and models without binary table.
+    """
+
+    def __init__(self,models,number_of_features):
+
+        Moses.__init__(self,models,number_of_features)
+
+        if PhraseDictionaryTree is None:
+            sys.stderr.write('Error: binary phrase tables require the Python interface to Moses (moses.dictree in contrib/python)\n')
+            sys.exit(1)
+
+        self.binary_tables = {}
+
+
+    def open_binary_table(self,model):
+        """open the binary phrase table of a model (with word alignment, if available), or return None if there is none"""
+
+        if model not in self.binary_tables:
+            stem = os.path.join(model,'model','phrase-table')
+            self.binary_tables[model] = None
+            for alignment in [True,False]:
+                if PhraseDictionaryTree.canLoad(stem,alignment):
+                    if not isinstance(stem,bytes):
+                        stem = stem.encode(sys.getfilesystemencoding() or 'utf-8')
+                    # table limit 0: we need all translations of a source phrase
+                    self.binary_tables[model] = PhraseDictionaryTree(stem,0,self.number_of_features+1,alignment)
+                    break
+
+        return self.binary_tables[model]
+
+
+    def filtered_phrase_table(self,model,sources,mode='interpolate',flags=None):
+        """phrase table lines of the source phrases in sources, looked up in the binary table"""
+
+        if self._needs_all_targets(mode,flags):
+            sys.stderr.write('Warning: binary phrase tables have no counts, and only return the translations of given source phrases. Reading text table of ' + model + '\n')
+            return Moses.filtered_phrase_table(self,model,sources,mode,flags)
+
+        table = self.open_binary_table(model)
+        if table is None:
+            sys.stderr.write('Warning: no binary phrase table in ' + model + '. Reading text table\n')
+            return Moses.filtered_phrase_table(self,model,sources,mode,flags)
+
+        return self._lookup_lines(table,sources)
+
+
+    def _lookup_lines(self,table,sources):
+        """yield text phrase table lines (with empty counts) for all translations of the source phrases, in the order of a sorted text table"""
+
+        for src in sorted(sources,key=lambda x: x + b' |'):
+            lines = []
+            # scores are returned as stored (probabilities), and in no particular order
+            for target in table.query(src,converter=None,cmp=None):
+                target_phrase = b' '.join(target.rhs)
+                scores = ' '.join(repr(score) for score in target.scores).encode('ascii')
+                alignment = '{0}'.format(target.alignment).encode('ascii') if table.wa else b''
+                lines.append((target_phrase + b' |',b' ||| '.join([src,target_phrase,scores,alignment,b'']) + b'\n'))
+            lines.sort()
+            for key,line in lines:
+                yield line
+
+
+def _iterparse(filename,tags):
+    """iterate over the elements of an XML file that have one of the given tags (with their subtrees), without keeping the whole tree in memory:
+       all other elements are removed from the tree as soon as they end (unless they are inside an element with one of the tags),
+       and elements with one of the tags as soon as they have been processed.
+    """
+
+    stack = []
+    inside = 0 # number of open elements with one of the tags
+
+    # (cElementTree in Python 2 only accepts native strings as event names)
+    for event,element in ET.iterparse(filename,events=(str('start'),str('end'))):
+
+        if event == 'start':
+            stack.append(element)
+            if element.tag in tags:
+                inside += 1
+            continue
+
+        stack.pop()
+        if element.tag in tags:
+            inside -= 1
+            yield element
+
+        if not inside and stack:
+            stack[-1].remove(element)
+
 
 class TigerXML():
     """interface to load reference word alignments from TigerXML corpus.
        Tested on SMULTRON (http://kitt.cl.uzh.ch/kitt/smultron/)
+       The XML files are parsed incrementally (see _iterparse), and only the words of aligned terminals are kept in memory.
     """
     
     def __init__(self,alignment_xml):
@@ -534,22 +1377,24 @@ class TigerXML():
         
 
     def _open_treebanks(self,alignment_xml):
-        """Parallel XML format references monolingual files. Open all."""
+        """Parallel XML format references monolingual files. Find the paths of all (the treebanks are declared before the alignments)."""
         
         alignment_path = os.path.dirname(alignment_xml)
-        align_xml = ET.parse(alignment_xml)
 
         treebanks = {}
-        treebanks['aligned'] = align_xml
+        treebanks['aligned'] = alignment_xml
         
-        for treebank in align_xml.findall('//treebank'):
-            treebank_id = treebank.get('id')
-            filename = treebank.get('filename')
+        for element in _iterparse(alignment_xml,('treebank','align')):
+            if element.tag == 'align':
+                break
+
+            treebank_id = element.get('id')
+            filename = element.get('filename')
             
             if not os.path.isabs(filename):
                 filename = os.path.join(alignment_path,filename)
         
-            treebanks[treebank_id] = ET.parse(filename)  
+            treebanks[treebank_id] = filename
 
         return treebanks
     
@@ -561,7 +1406,7 @@ class TigerXML():
         alignments = []
         ids = defaultdict(dict)
         
-        for alignment in self.treebanks['aligned'].findall('//align'):
+        for alignment in _iterparse(self.treebanks['aligned'],('align',)):
             
             newpair = {}
             
@@ -647,12 +1492,20 @@ class TigerXML():
         """Knowing which nodes are aligned, get actual words that are aligned."""
         
         words = defaultdict(dict)
+
+        # only the words of aligned terminals are stored
+        aligned_ids = {src:set(),target:set()}
+        for (src_ids, target_ids) in alignments:
+            aligned_ids[src].update(src_ids)
+            aligned_ids[target].update(target_ids)
         
-        for text in [text for text in self.treebanks if not text == 'aligned']:
+        for text in [text for text in aligned_ids if text in self.treebanks]:
         
             #TODO: Make lowercasing optional
-            for terminal in self.treebanks[text].findall('//t'):
-                words[text][terminal.get('id')] = terminal.get('word').lower()
+            for terminal in _iterparse(self.treebanks[text],('t',)):
+                terminal_id = terminal.get('id')
+                if terminal_id in aligned_ids[text]:
+                    words[text][terminal_id] = terminal.get('word').lower()
         
         
         for (src_ids, target_ids) in alignments:
@@ -709,6 +1562,35 @@ class Moses_Alignment():
             self.word_target[target] += 1
         
 
+class MultiReference():
+    """union of several reference sets (e.g. the tuning sets of different domains), each with its own reference interface.
+       The union (with the summed frequencies of the phrase pairs) serves to load the model data that is relevant for all reference sets in a single pass,
+       and is itself a reference set (e.g. for tuning on all reference sets together). The individual reference sets are in self.references.
+    """
+
+    def __init__(self,references):
+
+        self.references = references
+        self.word_pairs = defaultdict(lambda: defaultdict(int))
+        self.word_source = defaultdict(int)
+        self.word_target = defaultdict(int)
+
+
+    def load_word_pairs(self,src_lang,target_lang):
+        """load each reference set, and merge their phrase pairs"""
+
+        for reference in self.references:
+            reference.load_word_pairs(src_lang,target_lang)
+
+            for src,targets in reference.word_pairs.items():
+                for target,c in targets.items():
+                    self.word_pairs[src][target] += c
+            for src,c in reference.word_source.items():
+                self.word_source[src] += c
+            for target,c in reference.word_target.items():
+                self.word_target[target] += c
+
+
 def dot_product(a,b):
     """calculate dot product from two lists"""
     
@@ -722,6 +1604,64 @@ def dot_product(a,b):
     return s
     
 
+def _top_translations(candidates,values,limit):
+    """select the (at most) limit candidates with the highest values (with a bounded heap), in their original order.
+       candidates is a list of indices into values; of equal values, the earlier candidate is kept
+    """
+
+    if len(candidates) <= limit:
+        return candidates
+
+    return sorted(nlargest(limit,candidates,key=lambda j: (values[j],-j)))
+
+
+def _limit_block(pairs,scores,limit,feature):
+    """indices of the phrase pairs of a block (sorted by source phrase) that are written with a table limit:
+       for each source phrase, the limit translations with the highest value of a feature, among those that are written at all (see write_phrase_table_block)
+    """
+
+    written = (scores != 0).all(axis=1).tolist()
+    values = scores[:,feature].tolist()
+
+    keep = []
+    start = 0
+    for end in range(1,len(pairs)+1):
+        if end == len(pairs) or pairs[end][0] != pairs[start][0]:
+            keep += _top_translations([j for j in range(start,end) if written[j]],values,limit)
+            start = end
+
+    return keep
+
+
+def _dot_columns(values,weights):
+    """dot product of each row of a NumPy array (one column per model) with weights.
+       weights is either a list (same weights for all rows) or an array of the same shape as values.
+       summation order is the same as in dot_product, so results are identical
+    """
+    
+    s = numpy.zeros(len(values))
+    if isinstance(weights,list):
+        for k,w in enumerate(weights):
+            s += values[:,k] * w
+    else:
+        for k in range(weights.shape[1]):
+            s += values[:,k] * weights[:,k]
+    
+    return s
+    
+
+def _scalar_list(values,weights):
+    """convert a NumPy array that was computed with _dot_columns(x,weights) to a list,
+       with the same scalar type that dot_product would return.
+    """
+
+    for w in weights:
+        if isinstance(w,numpy.generic):
+            return list(values)
+
+    return values.tolist()
+
+
 def priority_sort_models(models):
     """primary models should have priority before supplementary models.
        zipped with index to know which weight model belongs to
@@ -756,14 +1696,15 @@ def cross_entropy(model_interface,reference_interface,weights,score,mode,flags):
             c = reference_interface.word_pairs[src][target]
             
             for i in range(num_results):
-                if src in model_interface.phrase_pairs and target in model_interface.phrase_pairs[src]:
+                if (src,target) in model_interface.phrase_pairs:
 
                     if ('compare_cross-entropies' in flags and flags['compare_cross-entropies']) or ('intersected_cross-entropies' in flags and flags['intersected_cross-entropies']):
                         
-                        if 0 in model_interface.phrase_pairs[src][target][0][0]: #only use intersection of models for comparability
+                        model_values = model_interface.phrase_pairs.get(src,target)[0]
+                        if 0 in model_values: #only use intersection of models for comparability
                         
                             # update unknown words statistics
-                            if model_interface.phrase_pairs[src][target][0][0][i]:
+                            if model_values[i]:
                                 ignored[i] += c
                             elif src in model_interface.phrase_source and model_interface.phrase_source[src][i]:
                                 other_translations[i] += c
@@ -844,6 +1785,384 @@ def cross_entropy_light(model_interface,reference_interface,weights,score,mode,f
     return cross_entropies
 
 
+def cross_entropy_gradient(model_interface,reference_interface,weights,score,mode,flags,cache,i):
+    """cross entropy of feature i (same as cross_entropy_light(...)[i]) and its gradient
+       with respect to the (unnormalized) weights of feature i.
+       don't call this directly, but use one of the Combine_TMs methods.
+    """
+    normalized_weights = normalize_weights(weights,mode,flags)
+    cross_entropy = 0
+    gradient = [0]*len(weights[i])
+
+    for (src,target,c) in cache:
+        features = score(normalized_weights,src,target,model_interface,flags,cache=True)
+
+        if 0 in features:
+            continue
+
+        cross_entropy -= log(features[i],2)*c
+
+        # d(-c*log2(p))/dw = -c/ln(2) * dlog(p)/dw
+        factor = -c/log(2)
+        for k,g in enumerate(_log_score_gradient(weights[i],src,target,model_interface,flags,i,mode,score)):
+            gradient[k] += factor*g
+
+    return cross_entropy,gradient
+
+
+def _log_score_gradient(weights,src,target,interface,flags,i,mode,score):
+    """gradient of the log of feature i of a phrase pair, with respect to the (unnormalized) weights of feature i.
+       mode is the feature-specific mode (see feature_specific_mode)
+    """
+
+    model_values = interface.phrase_pairs.get(src,target)[i]
+    lexical = i == flags['i_e2f_lex'] or i == flags['i_f2e_lex']
+
+    if score is score_loglinear:
+        # p = exp(sum_k u_k*log(p_k)), with u_k = w_k/sum(w)
+        total = sum(weights)
+        log_values = [log(p) for p in model_values]
+        mean = dot_product(log_values,weights)/total
+        return [(l - mean)/total for l in log_values]
+
+    if mode == 'counts':
+
+        if lexical:
+            return _log_lexicalweight_gradient(weights,src,target,interface,flags,i,mode)
+
+        # p = J/T, with J = sum_k w_k*c_k(s,t) and T = sum_k w_k*c_k(t) (or c_k(s) for p(t|s))
+        if i == flags['i_e2f']:
+            marginal = interface.phrase_target[target]
+        else:
+            marginal = interface.phrase_source[src]
+        joined_count = dot_product(model_values,weights)
+        marginal_count = dot_product(marginal,weights)
+        return [model_values[k]/joined_count - marginal[k]/marginal_count for k in range(len(weights))]
+
+    # linear interpolation: models in which the conditioning phrase is unseen get weight 0 if 'normalized' is set (see redistribute_probability_mass)
+    seen = [1]*len(weights)
+    if 'normalized' in flags and flags['normalized'] and (not lexical or flags['normalize-lexical_weights']):
+        if i == flags['i_f2e'] or i == flags['i_f2e_lex']:
+            seen = interface.phrase_source[src]
+        elif flags['normalize_s_given_t'] == 's' and (i == flags['i_e2f'] or i == flags['i_e2f_lex']):
+            seen = interface.phrase_source[src]
+        elif flags['normalize_s_given_t'] == 't' and (i == flags['i_e2f'] or i == flags['i_e2f_lex']):
+            seen = interface.phrase_target[target]
+
+    if lexical and 'recompute_lexweights' in flags and flags['recompute_lexweights']:
+        return _log_lexicalweight_gradient(list(map(mul,seen,weights)),src,target,interface,flags,i,mode,seen)
+
+    # p = sum_k w_k*s_k*p_k / D, with D = sum_k w_k*s_k
+    seen_weights = list(map(mul,seen,weights))
+    total = sum(seen_weights)
+    p = dot_product(model_values,seen_weights)/total
+    return [seen[k]*(model_values[k] - p)/(total*p) for k in range(len(weights))]
+
+
+def _log_lexicalweight_gradient(weights,src,target,interface,flags,i,mode,seen=None):
+    """gradient of the log of the lexical weight (see compute_lexicalweight) of a phrase pair, with respect to the (unnormalized) weights of feature i.
+       in mode 'interpolate', weights are the weights after redistribution (seen: 0 for models that are ignored, see redistribute_probability_mass)
+    """
+
+    e2f_alignment,f2e_alignment = interface.get_word_alignments(src,target,cache=True)
+
+    if i == flags['i_e2f_lex']:
+        alignment,word_pairs,marginal = e2f_alignment,interface.word_pairs_e2f,interface.word_target
+    else:
+        alignment,word_pairs,marginal = f2e_alignment,interface.word_pairs_f2e,interface.word_source
+
+    m = len(weights)
+    gradient = [0]*m
+
+    if mode == 'counts':
+
+        # lex = prod_x L_x, with L_x = 1/|T_x| * sum_y J(x,y)/M(y)
+        for x,translations in alignment:
+            if x.startswith(b'['):
+                continue
+
+            lex_step = 0
+            step_gradient = [0]*m
+            for y in translations:
+                joined = word_pairs.get(x,y)
+                marginal_y = marginal[y]
+                joined_count = dot_product(joined,weights)
+                marginal_count = dot_product(marginal_y,weights)
+                ratio = joined_count/marginal_count
+                lex_step += ratio
+                for k in range(m):
+                    step_gradient[k] += (joined[k] - ratio*marginal_y[k])/marginal_count
+
+            for k in range(m):
+                gradient[k] += step_gradient[k]/lex_step
+
+    else:
+
+        # lex = prod_x L_x, with L_x = sum_k u_k*a_k(x), u_k = w_k/D, and a_k(x) = 1/|T_x| * sum_y p_k(y|x)
+        # (the constant factor 1/|T_x| cancels out in the gradient of log(L_x))
+        total = sum(weights)
+        for x,translations in alignment:
+            if x.startswith(b'['):
+                continue
+
+            mean_values = [0]*m
+            for y in translations:
+                for k,p in enumerate(word_pairs.get(x,y)):
+                    mean_values[k] += p
+            lex_step = dot_product(mean_values,weights)/total
+
+            for k in range(m):
+                gradient[k] += seen[k]*(mean_values[k] - lex_step)/(total*lex_step)
+
+    return gradient
+
+
+class CompiledReference():
+    """reference phrase pairs (see _get_reference_cache) compiled into dense arrays for fast computation of cross-entropies and their gradients.
+       all data that does not depend on the weights (model probabilities, phrase counts, word translation probabilities for lexical weights)
+       is looked up once, so each evaluation only consists of a few vectorized array operations. Requires NumPy.
+       cross_entropy() returns the same values as cross_entropy_light() with the default scoring functions, and cross_entropy_gradient() as the function of the same name,
+       except for floating-point rounding (the terms are summed in a different order).
+    """
+
+    def __init__(self,cache,model_interface,mode,flags):
+
+        self.mode = mode
+        self.flags = flags
+        self.number_of_features = model_interface.number_of_features
+        self.number_of_models = len(model_interface.models)
+
+        self.lexical_features = [flags['i_e2f_lex'],flags['i_f2e_lex']]
+        self.count_features = [flags['i_e2f'],flags['i_f2e']]
+        recompute_lexweights = mode == 'counts' or (mode == 'interpolate' and 'recompute_lexweights' in flags and flags['recompute_lexweights'])
+
+        pairs = []
+        alignments = []
+        for (src,target,c) in cache:
+            if recompute_lexweights:
+                e2f_alignment,f2e_alignment = model_interface.get_word_alignments(src,target,cache=True)
+                # lexical weights are 0, so the phrase pair is always ignored
+                if not e2f_alignment or not f2e_alignment:
+                    continue
+                alignments.append((e2f_alignment,f2e_alignment))
+            pairs.append((src,target,c))
+
+        n = len(pairs)
+        rows = [model_interface.phrase_pairs.row(src,target) for (src,target,c) in pairs]
+        self.size = n
+        self.counts = numpy.array([c for (src,target,c) in pairs],dtype=numpy.float64)
+        self.values = model_interface.phrase_pairs.matrix()[rows].reshape(n,self.number_of_features,self.number_of_models)
+        self.source = model_interface.phrase_source.matrix([src for (src,target,c) in pairs])
+        self.target = model_interface.phrase_target.matrix([target for (src,target,c) in pairs])
+
+        # how each feature is computed
+        self.kinds = []
+        for i in range(self.number_of_features):
+            if mode == 'loglinear':
+                self.kinds.append('loglinear')
+            elif mode == 'counts' and i in self.count_features:
+                self.kinds.append('counts')
+            elif recompute_lexweights and i in self.lexical_features:
+                self.kinds.append(mode + '_lexical')
+            else:
+                self.kinds.append('interpolate')
+
+        # for linear interpolation with 'normalized': which models have seen the conditioning phrase (see redistribute_probability_mass)
+        self.seen = [None]*self.number_of_features
+        if mode == 'interpolate' and 'normalized' in flags and flags['normalized']:
+            redistribute = [(flags['i_f2e'],self.source)]
+            if flags['normalize-lexical_weights']:
+                redistribute.append((flags['i_f2e_lex'],self.source))
+            if flags['normalize_s_given_t'] == 's':
+                redistribute.append((flags['i_e2f'],self.source))
+                if flags['normalize-lexical_weights']:
+                    redistribute.append((flags['i_e2f_lex'],self.source))
+            elif flags['normalize_s_given_t'] == 't':
+                redistribute.append((flags['i_e2f'],self.target))
+                if flags['normalize-lexical_weights']:
+                    redistribute.append((flags['i_e2f_lex'],self.target))
+            for i,seen in redistribute:
+                self.seen[i] = seen
+
+        if mode == 'loglinear':
+            self.defined = (self.values > 0).all(axis=2)
+            with numpy.errstate(divide='ignore',invalid='ignore'):
+                self.log_values = numpy.log(numpy.where(self.values > 0,self.values,1))
+
+        self.lexical = {}
+        if recompute_lexweights:
+            if mode == 'counts':
+                marginals = [model_interface.word_target,model_interface.word_source]
+            else:
+                marginals = [None,None]
+            for d,(i,word_pairs,marginal) in enumerate(zip(self.lexical_features,[model_interface.word_pairs_e2f,model_interface.word_pairs_f2e],marginals)):
+                self.lexical[i] = self._compile_lexical([alignment[d] for alignment in alignments],word_pairs,marginal)
+
+
+    def _compile_lexical(self,alignments,word_pairs,marginal):
+        """index structure for lexical weights (see compute_lexicalweight): each phrase pair has one step per (terminal) word x,
+           and each step is the average over the word translation probabilities of the words aligned to x.
+        """
+
+        index = {}
+        keys = []
+        entry_word = []
+        entry_step = []
+        step_pair = []
+        step_length = []
+
+        for p,alignment in enumerate(alignments):
+            for x,translations in alignment:
+                if x.startswith(b'['):
+                    continue
+                step = len(step_pair)
+                step_pair.append(p)
+                step_length.append(len(translations))
+                for y in translations:
+                    try:
+                        k = index[(x,y)]
+                    except KeyError:
+                        k = index[(x,y)] = len(keys)
+                        keys.append((x,y))
+                    entry_word.append(k)
+                    entry_step.append(step)
+
+        m = self.number_of_models
+        lexical = {'word_pairs': word_pairs.matrix(keys),
+                   'entry_word': numpy.array(entry_word,dtype=numpy.intp),
+                   'entry_step': numpy.array(entry_step,dtype=numpy.intp),
+                   'step_pair': numpy.array(step_pair,dtype=numpy.intp),
+                   'step_length': numpy.array(step_length,dtype=numpy.float64)}
+
+        if marginal is not None:
+            lexical['marginal'] = marginal.matrix([y for (x,y) in keys])
+        else:
+            # for linear interpolation, the average of each step is independent of the weights
+            lexical['step_means'] = _sum_rows(lexical['word_pairs'][lexical['entry_word']],lexical['entry_step'],len(step_pair)) / lexical['step_length'][:,None]
+
+        return lexical
+
+
+    def _feature(self,weights,i,gradient=False):
+        """scores of feature i for all phrase pairs, given the (unnormalized) weights of feature i.
+           if gradient is True, also return the gradient of the log of the scores with respect to the weights (one row per phrase pair)
+        """
+
+        kind = self.kinds[i]
+        values = self.values[:,i,:]
+        grad = None
+
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+
+            if kind == 'loglinear':
+                # p = exp(sum_k u_k*log(p_k)), with u_k = w_k/sum(w). 0 if any p_k is 0
+                total = weights.sum()
+                log_values = self.log_values[:,i,:]
+                mean = log_values.dot(weights)/total
+                scores = numpy.where(self.defined[:,i],numpy.exp(mean),0)
+                if gradient:
+                    grad = (log_values - mean[:,None])/total
+
+            elif kind == 'counts':
+                # p = J/T, with J = sum_k w_k*c_k(s,t) and T = sum_k w_k*c_k(t) (or c_k(s) for p(t|s))
+                if i == self.flags['i_e2f']:
+                    marginal = self.target
+                else:
+                    marginal = self.source
+                joined_count = values.dot(weights)
+                marginal_count = marginal.dot(weights)
+                scores = numpy.where(marginal_count == 0,0,joined_count/marginal_count)
+                if gradient:
+                    grad = values/joined_count[:,None] - marginal/marginal_count[:,None]
+
+            elif kind == 'counts_lexical':
+                # lex = prod_x L_x, with L_x = 1/|T_x| * sum_y J(x,y)/M(y)
+                lexical = self.lexical[i]
+                marginal_count = lexical['marginal'].dot(weights)
+                ratios = lexical['word_pairs'].dot(weights)/marginal_count
+                step_sums = numpy.bincount(lexical['entry_step'],weights=ratios[lexical['entry_word']],minlength=len(lexical['step_pair']))
+                scores = numpy.exp(numpy.bincount(lexical['step_pair'],weights=numpy.log(step_sums/lexical['step_length']),minlength=self.size))
+                if gradient:
+                    ratio_gradient = (lexical['word_pairs'] - ratios[:,None]*lexical['marginal'])/marginal_count[:,None]
+                    step_gradient = _sum_rows(ratio_gradient[lexical['entry_word']],lexical['entry_step'],len(step_sums)) / step_sums[:,None]
+                    grad = _sum_rows(step_gradient,lexical['step_pair'],self.size)
+
+            else:
+                # linear interpolation: models in which the conditioning phrase is unseen get weight 0 if 'normalized' is set
+                seen = self.seen[i]
+                if seen is None:
+                    seen = numpy.ones((self.size,self.number_of_models))
+                seen_weights = seen*weights
+                total = seen_weights.sum(axis=1)
+
+                if kind == 'interpolate':
+                    scores = numpy.where(total == 0,0,(values*seen_weights).sum(axis=1)/total)
+                    if gradient:
+                        grad = seen*(values - scores[:,None])/(total*scores)[:,None]
+
+                else:
+                    # lex = prod_x L_x, with L_x = sum_k u_k*a_k(x), u_k = w_k*s_k/D, and a_k(x) = 1/|T_x| * sum_y p_k(y|x)
+                    lexical = self.lexical[i]
+                    step_pair = lexical['step_pair']
+                    normalized_weights = seen_weights/total[:,None]
+                    steps = (lexical['step_means']*normalized_weights[step_pair]).sum(axis=1)
+                    scores = numpy.exp(numpy.bincount(step_pair,weights=numpy.log(steps),minlength=self.size))
+                    scores[total == 0] = 0
+                    if gradient:
+                        step_gradient = seen[step_pair]*(lexical['step_means'] - steps[:,None])/(total[step_pair]*steps)[:,None]
+                        grad = _sum_rows(step_gradient,step_pair,self.size)
+
+        return scores,grad
+
+
+    def _scores(self,weights):
+        """scores of all features, and a mask of the phrase pairs that are considered (all scores non-zero)"""
+
+        scores = numpy.array([self._feature(numpy.array(weights[i],dtype=numpy.float64),i)[0] for i in range(self.number_of_features)]).reshape(self.number_of_features,self.size)
+        return scores,(scores != 0).all(axis=0)
+
+
+    def cross_entropy(self,weights):
+        """cross-entropy (not normalized by the number of phrase pairs) of each feature. See cross_entropy_light"""
+
+        scores,considered = self._scores(weights)
+        counts = self.counts[considered]
+
+        return [float(-(numpy.log2(scores[i][considered])*counts).sum()) for i in range(self.number_of_features)]
+
+
+    def cross_entropy_gradient(self,weights,i):
+        """cross-entropy of feature i, and its gradient with respect to the (unnormalized) weights of feature i. See cross_entropy_gradient"""
+
+        scores,considered = self._scores(weights)
+        counts = self.counts[considered]
+        feature_scores,grad = self._feature(numpy.array(weights[i],dtype=numpy.float64),i,gradient=True)
+
+        cross_entropy = float(-(numpy.log2(feature_scores[considered])*counts).sum())
+        gradient = -(grad[considered]*counts[:,None]).sum(axis=0)/log(2)
+
+        return cross_entropy,gradient.tolist()
+
+
+def _sum_rows(values,index,size):
+    """sum the rows of a 2-dimensional NumPy array by index (size: number of distinct indices)"""
+
+    result = numpy.zeros((size,values.shape[1]))
+    for k in range(values.shape[1]):
+        result[:,k] = numpy.bincount(index,weights=values[:,k],minlength=size)
+
+    return result
+
+
+def _compile_reference_cache(cache,model_interface,score_function,mode,flags):
+    """compile reference cache into a CompiledReference object if possible (requires NumPy, and one of the default scoring functions)"""
+
+    if numpy is None or (mode,score_function) not in [('interpolate',score_interpolate),('counts',score_counts),('loglinear',score_loglinear)]:
+        return None
+
+    return CompiledReference(cache,model_interface,mode,flags)
+
+
 def _get_reference_cache(reference_interface,model_interface):
     """creates a data structure that allows for a quick access 
        to all relevant reference set phrase/word pairs and their frequencies.
@@ -853,7 +2172,7 @@ def _get_reference_cache(reference_interface,model_interface):
 
     for src in reference_interface.word_pairs:
         for target in reference_interface.word_pairs[src]:
-            if src in model_interface.phrase_pairs and target in model_interface.phrase_pairs[src]:
+            if (src,target) in model_interface.phrase_pairs:
                 c = reference_interface.word_pairs[src][target]
                 cache.append((src,target,c))
                 n += c
@@ -870,7 +2189,7 @@ def _get_lexical_filter(reference_interface,model_interface):
     
     for src in reference_interface.word_pairs:
         for target in reference_interface.word_pairs[src]:
-            if src in model_interface.phrase_pairs and target in model_interface.phrase_pairs[src]:
+            if (src,target) in model_interface.phrase_pairs:
                 e2f_alignment,f2e_alignment = model_interface.get_word_alignments(src,target)
                 
                 for s,t_list in e2f_alignment:
@@ -895,7 +2214,7 @@ def _hillclimb_move(weights,stepsize,mode,flags):
         if new >= 1e-10:
             yield normalize_weights(weights[:i]+[new]+weights[i+1:],mode,flags)
 
-def _hillclimb(scores,best_weights,objective,model_interface,reference_interface,score_function,mode,flags,precision,cache,n):
+def _hillclimb(scores,best_weights,objective,model_interface,reference_interface,score_function,mode,flags,precision,cache,n,compiled=None):
     """first (deprecated) implementation of iterative weight optimization."""
     
     best = objective(best_weights)
@@ -921,7 +2240,10 @@ def _hillclimb(scores,best_weights,objective,model_interface,reference_interface
             if weights_tuple in scores:
                 continue
 
-            scores[weights_tuple] = cross_entropy_light(model_interface,reference_interface,[w for m in range(model_interface.number_of_features)],score_function,mode,flags,cache)
+            if compiled:
+                scores[weights_tuple] = compiled.cross_entropy([w for m in range(model_interface.number_of_features)])
+            else:
+                scores[weights_tuple] = cross_entropy_light(model_interface,reference_interface,[w for m in range(model_interface.number_of_features)],score_function,mode,flags,cache)
             
             if objective(weights_tuple)+precision < best:
                 best = objective(weights_tuple)
@@ -939,9 +2261,10 @@ def _hillclimb(scores,best_weights,objective,model_interface,reference_interface
     return best_weights
 
 
-def optimize_cross_entropy_hillclimb(model_interface,reference_interface,initial_weights,score_function,mode,flags,precision=0.000001):
+def optimize_cross_entropy_hillclimb(model_interface,reference_interface,initial_weights,score_function,mode,flags,precision=0.000001,stats=None):
     """find weights that minimize cross-entropy on a tuning set
        deprecated (default is now L-BFGS (optimize_cross_entropy)), but left in for people without SciPy
+       stats: PhaseStats object that receives the statistics of each objective
     """
     
     scores = {}
@@ -949,66 +2272,224 @@ def optimize_cross_entropy_hillclimb(model_interface,reference_interface,initial
     best_weights = tuple(initial_weights[0])
     
     cache,n = _get_reference_cache(reference_interface,model_interface)
+    compiled = _compile_reference_cache(cache,model_interface,score_function,mode,flags)
     
     # each objective is a triple: which score to minimize from cross_entropy(), which weights to update accordingly, and a comment that is printed
-    objectives = [(lambda x: scores[x][i]/n,[i],'minimize cross-entropy for feature {0}'.format(i)) for i in range(model_interface.number_of_features)]
+    objectives = [(lambda x,i=i: scores[x][i]/n,[i],'minimize cross-entropy for feature {0}'.format(i)) for i in range(model_interface.number_of_features)]
     
-    scores[best_weights] = cross_entropy_light(model_interface,reference_interface,initial_weights,score_function,mode,flags,cache)
+    if compiled:
+        scores[best_weights] = compiled.cross_entropy(initial_weights)
+    else:
+        scores[best_weights] = cross_entropy_light(model_interface,reference_interface,initial_weights,score_function,mode,flags,cache)
     final_weights = initial_weights[:]
     final_cross_entropy = [0]*model_interface.number_of_features
     
-    for i,(objective, features, comment) in enumerate(objectives):
+    def optimize(i):
+        objective, features, comment = objectives[i]
         best_weights = min(scores,key=objective)
+        evaluations = len(scores)
         sys.stderr.write('Optimizing objective "' + comment +'"\n')
-        best_weights = _hillclimb(scores,best_weights,objective,model_interface,reference_interface,score_function,feature_specific_mode(mode,i,flags),flags,precision,cache,n)
+        best_weights = _hillclimb(scores,best_weights,objective,model_interface,reference_interface,score_function,feature_specific_mode(mode,i,flags),flags,precision,cache,n,compiled)
         
         sys.stderr.write('\nCross-entropy:' + str(objective(best_weights)) + ' - weights: ' + str(best_weights)+'\n\n')
         
+        return (list(best_weights),objective(best_weights)),{'evaluations':len(scores)-evaluations}
+    
+    # with several processes, objectives are optimized concurrently, and points evaluated for one objective are not re-used for the others
+    results = _run_optimizations(optimize,objectives,flags['processes'],stats)
+    
+    for (objective, features, comment),((best_weights,best_cross_entropy),objective_stats) in zip(objectives,results):
         for j in features:
-            final_weights[j] = list(best_weights)
-            final_cross_entropy[j] = objective(best_weights)
+            final_weights[j] = best_weights
+            final_cross_entropy[j] = best_cross_entropy
 
     return final_weights,final_cross_entropy
 
 
-def optimize_cross_entropy(model_interface,reference_interface,initial_weights,score_function,mode,flags):
+def optimize_cross_entropy(model_interface,reference_interface,initial_weights,score_function,mode,flags,stats=None):
     """find weights that minimize cross-entropy on a tuning set
        Uses L-BFGS optimization and requires SciPy
+       stats: PhaseStats object that receives the statistics of each objective and of each L-BFGS iteration
+    """
+
+    return optimize_cross_entropies(model_interface,[reference_interface],initial_weights,score_function,mode,flags,stats)[0]
+
+
+def optimize_cross_entropies(model_interface,reference_interfaces,initial_weights,score_function,mode,flags,stats=None):
+    """find the weights that minimize cross-entropy on each of several tuning sets, which share the loaded model data (see MultiReference).
+       the objectives of all tuning sets (one per feature and tuning set) are optimized together (concurrently with several processes).
+       returns one pair (weights,cross-entropies) per tuning set
     """
     
     if not optimizer == 'l-bfgs':
         sys.stderr.write('SciPy is not installed. Falling back to naive hillclimb optimization (instead of L-BFGS)\n')
-        return optimize_cross_entropy_hillclimb(model_interface,reference_interface,initial_weights,score_function,mode,flags)
-    
-    cache,n = _get_reference_cache(reference_interface,model_interface)
+        return [optimize_cross_entropy_hillclimb(model_interface,reference_interface,initial_weights,score_function,mode,flags,stats=stats) for reference_interface in reference_interfaces]
     
-    # each objective is a triple: which score to minimize from cross_entropy(), which weights to update accordingly, and a comment that is printed
-    objectives = [(lambda w: cross_entropy_light(model_interface,reference_interface,[[1]+list(w) for m in range(model_interface.number_of_features)],score_function,feature_specific_mode(mode,i,flags),flags,cache)[i],[i],'minimize cross-entropy for feature {0}'.format(i)) for i in range(model_interface.number_of_features)] #optimize cross-entropy for p(s|t)
-
-    final_weights = initial_weights[:]
-    final_cross_entropy = [0]*model_interface.number_of_features
-    
-    for i,(objective, features, comment) in enumerate(objectives):
+    # each objective is a triple: a function that returns the cross-entropy of a feature and its gradient, which weights to update accordingly, and a comment that is printed
+    objectives = []
+    sizes = []
+    for k,reference_interface in enumerate(reference_interfaces):
+        cache,n = _get_reference_cache(reference_interface,model_interface)
+        compiled = _compile_reference_cache(cache,model_interface,score_function,mode,flags)
+        tuning_set = ' on tuning set {0}'.format(k) if len(reference_interfaces) > 1 else ''
+        objectives += [(_cross_entropy_objective(model_interface,reference_interface,score_function,mode,flags,cache,i,compiled),[i],'minimize cross-entropy for feature {0}'.format(i) + tuning_set) for i in range(model_interface.number_of_features)] #optimize cross-entropy for p(s|t)
+        sizes += [n]*model_interface.number_of_features
+
+    def optimize(i):
+        objective, features, comment = objectives[i]
+        n = sizes[i]
         sys.stderr.write('Optimizing objective "' + comment +'"\n')
         initial_values = [1]*(len(model_interface.models)-1) # we leave value of first model at 1 and optimize all others (normalized of course)
-        best_weights, best_point, data = fmin_l_bfgs_b(objective,initial_values,approx_grad=True,bounds=[(0.000000001,None)]*len(initial_values))
-        best_weights = normalize_weights([1]+list(best_weights),feature_specific_mode(mode,i,flags),flags)
+        traced_objective,callback,trace = _trace_iterations(objective,n)
+        best_weights, best_point, data = fmin_l_bfgs_b(traced_objective,initial_values,bounds=[(0.000000001,None)]*len(initial_values),callback=callback)
+        best_weights = normalize_weights([1]+list(best_weights),feature_specific_mode(mode,features[0],flags),flags)
         sys.stderr.write('Cross-entropy after L-BFGS optimization: ' + str(best_point/n) + ' - weights: ' + str(best_weights)+'\n')
+        
+        objective_stats = {'iterations':data.get('nit'),'evaluations':data['funcalls'],'converged':data['warnflag'] == 0,'message':data['task'],'trace':trace}
+        return (best_weights,best_point/n),objective_stats
     
-        for j in features:
-            final_weights[j] = list(best_weights)
-            final_cross_entropy[j] = best_point/n
+    results = _run_optimizations(optimize,objectives,flags['processes'],stats)
+
+    best = []
+    number_of_features = model_interface.number_of_features
+    for k in range(len(reference_interfaces)):
+        final_weights = initial_weights[:]
+        final_cross_entropy = [0]*number_of_features
+        for (objective, features, comment),((best_weights,best_cross_entropy),objective_stats) in list(zip(objectives,results))[k*number_of_features:(k+1)*number_of_features]:
+            for j in features:
+                final_weights[j] = list(best_weights)
+                final_cross_entropy[j] = best_cross_entropy
+        best.append((final_weights,final_cross_entropy))
+
+    return best
+
+
+def _trace_iterations(objective,n):
+    """wrap an L-BFGS objective to record the progress of each iteration.
+       returns the wrapped objective, a callback for fmin_l_bfgs_b, and the list that the callback fills with one dictionary per iteration
+       (cross-entropy and weights at the end of the iteration, number of evaluations, wall-clock and CPU time of the iteration).
+    """
 
-    return final_weights,final_cross_entropy
+    trace = []
+    last = {'value':None,'evaluations':0,'time':time.time(),'cpu':sum(os.times()[:2])}
 
+    def traced_objective(w):
+        value = objective(w)
+        last['value'] = value[0]
+        last['evaluations'] += 1
+        return value
 
-def feature_specific_mode(mode,i,flags):
-    """in mode 'counts', only the default Moses features can be recomputed from raw frequencies;
-       all other features are interpolated by default. 
-       This fucntion mostly serves optical purposes (i.e. normalizing a single weight vector for logging),
-       since normalize_weights also handles a mix of interpolated and recomputed features.
-    """
-    
+    def callback(w):
+        now,cpu = time.time(),sum(os.times()[:2])
+        trace.append({'iteration':len(trace)+1,
+                      'cross_entropy':float(last['value'])/n,
+                      'weights':[1]+[float(x) for x in w],
+                      'evaluations':last['evaluations'],
+                      'wall':now-last['time'],
+                      'cpu':cpu-last['cpu'],
+                      'time':now})
+        last.update(evaluations=0,time=now,cpu=cpu)
+
+    return traced_objective,callback,trace
+
+
+# state of the parent process, inherited by forked worker processes (see _run_optimizations)
+_optimization_state = {}
+
+def _optimize_objective(i):
+    """worker function: optimize objective i, and measure the (wall-clock and CPU) time it takes"""
+
+    start,start_cpu = time.time(),sum(os.times()[:2])
+    try:
+        result,stats = _optimization_state['optimize'](i)
+    except SystemExit:
+        # don't let sys.exit() kill the worker silently; the parent should know
+        raise RuntimeError('optimization of objective {0} failed (see error message above)'.format(i))
+    stats['time'] = time.time() - start
+    stats['cpu'] = sum(os.times()[:2]) - start_cpu
+
+    return result,stats
+
+
+def _run_optimizations(optimize,objectives,processes=1,phase_stats=None):
+    """call optimize(i) for each objective i, which returns a result and a dictionary of statistics.
+       with several processes, the objectives are optimized concurrently by forked worker processes
+       that share all loaded data (copy-on-write; if processes can't be forked, see _fork_pool, they are optimized one after the other). Returns a list of (result,stats), and reports the statistics of each objective
+       (and, if phase_stats is a PhaseStats object, emits them as records, along with the iterations in stats['trace']).
+    """
+
+    start = time.time()
+    _optimization_state.update(optimize=optimize)
+    try:
+        pool = None
+        if processes > 1 and len(objectives) > 1:
+            pool = _fork_pool(min(processes,len(objectives)))
+            if pool is None:
+                sys.stderr.write('Warning: concurrent optimization requires that worker processes can be forked, which is not possible on this platform. Using a single process...\n')
+        if pool is not None:
+            try:
+                results = pool.map(_optimize_objective,range(len(objectives)))
+            except:
+                pool.terminate()
+                raise
+            pool.close()
+            pool.join()
+        else:
+            results = [_optimize_objective(i) for i in range(len(objectives))]
+    finally:
+        _optimization_state.clear()
+
+    sys.stderr.write('Optimization statistics:\n')
+    for (objective, features, comment),(result,stats) in zip(objectives,results):
+        line = '  {0}: {1:.2f}s'.format(comment,stats['time'])
+        if stats.get('iterations') is not None:
+            line += ', {0} iterations'.format(stats['iterations'])
+        line += ', {0} evaluations'.format(stats['evaluations'])
+        if 'converged' in stats:
+            if stats['converged']:
+                line += ', converged'
+            else:
+                line += ', not converged ({0})'.format(stats['message'])
+        sys.stderr.write(line + '\n')
+    sys.stderr.write('  total: {0:.2f}s\n'.format(time.time()-start))
+
+    if phase_stats is not None:
+        for i,((objective, features, comment),(result,stats)) in enumerate(zip(objectives,results)):
+            for iteration in stats.get('trace',[]):
+                phase_stats.emit(dict(iteration,phase='optimizer-iteration',objective=i))
+            record = dict((key,value) for (key,value) in stats.items() if key not in ['time','trace'])
+            record.update(phase='optimize-objective',objective=i,comment=comment,wall=stats['time'],cross_entropy=float(result[1]))
+            if isinstance(record.get('message'),bytes):
+                record['message'] = record['message'].decode('utf-8')
+            phase_stats.emit(record)
+
+    return results
+
+
+def _cross_entropy_objective(model_interface,reference_interface,score_function,mode,flags,cache,i,compiled=None):
+    """objective function for L-BFGS: cross-entropy of feature i and its (analytic) gradient.
+       the weight of the first model is fixed at 1; the free variables are the weights of all other models.
+       uses the compiled reference set (see CompiledReference) if available.
+    """
+
+    def objective(w):
+        weights = [[1]+list(w) for m in range(model_interface.number_of_features)]
+        if compiled:
+            cross_entropy,gradient = compiled.cross_entropy_gradient(weights,i)
+        else:
+            cross_entropy,gradient = cross_entropy_gradient(model_interface,reference_interface,weights,score_function,feature_specific_mode(mode,i,flags),flags,cache,i)
+        return cross_entropy,numpy.array(gradient[1:])
+
+    return objective
+
+
+def feature_specific_mode(mode,i,flags):
+    """in mode 'counts', only the default Moses features can be recomputed from raw frequencies;
+       all other features are interpolated by default. 
+       This fucntion mostly serves optical purposes (i.e. normalizing a single weight vector for logging),
+       since normalize_weights also handles a mix of interpolated and recomputed features.
+    """
+    
     if mode == 'counts' and i not in [flags['i_e2f'],flags['i_e2f_lex'],flags['i_f2e'],flags['i_f2e_lex']]:
         return 'interpolate'
     else:
@@ -1055,7 +2536,7 @@ def score_interpolate(weights,src,target,interface,flags,cache=False):
        if normalized is True, the probability mass for p(x|y) is redistributed to models with p(y) > 0
     """
 
-    model_values = interface.phrase_pairs[src][target][0]
+    model_values = interface.phrase_pairs.get(src,target)
     
     scores = [0]*len(model_values)
     
@@ -1091,7 +2572,7 @@ def score_loglinear(weights,src,target,interface,flags,cache=False):
     """
     
     scores = []
-    model_values = interface.phrase_pairs[src][target][0]
+    model_values = interface.phrase_pairs.get(src,target)
 
     for idx,prob in enumerate(model_values):
         try:
@@ -1118,15 +2599,17 @@ def score_counts(weights,src,target,interface,flags,cache=False):
     else:
         scores = score_interpolate(weights,src,target,interface,flags,cache=cache)
     
+    model_values = interface.phrase_pairs.get(src,target)
+    
     try:
-        joined_count = dot_product(interface.phrase_pairs[src][target][0][i_e2f],weights[i_e2f])
+        joined_count = dot_product(model_values[i_e2f],weights[i_e2f])
         target_count = dot_product(interface.phrase_target[target],weights[i_e2f])
         scores[i_e2f] = joined_count / target_count
     except ZeroDivisionError:
         scores[i_e2f] = 0
 
     try:
-        joined_count = dot_product(interface.phrase_pairs[src][target][0][i_f2e],weights[i_f2e])
+        joined_count = dot_product(model_values[i_f2e],weights[i_f2e])
         source_count = dot_product(interface.phrase_source[src],weights[i_f2e])
         scores[i_f2e] = joined_count / source_count
     except ZeroDivisionError:
@@ -1140,12 +2623,187 @@ def score_counts(weights,src,target,interface,flags,cache=False):
         scores[i_f2e_lex] = 0
     
     else:
-        scores[i_e2f_lex] = compute_lexicalweight(weights[i_e2f_lex],e2f_alignment,interface.word_pairs_e2f,interface.word_target,mode='counts',cache=cache)
-        scores[i_f2e_lex] = compute_lexicalweight(weights[i_f2e_lex],f2e_alignment,interface.word_pairs_f2e,interface.word_source,mode='counts',cache=cache)
+        scores[i_e2f_lex] = compute_lexicalweight(weights[i_e2f_lex],e2f_alignment,interface.word_pairs_e2f,interface.word_target,mode='counts',cache=interface.lexical_cache_e2f if cache else None)
+        scores[i_f2e_lex] = compute_lexicalweight(weights[i_f2e_lex],f2e_alignment,interface.word_pairs_f2e,interface.word_source,mode='counts',cache=interface.lexical_cache_f2e if cache else None)
     
     return scores
 
 
+def redistribute_probability_mass_block(weights,pairs,interface,flags):
+    """same as redistribute_probability_mass, but for a list of phrase pairs.
+       returns a list of weights per feature; redistributed weights are NumPy arrays with one row per phrase pair
+    """
+
+    i_e2f = flags['i_e2f']
+    i_e2f_lex = flags['i_e2f_lex']
+    i_f2e = flags['i_f2e']
+    i_f2e_lex = flags['i_f2e_lex']
+
+    # features that are not redistributed are normalized as usual
+    new_weights = normalize_weights(weights,'interpolate',flags)
+
+    source_seen = interface.phrase_source.matrix([src for (src,target) in pairs])
+
+    redistribute = [(i_f2e,source_seen)]
+    if flags['normalize-lexical_weights']:
+        redistribute.append((i_f2e_lex,source_seen))
+
+    if flags['normalize_s_given_t'] == 's':
+        redistribute.append((i_e2f,source_seen))
+        if flags['normalize-lexical_weights']:
+            redistribute.append((i_e2f_lex,source_seen))
+
+    elif flags['normalize_s_given_t'] == 't':
+        target_seen = interface.phrase_target.matrix([target for (src,target) in pairs])
+        redistribute.append((i_e2f,target_seen))
+        if flags['normalize-lexical_weights']:
+            redistribute.append((i_e2f_lex,target_seen))
+
+    for i,seen in redistribute:
+
+        # set weight to 0 for all models where the phrase is unseen, and renormalize
+        feature_weights = seen * weights[i]
+        total = _dot_columns(feature_weights,[1]*len(weights[i]))
+
+        unseen = total == 0
+        if unseen.any():
+            sys.stderr.write('Error: Zero division in weight normalization. Are some of your weights zero? This might lead to undefined behaviour if a phrase pair is only seen in model with weight 0\n')
+            total[unseen] = 1
+
+        new_weights[i] = feature_weights / total[:,None]
+
+    return new_weights
+
+
+def score_interpolate_block(weights,pairs,rows,interface,flags):
+    """same as score_interpolate, but for a list of phrase pairs (with their rows in interface.phrase_pairs).
+       returns a NumPy array of scores with one row per phrase pair
+    """
+
+    model_values = interface.phrase_pairs.matrix()[rows]
+
+    scores = numpy.zeros(model_values.shape[:2])
+
+    if 'normalized' in flags and flags['normalized']:
+        normalized_weights = redistribute_probability_mass_block(weights,pairs,interface,flags)
+    else:
+        normalized_weights = weights
+
+    recompute_lexweights = 'recompute_lexweights' in flags and flags['recompute_lexweights']
+
+    for idx in range(model_values.shape[1]):
+        if not (recompute_lexweights and (idx == flags['i_e2f_lex'] or idx == flags['i_f2e_lex'])):
+            scores[:,idx] = _dot_columns(model_values[:,idx,:],normalized_weights[idx])
+
+    if recompute_lexweights:
+
+        alignments = _get_word_alignments_block(pairs,interface)
+
+        for idx,word_pairs,alignment_list in [(flags['i_e2f_lex'],interface.word_pairs_e2f,[a[0] for a in alignments]),(flags['i_f2e_lex'],interface.word_pairs_f2e,[a[1] for a in alignments])]:
+
+            # redistributed weights differ between phrase pairs
+            if isinstance(normalized_weights[idx],list):
+                scores[:,idx] = compute_lexicalweight_block(normalized_weights[idx],alignment_list,word_pairs,None,mode='interpolate')
+            else:
+                for j,alignment in enumerate(alignment_list):
+                    if alignment:
+                        scores[j,idx] = compute_lexicalweight(normalized_weights[idx][j].tolist(),alignment,word_pairs,None,mode='interpolate')
+
+    return scores
+
+
+def score_interpolate_sweep_block(weight_configurations,pairs,rows,interface,flags):
+    """same as score_interpolate_block (without normalization or recomputed lexical weights), but for several weight configurations at once.
+       returns a NumPy array with one array of scores (one row per phrase pair) per weight configuration.
+       models are summed in the same order as in _dot_columns, so the scores are identical to those of score_interpolate_block.
+    """
+
+    model_values = interface.phrase_pairs.matrix()[rows]
+    weights = numpy.array(weight_configurations,dtype=float)
+
+    scores = numpy.zeros((len(weight_configurations),) + model_values.shape[:2])
+    for k in range(model_values.shape[2]):
+        scores += model_values[None,:,:,k] * weights[:,None,:,k]
+
+    return scores
+
+
+def score_loglinear_block(weights,pairs,rows,interface,flags):
+    """same as score_loglinear, but for a list of phrase pairs (with their rows in interface.phrase_pairs).
+       returns a NumPy array of scores with one row per phrase pair
+    """
+
+    model_values = interface.phrase_pairs.matrix()[rows]
+
+    scores = numpy.zeros(model_values.shape[:2])
+
+    # log of non-positive values is undefined; these scores are 0
+    defined = (model_values > 0).all(axis=2)
+
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        log_values = numpy.log(model_values)
+
+    for idx in range(model_values.shape[1]):
+        scores[:,idx] = numpy.exp(_dot_columns(log_values[:,idx,:],weights[idx]))
+
+    scores[~defined] = 0
+
+    return scores
+
+
+def score_counts_block(weights,pairs,rows,interface,flags):
+    """same as score_counts, but for a list of phrase pairs (with their rows in interface.phrase_pairs).
+       returns a NumPy array of scores with one row per phrase pair
+    """
+
+    i_e2f = flags['i_e2f']
+    i_e2f_lex = flags['i_e2f_lex']
+    i_f2e = flags['i_f2e']
+    i_f2e_lex = flags['i_f2e_lex']
+
+    # if we have non-default number of weights, assume that we might have to do a mix of count-based and interpolated scores.
+    if len(weights) == 4:
+        scores = numpy.zeros((len(pairs),len(weights)))
+    else:
+        scores = score_interpolate_block(weights,pairs,rows,interface,flags)
+
+    model_values = interface.phrase_pairs.matrix()[rows]
+
+    joined_count = _dot_columns(model_values[:,i_e2f,:],weights[i_e2f])
+    target_count = _dot_columns(interface.phrase_target.matrix([target for (src,target) in pairs]),weights[i_e2f])
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        scores[:,i_e2f] = numpy.where(target_count == 0,0,joined_count / target_count)
+
+    joined_count = _dot_columns(model_values[:,i_f2e,:],weights[i_f2e])
+    source_count = _dot_columns(interface.phrase_source.matrix([src for (src,target) in pairs]),weights[i_f2e])
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        scores[:,i_f2e] = numpy.where(source_count == 0,0,joined_count / source_count)
+
+    alignments = _get_word_alignments_block(pairs,interface)
+
+    scores[:,i_e2f_lex] = compute_lexicalweight_block(weights[i_e2f_lex],[a[0] for a in alignments],interface.word_pairs_e2f,interface.word_target,mode='counts')
+    scores[:,i_f2e_lex] = compute_lexicalweight_block(weights[i_f2e_lex],[a[1] for a in alignments],interface.word_pairs_f2e,interface.word_source,mode='counts')
+
+    return scores
+
+
+def _get_word_alignments_block(pairs,interface):
+    """word alignments of a list of phrase pairs. If a phrase pair has no alignment, both alignments are None"""
+
+    alignments = []
+
+    for src,target in pairs:
+        e2f_alignment,f2e_alignment = interface.get_word_alignments(src,target)
+
+        if not e2f_alignment or not f2e_alignment:
+            sys.stderr.write('Error: no word alignments found, but necessary for lexical weight computation.\n')
+            e2f_alignment,f2e_alignment = None,None
+
+        alignments.append((e2f_alignment,f2e_alignment))
+
+    return alignments
+
+
 def score_interpolate_reordering(weights,src,target,interface):
     """linear interpolation of reordering model probabilities
        also normalizes model so that 
@@ -1165,43 +2823,127 @@ def score_interpolate_reordering(weights,src,target,interface):
     return scores
 
 
-def compute_lexicalweight(weights,alignment,word_pairs,marginal,mode='counts',cache=False,mycache=[0,defaultdict(dict)]):
-    """compute the lexical weights as implemented in Moses toolkit"""
+def score_interpolate_reordering_block(weights,pairs,rows,interface):
+    """same as score_interpolate_reordering, but for a list of phrase pairs (with their rows in interface.phrase_pairs).
+       returns NumPy array of shape (pairs,features)
+    """
+
+    model_values = interface.phrase_pairs.matrix()[rows]
+    number_of_features = interface.number_of_features
+
+    scores = numpy.empty((len(rows),number_of_features))
+    for idx in range(number_of_features):
+        scores[:,idx] = _dot_columns(model_values[:,idx,:],list(weights[idx]))
+
+    #normalizes first half and last half probabilities (see score_interpolate_reordering)
+    mid = int(number_of_features/2)
+    for start,end in [(0,mid),(mid,number_of_features)]:
+        total = numpy.zeros(len(rows))
+        for idx in range(start,end):
+            total += scores[:,idx]
+
+        # let normalize_weights deal with a probability mass of zero, as in the per-pair scoring
+        for j in numpy.flatnonzero(total == 0):
+            scores[j,start:end] = normalize_weights(scores[j,start:end].tolist(),'interpolate')
+
+        nonzero = total != 0
+        scores[nonzero,start:end] /= total[nonzero,None]
+
+    return scores
+
+
+def compute_lexicalweight(weights,alignment,word_pairs,marginal,mode='counts',cache=None):
+    """compute the lexical weights as implemented in Moses toolkit.
+       cache is an optional dictionary that stores the steps of each word for the current weights. Use one cache per lexical table (e.g. interface.lexical_cache_e2f for word_pairs_e2f).
+    """
     
     lex = 1
     
     # new weights: empty cache
-    if cache and mycache[0] != weights:
-        mycache[0] = weights
-        mycache[1] = defaultdict(dict)
+    if cache is not None:
+        if cache.get('weights') != weights:
+            cache['weights'] = list(weights)
+            cache['steps'] = defaultdict(dict)
+        steps = cache['steps']
     
     for x,translations in alignment:
         # skip nonterminals
         if x.startswith(b'['):
           continue
         
-        if cache and translations in mycache[1][x]:
-            lex_step = mycache[1][x][translations]
+        if cache is not None and translations in steps[x]:
+            lex_step = steps[x][translations]
         
         else:
             lex_step = 0
             for y in translations:
                 
                 if mode == 'counts':
-                    lex_step += dot_product(word_pairs[x][y],weights) / dot_product(marginal[y],weights)
+                    lex_step += dot_product(word_pairs.get(x,y),weights) / dot_product(marginal[y],weights)
                 elif mode == 'interpolate':
-                    lex_step += dot_product(word_pairs[x][y],weights)
+                    lex_step += dot_product(word_pairs.get(x,y),weights)
             
             lex_step /= len(translations)
             
-            if cache:
-                mycache[1][x][translations] = lex_step
+            if cache is not None:
+                steps[x][translations] = lex_step
             
         lex *= lex_step
         
     return lex
 
 
+def compute_lexicalweight_block(weights,alignments,word_pairs,marginal,mode='counts'):
+    """same as compute_lexicalweight, but for a list of alignments (lexical weight is 0 if alignment is None).
+       the weighted word translation probabilities of all word pairs are computed together with vectorized operations.
+    """
+
+    index = {}
+    keys = []
+
+    for alignment in alignments:
+        if not alignment:
+            continue
+        for x,translations in alignment:
+            if x.startswith(b'['):
+                continue
+            for y in translations:
+                if (x,y) not in index:
+                    index[(x,y)] = len(keys)
+                    keys.append((x,y))
+
+    if keys:
+        probabilities = _dot_columns(word_pairs.matrix(keys),weights)
+        if mode == 'counts':
+            probabilities /= _dot_columns(marginal.matrix([y for (x,y) in keys]),weights)
+        probabilities = probabilities.tolist()
+
+    lexical_weights = []
+
+    for alignment in alignments:
+
+        if not alignment:
+            lexical_weights.append(0)
+            continue
+
+        lex = 1
+        for x,translations in alignment:
+            # skip nonterminals
+            if x.startswith(b'['):
+              continue
+
+            lex_step = 0
+            for y in translations:
+                lex_step += probabilities[index[(x,y)]]
+
+            lex_step /= len(translations)
+            lex *= lex_step
+
+        lexical_weights.append(lex)
+
+    return lexical_weights
+
+
 def normalize_weights(weights,mode,flags=None):
     """make sure that probability mass in linear interpolation is 1
        for weighted counts, weight of first model is set to 1
@@ -1258,64 +3000,1458 @@ def normalize_weights(weights,mode,flags=None):
         else:
             return normalize_weights(weights,'counts_pure')
 
-    return new_weights
+    return new_weights
+
+
+def handle_file(filename,action,fileobj=None,mode='r',threads=1):
+    """support reading/writing either from/to file, stdout or gzipped file
+       gzipped files are (de)compressed in background threads (see GzipReader and GzipWriter); threads is the number of threads that compress output.
+    """
+
+    if action == 'open':
+
+        if mode == 'r':
+            mode = 'rb'
+        elif mode == 'w':
+            mode = 'wb'
+
+        if mode == 'rb' and not filename == '-' and not os.path.exists(filename):
+            if os.path.exists(filename+'.gz'):
+                filename = filename+'.gz'
+            else:
+                sys.stderr.write('Error: unable to open file. ' + filename + ' - aborting.\n')
+                
+                if 'counts' in filename and os.path.exists(os.path.dirname(filename)):
+                    sys.stderr.write('For a weighted counts combination, we need statistics that Moses doesn\'t write to disk by default.\n')
+                    sys.stderr.write('Repeat step 4 of Moses training for all models with the option -write-lexical-counts.\n')
+                
+                exit(1)
+
+        if filename.endswith('.gz') and mode == 'rb':
+            fileobj = GzipReader(filename)
+
+        elif filename.endswith('.gz') and mode == 'wb':
+            fileobj = GzipWriter(filename,threads)
+
+        elif filename.endswith('.gz'):
+            fileobj = gzip.open(filename,mode)
+            
+        elif filename == '-' and mode == 'wb':
+            fileobj = sys.stdout
+                    
+        else:
+                fileobj = open(filename,mode)
+        
+        return fileobj
+    
+    elif action == 'close' and filename != '-':
+        fileobj.close()   
+
+
+class GzipReader():
+    """read gzipped file line by line. Decompression runs in a background thread (zlib releases the GIL while decompressing),
+       so that it overlaps with the processing of the lines in the main thread. Files with multiple gzip members are supported.
+    """
+
+    def __init__(self,filename,block_size=256*1024,queue_size=4):
+
+        self.name = filename
+        self.closed = False
+        self.fileobj = open(filename,'rb')
+        self.blocks = queue.Queue(queue_size)
+        self.stopped = threading.Event()
+        self.lines = self._read_lines()
+
+        self.thread = threading.Thread(target=self._decompress,args=(block_size,))
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        return next(self.lines)
+
+    next = __next__
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self,*args):
+        self.close()
+
+
+    def readline(self):
+        for line in self.lines:
+            return line
+        return b''
+
+
+    def read(self):
+        """read the rest of the file"""
+        return b''.join(self.lines)
+
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+        self.fileobj.close()
+        self.closed = True
+
+
+    def _put(self,item):
+        """put item into queue; returns False if reader was closed in the meantime"""
+
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item,timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+    def _decompress(self,block_size):
+        """background thread: read and decompress file, and put blocks of decompressed data into the queue (None at the end of the file)"""
+
+        try:
+            decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+            data = self.fileobj.read(block_size)
+            while data:
+                block = decompressor.decompress(data)
+                if block and not self._put(block):
+                    return
+
+                # start of the next gzip member (ignoring zero padding at the end of the file)
+                data = decompressor.unused_data
+                if data and data.strip(b'\x00'):
+                    decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+                else:
+                    data = self.fileobj.read(block_size)
+
+            if not _stream_ended(decompressor):
+                raise IOError('Compressed file ended before the end-of-stream marker was reached: ' + self.name)
+            self._put(None)
+
+        except Exception as e:
+            self._put(e)
+
+
+    def _read_lines(self):
+
+        partial = b''
+
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            elif isinstance(block,Exception):
+                raise block
+
+            lines = (partial + block).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+
+        if partial:
+            yield partial
+
+
+def _stream_ended(decompressor):
+    """whether zlib decompressor has reached the end of its stream (Python 2 lacks the attribute 'eof')"""
+
+    if hasattr(decompressor,'eof'):
+        return decompressor.eof
+    elif decompressor.unused_data:
+        return True
+
+    # data after the end of the stream is not consumed, but stored as unused_data
+    try:
+        decompressor.decompress(b'\x00')
+    except zlib.error:
+        return False
+    return bool(decompressor.unused_data)
+
+
+class GzipWriter():
+    """write gzipped file. The data is split into blocks which are compressed by background threads (zlib releases the GIL while compressing),
+       and written in order as separate gzip members. gzip, zcat and Python read such a multi-member file as one stream.
+    """
+
+    def __init__(self,filename,threads=1,compresslevel=6,block_size=1024*1024,offset=None):
+        """offset: continue an existing file (e.g. from a Checkpoint) after truncating it to offset, which must be the end of a gzip member (see flush())"""
+
+        self.name = filename
+        self.closed = False
+        if offset is None:
+            self.fileobj = open(filename,'wb')
+        else:
+            self.fileobj = open(filename,'r+b')
+            self.fileobj.truncate(offset)
+            self.fileobj.seek(offset)
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.members = 1 if offset else 0
+
+        # at most two blocks per thread are held in memory
+        self.max_pending = 2*threads
+        self.pending = []
+        self.pool = ThreadPool(threads)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self,*args):
+        self.close()
+
+
+    def write(self,data):
+
+        self.buffer.append(data)
+        self.buffer_bytes += len(data)
+
+        if self.buffer_bytes >= self.block_size:
+            self._compress_block()
+
+
+    def writelines(self,lines):
+        for line in lines:
+            self.write(line)
+
+
+    def flush(self):
+        """compress the buffered data into a gzip member, and write all pending members (so that tell() is the end of a member)"""
+
+        if self.buffer:
+            self._compress_block()
+        for result in self.pending:
+            self.fileobj.write(result.get())
+        self.pending = []
+        self.fileobj.flush()
+
+
+    def tell(self):
+        """position in the compressed file (only the end of the written data after flush())"""
+        return self.fileobj.tell()
+
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        if self.buffer or not self.members:
+            self._compress_block()
+        for result in self.pending:
+            self.fileobj.write(result.get())
+        self.pending = []
+
+        self.pool.close()
+        self.pool.join()
+        self.fileobj.close()
+        self.closed = True
+
+
+    def _compress_block(self):
+
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffer_bytes = 0
+
+        self.pending.append(self.pool.apply_async(_compress_member,(data,self.compresslevel)))
+        self.members += 1
+
+        if len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.pop(0).get())
+
+
+def _compress_member(data,compresslevel):
+    """compress data into a single gzip member"""
+
+    compressor = zlib.compressobj(compresslevel,zlib.DEFLATED,16+zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _sort_run(lines,tempdir=None):
+    """sort one run of lines and write it to a compressed temporary file. returns its name"""
+
+    # with all lines ending in a newline, byte order is the same as C locale order,
+    # unless a line contains control characters that sort before the newline
+    if _low_control_chars.search(b''.join(lines)):
+        lines.sort(key=_c_sort_key)
+    else:
+        lines.sort()
+
+    run = NamedTemporaryFile(prefix='sortrun',suffix='.gz',delete=False,dir=tempdir)
+    run.write(_compress_member(b''.join(lines),1))
+    run.close()
+
+    return run.name
+
+
+_low_control_chars = re.compile(b'[\x00-\x09]')
+
+def _c_sort_key(line):
+    return line[:-1]
+
+
+class ExternalSort():
+    """sort lines in C locale order (like LC_ALL=C sort), without holding them all in memory.
+       Lines are written to the object with write(); when the buffer is full, it is sorted and spilled to a compressed temporary file (a run).
+       Runs are sorted in parallel if processes > 1. finish() merges all runs and returns a temporary file with the sorted lines.
+    """
+
+    def __init__(self,tempdir=None,buffer_size=1024,processes=1):
+        """buffer_size: memory budget in MB for all lines held in memory at the same time (by this process and the workers)."""
+
+        self.tempdir = tempdir
+        self.processes = processes
+        self.run_size = buffer_size*1024*1024 // processes
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.partial = b''
+        self.runs = [] # file names (or, with several processes, pending results of workers)
+        self.pending = []
+        self.pool = None
+
+
+    def write(self,data):
+        """add data to be sorted. data may be a single line or a chunk of several lines."""
+
+        if self.partial:
+            data = self.partial + data
+            self.partial = b''
+
+        if data.count(b'\n') == 1 and data.endswith(b'\n'):
+            lines = [data]
+        else:
+            # only split at b'\n' (splitlines() would also split phrases that contain b'\r' or other line separators)
+            lines = data.split(b'\n')
+            self.partial = lines.pop()
+            lines = [line + b'\n' for line in lines]
+
+        for line in lines:
+            self.buffer.append(line)
+            self.buffer_bytes += len(line) + 40 # approximate overhead of string object
+
+        if self.buffer_bytes >= self.run_size:
+            self._spill()
+
+
+    def writelines(self,lines):
+        for line in lines:
+            self.write(line)
+
+
+    def _spill(self):
+        """sort buffer and write it to a run (in a worker process, if we have more than one)"""
+
+        if self.processes > 1:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes-1)
+            # limit the number of buffers that are held in memory by workers
+            self.pending = [result for result in self.pending if not result.ready()]
+            if len(self.pending) >= self.processes-1:
+                self.pending[0].wait()
+            result = self.pool.apply_async(_sort_run,(self.buffer,self.tempdir))
+            self.pending.append(result)
+            self.runs.append(result)
+        else:
+            self.runs.append(_sort_run(self.buffer,self.tempdir))
+
+        self.buffer = []
+        self.buffer_bytes = 0
+
+
+    def finish(self):
+        """merge all runs and return temporary file with the sorted lines, positioned at the start."""
+
+        if self.partial:
+            self.buffer.append(self.partial + b'\n')
+            self.partial = b''
+
+        outfile = NamedTemporaryFile(prefix='sorted',delete=False,dir=self.tempdir)
+
+        # everything fits into memory
+        if not self.runs:
+            if _low_control_chars.search(b''.join(self.buffer)):
+                self.buffer.sort(key=_c_sort_key)
+            else:
+                self.buffer.sort()
+            outfile.writelines(self.buffer)
+            self.buffer = []
+            _temp_bytes[0] += outfile.tell()
+            outfile.seek(0)
+            return outfile
+
+        if self.buffer:
+            self._spill()
+
+        if self.pool is not None:
+            self.runs = [result.get() for result in self.runs]
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.pending = []
+
+        runs = [GzipReader(filename) for filename in self.runs]
+        outfile.writelines(_merge_sorted(runs))
+        _temp_bytes[0] += outfile.tell()
+        outfile.seek(0)
+
+        for run,filename in zip(runs,self.runs):
+            run.close()
+            _add_temp_bytes(filename)
+            os.remove(filename)
+        self.runs = []
+
+        return outfile
+
+
+def _merge_sorted(iterables):
+    """merge sorted iterables of lines in C locale order"""
+
+    heap = []
+    for pos,iterable in enumerate(iterables):
+        iterator = iter(iterable)
+        for line in iterator:
+            heap.append((_c_sort_key(line),pos,line,iterator))
+            break
+    heapify(heap)
+
+    while heap:
+        key,pos,line,iterator = heap[0]
+        yield line
+        for line in iterator:
+            heapreplace(heap,(_c_sort_key(line),pos,line,iterator))
+            break
+        else:
+            heappop(heap)
+
+
+def sort_file(filename,tempdir=None,buffer_size=1024,processes=1):
+    """Sort a file (in C locale order) and return temporary file"""
+
+    sorter = ExternalSort(tempdir=tempdir,buffer_size=buffer_size,processes=processes)
+    fobj = open(filename,'rb')
+    for line in fobj:
+        sorter.write(line)
+    fobj.close()
+
+    outfile = sorter.finish()
+    sys.stderr.write('Sorted ' + filename + ' > ' + outfile.name + '\n')
+
+    return outfile
+
+
+class PhraseCountIndex():
+    """on-disk counterpart of PhraseCountStore for large tables (e.g. target phrase counts in low memory mode).
+       It is filled in one streaming pass with set(); finish() sorts the values by phrase (with ExternalSort) and makes the index read-only.
+       Only a sorted array of phrase hashes is kept in memory; the values are memory-mapped from a temporary file.
+       Phrases whose hashes collide are detected when building the index, and stored in a dictionary instead.
+       Looking up a phrase that is not indexed returns zeros (or, if it has the same hash as an indexed phrase, the values of that phrase).
+    """
+
+    def __init__(self,number_of_models,tempdir=None,buffer_size=1024,processes=1,pending_size=100000):
+        """buffer_size, processes: options of the ExternalSort of the records.
+           pending_size: number of phrases per model whose values are collected in memory before they are written as records; repeated phrases (e.g. target phrases with many source phrases) only produce one record per model in this window.
+        """
+
+        self.number_of_models = number_of_models
+        self.tempdir = tempdir
+        self.sorter = ExternalSort(tempdir=tempdir,buffer_size=buffer_size,processes=processes)
+        self.pending = [{} for i in range(number_of_models)]
+        self.pending_size = pending_size
+        self.flushes = 0
+        self.hashes = array('l')
+        self.collisions = {}
+        self.values = None
+        self.row_format = struct.Struct('{0}d'.format(number_of_models))
+
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+    def set(self,key,i,value):
+        """add value (before finish(); ignored afterwards). If the same key is set several times for a model, the last value is used"""
+
+        if self.sorter is None:
+            return
+
+        pending = self.pending[i]
+        if len(pending) >= self.pending_size and key not in pending:
+            self._flush()
+            pending = self.pending[i]
+        pending[key] = value
+
+
+    def _flush(self):
+        """write pending values as records. Records are sorted by hash (offset to be non-negative), then key, model and number of the flush (so that later values win)"""
+
+        write = self.sorter.write
+        for i,pending in enumerate(self.pending):
+            for key,value in pending.items():
+                write(b'%016x %s ||| %d %012d %r\n' %(hash(key) + 2**63,key,i,self.flushes,value))
+
+        self.pending = [{} for i in range(self.number_of_models)]
+        self.flushes += 1
+
+
+    def clear(self):
+        """the index is read-only; the per-block clearing of PhraseCountStore does not apply"""
+        pass
+
+
+    def finish(self):
+        """sort records, and build the index"""
+
+        self._flush()
+        sorted_records = self.sorter.finish()
+        self.sorter = None
+
+        values_file = NamedTemporaryFile(prefix='index',delete=False,dir=self.tempdir)
+        values_file.close()
+        fobj = open(values_file.name,'w+b')
+        row = array('d')
+        colliding = []
+        last_hash,last_key = None,None
+
+        def write_row():
+            if colliding:
+                colliding.append((last_key,row.tolist()))
+                self.collisions[last_hash] = dict(colliding)
+            else:
+                self.hashes.append(last_hash)
+                row.tofile(fobj)
+
+        for record in sorted_records:
+            hash_hex,record = record.split(b' ',1)
+            key,record = record.rsplit(b' ||| ',1)
+            i,flush,value = record.split()
+            phrase_hash = int(hash_hex,16) - 2**63
+
+            if key != last_key or phrase_hash != last_hash:
+                if last_key is not None:
+                    if phrase_hash == last_hash:
+                        # collision: all phrases with this hash are stored in a dictionary
+                        colliding.append((last_key,row.tolist()))
+                    else:
+                        write_row()
+                        del colliding[:]
+                last_hash,last_key = phrase_hash,key
+                row = array('d',[0])*self.number_of_models
+
+            row[int(i)] = float(value)
+
+        if last_key is not None:
+            write_row()
+
+        sorted_records.close()
+        os.remove(sorted_records.name)
+
+        fobj.flush()
+        _temp_bytes[0] += fobj.tell()
+        if self.hashes:
+            # the memory map stays valid after the file is removed (and is shared by forked worker processes)
+            self.values = mmap.mmap(fobj.fileno(),0,access=mmap.ACCESS_READ)
+        fobj.close()
+        os.remove(values_file.name)
+
+        sys.stderr.write('Indexed {0} phrases ({1} hash collisions)\n'.format(len(self.hashes),len(self.collisions)))
+
+
+    def __contains__(self,key):
+        phrase_hash = hash(key)
+        if phrase_hash in self.collisions:
+            return key in self.collisions[phrase_hash]
+        pos = bisect_left(self.hashes,phrase_hash)
+        return pos < len(self.hashes) and self.hashes[pos] == phrase_hash
+
+
+    def __getitem__(self,key):
+        """values of key as a (new) list, with one value per model"""
+
+        phrase_hash = hash(key)
+
+        if phrase_hash in self.collisions:
+            return list(self.collisions[phrase_hash].get(key,[0]*self.number_of_models))
+
+        pos = bisect_left(self.hashes,phrase_hash)
+        if pos < len(self.hashes) and self.hashes[pos] == phrase_hash:
+            return list(self.row_format.unpack_from(self.values,pos*self.row_format.size))
+
+        return [0]*self.number_of_models
+
+
+    def matrix(self,keys):
+        """NumPy array with the values of a list of keys, with shape (keys,models). zeros for unknown keys"""
+
+        m = self.number_of_models
+        result = numpy.zeros((len(keys),m))
+
+        if self.hashes and keys:
+            hashes = numpy.frombuffer(self.hashes,dtype=numpy.dtype(self.hashes.typecode))
+            key_hashes = numpy.array([hash(key) for key in keys],dtype=hashes.dtype)
+            rows = numpy.minimum(numpy.searchsorted(hashes,key_hashes),len(hashes)-1)
+            known = hashes[rows] == key_hashes
+            result[known] = numpy.frombuffer(self.values,dtype=numpy.float64).reshape(-1,m)[rows[known]]
+
+        if self.collisions:
+            for j,key in enumerate(keys):
+                phrase_hash = hash(key)
+                if phrase_hash in self.collisions:
+                    result[j] = self.collisions[phrase_hash].get(key,0)
+
+        return result
+
+
+def _phrase_key(line):
+    """sort key of a raw phrase table line (Moses tables are sorted on source phrase + ' |||')"""
+
+    return line.split(b' ||| ',1)[0] + b' |'
+
+
+def _seekable_table(fobj):
+    """return path of fobj if it is an uncompressed file on disk (which we can split by byte offsets),
+       or a gzipped file with an up-to-date index (which we can split by source phrase keys; see TableIndex), otherwise None
+    """
+
+    filename = getattr(fobj,'name',None)
+    if not hasattr(filename,'endswith') or not os.path.isfile(filename):
+        return None
+    if filename.endswith('.gz') and TableIndex.load(filename) is None:
+        return None
+    return filename
+
+
+def _find_key_offset(fobj,size,key):
+    """binary search for the byte offset of the first line in sorted file whose key is >= key"""
+
+    def line_start(pos):
+        # offset of first line that starts at or after pos
+        if pos == 0:
+            return 0
+        fobj.seek(pos-1)
+        fobj.readline()
+        return fobj.tell()
+
+    lo, hi = 0, size
+    while lo < hi:
+        mid = (lo+hi)//2
+        start = line_start(mid)
+        fobj.seek(start)
+        line = fobj.readline()
+        if not line or _phrase_key(line) >= key:
+            hi = mid
+        else:
+            lo = mid+1
+
+    return line_start(lo)
+
+
+def split_tables(filenames,shards,start=None):
+    """split a set of sorted tables into (at most) the given number of shards with disjoint source phrase ranges.
+       start: only split the lines from this source phrase key on (e.g. when continuing from a Checkpoint).
+       returns the boundary keys between the shards, and one list of (start,end) byte offsets per shard, with one pair of offsets per table.
+    """
+
+    keys = _split_keys(filenames,shards)
+    if start is not None:
+        keys = [start] + [key for key in keys if key > start]
+    offsets = _key_offsets(filenames,keys)
+
+    shards = [[(table_offsets[j],table_offsets[j+1]) for table_offsets in offsets] for j in range(len(keys)+1)]
+    if start is not None:
+        return keys[1:],shards[1:]
+
+    return keys,shards
+
+
+def _split_keys(filenames,shards):
+    """boundary keys that split a set of sorted tables into (at most) the given number of source phrase ranges.
+       keys are taken from evenly spaced positions in the biggest table (or from the index of a gzipped table).
+    """
+
+    sizes = [os.path.getsize(filename) for filename in filenames]
+
+    biggest = sizes.index(max(sizes))
+    if filenames[biggest].endswith('.gz'):
+        return TableIndex.load(filenames[biggest]).split_keys(shards)
+
+    fobj = open(filenames[biggest],'rb')
+    keys = []
+    for k in range(1,shards):
+        fobj.seek(sizes[biggest]*k//shards)
+        fobj.readline()
+        line = fobj.readline()
+        if line:
+            key = _phrase_key(line)
+            if not keys or key > keys[-1]:
+                keys.append(key)
+    fobj.close()
+
+    return keys
+
+
+def _key_offsets(filenames,keys):
+    """for each table, the byte offsets of the ranges delimited by the boundary keys (including 0 and the size of the table).
+       gzipped tables can't be split by byte offsets; their ranges are delimited by the keys themselves (None for the start and end of the table).
+    """
+
+    offsets = []
+    for filename in filenames:
+        if filename.endswith('.gz'):
+            offsets.append([None] + keys + [None])
+            continue
+        size = os.path.getsize(filename)
+        fobj = open(filename,'rb')
+        offsets.append([0] + [_find_key_offset(fobj,size,key) for key in keys] + [size])
+        fobj.close()
+
+    return offsets
+
+
+def _parse_line(line):
+    """split a phrase table line into its fields"""
+
+    line = line.rstrip().split(b' ||| ')
+    if line[-1].endswith(b' |||'):
+        line[-1] = line[-1][:-4]
+        line.append(b'')
+    return line
+
+
+def merge_tables(models):
+    """k-way merge of sorted tables (with a heap of one cursor per table).
+       models is a list of (iterable,priority,i), as returned by priority_sort_models.
+       yields one block per source phrase: a list of (lines,priority,i) for all models that contain the source phrase,
+       in the order of models (so that the model priorities are respected when loading the block).
+    """
+
+    iterators = [iter(model) for (model,priority,i) in models]
+    current = [None]*len(models) # first line of the next block of each model
+    heap = []
+
+    for pos,iterator in enumerate(iterators):
+        for line in iterator:
+            line = _parse_line(line)
+            current[pos] = line
+            heap.append((line[0] + b' |',pos))
+            break
+    heapify(heap)
+
+    while heap:
+
+        key = heap[0][0]
+        positions = []
+        block = []
+
+        # entries with the same key are popped in order of position
+        while heap and heap[0][0] == key:
+            positions.append(heappop(heap)[1])
+
+        for pos in positions:
+            first = current[pos]
+            src = first[0]
+            lines = [first]
+            current[pos] = None
+
+            for line in iterators[pos]:
+                line = _parse_line(line)
+                if line[0] != src:
+                    current[pos] = line
+                    heappush(heap,(line[0] + b' |',pos))
+                    break
+                lines.append(line)
+
+            block.append((lines,models[pos][1],models[pos][2]))
+
+        yield block
+
+
+def read_range(filename,start,end):
+    """iterate over the lines of a file between two byte offsets (which must be line boundaries).
+       for gzipped tables, start and end are source phrase keys (see _key_offsets), and reading starts at the closest preceding position in the index of the table.
+    """
+
+    if filename.endswith('.gz'):
+        return TableIndex.load(filename).lines(start,end)
+    return _read_byte_range(filename,start,end)
+
+
+def _read_from(filename,key,offset):
+    """iterate over the lines of a sorted table from a source phrase key to the end of the table.
+       offset is the byte offset of the key in uncompressed tables (see _key_offsets); gzipped tables are read from the key.
+    """
+
+    if filename.endswith('.gz'):
+        return read_range(filename,key,None)
+    return read_range(filename,offset,os.path.getsize(filename))
+
+
+def _read_byte_range(filename,start,end):
+
+    fobj = open(filename,'rb')
+    fobj.seek(start)
+    pos = start
+    for line in fobj:
+        if pos >= end:
+            break
+        pos += len(line)
+        yield line
+    fobj.close()
+
+
+def _gzip_blocks(fobj,block_size=256*1024):
+    """decompress a gzip file (with one or more members) from the current position of fobj, which must be the start of a member.
+       yields (offset,data): blocks of decompressed data, and the byte offset in the file of the gzip member that they belong to.
+    """
+
+    member = fobj.tell()
+    data = fobj.read(block_size)
+    position = member + len(data)
+    decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+    while data:
+        block = decompressor.decompress(data)
+        if block:
+            yield member,block
+
+        # start of the next gzip member (ignoring zero padding at the end of the file)
+        data = decompressor.unused_data
+        if data and data.strip(b'\x00'):
+            member = position - len(data)
+            decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+        else:
+            data = fobj.read(block_size)
+            position += len(data)
+
+    if not _stream_ended(decompressor):
+        raise IOError('Compressed file ended before the end-of-stream marker was reached: ' + fobj.name)
+
+
+class TableIndex():
+    """sidecar index of a sorted (plain or gzipped) table, stored in filename + '.index': the key (see _phrase_key) and position of every Nth source phrase.
+       a position is a pair (offset,skip): reading starts at byte offset in the file, and skips the first skip bytes of (decompressed) data.
+       for plain tables, the offset is that of the line itself. Gzip streams can only be decompressed from the start of a member,
+       so the offset is that of the member which contains the line. Seeking is efficient in tables with many small members,
+       such as those written by GzipWriter (gzip itself writes a single member; see recompress_table).
+
+       The index is used to read only the parts of a table that contain given source phrases (e.g. those of a reference set; see Moses.filtered_phrase_table),
+       and to split gzipped tables into source phrase ranges for parallel combination (see split_tables).
+    """
+
+    version = 1
+
+    def __init__(self,filename,keys,positions):
+
+        self.filename = filename
+        self.keys = keys
+        self.positions = positions
+
+
+    @classmethod
+    def build(cls,filename,interval=1000):
+        """read a table once, and write its index with the position of every interval-th source phrase"""
+
+        compressed = filename.endswith('.gz')
+        keys = []
+        positions = []
+
+        fobj = open(filename,'rb')
+        if compressed:
+            blocks = _gzip_blocks(fobj)
+        else:
+            blocks = ((0,block) for block in iter(lambda: fobj.read(1024*1024),b''))
+
+        member = member_start = None # current gzip member, and uncompressed offset at which it starts
+        line_member = line_member_start = None # member in which the current line starts
+        position = 0 # uncompressed offset of the current line
+        partial = b''
+        last_key = None
+        n = 0
+
+        def add(line):
+            key = _phrase_key(line)
+            if key != last_key:
+                if not n % interval:
+                    keys.append(key)
+                    positions.append((line_member,position-line_member_start) if compressed else (position,0))
+                return key,n+1
+            return key,n
+
+        for offset,block in blocks:
+            if offset != member:
+                member,member_start = offset,position+len(partial)
+            if not partial:
+                line_member,line_member_start = member,member_start
+
+            lines = (partial + block).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                last_key,n = add(line)
+                position += len(line) + 1
+                line_member,line_member_start = member,member_start
+
+        if partial:
+            add(partial)
+        fobj.close()
+
+        status = os.stat(filename)
+        header = {'version':cls.version,'size':status.st_size,'mtime':status.st_mtime,'interval':interval}
+        index_file = open(filename + '.index','wb')
+        index_file.write(json.dumps(header).encode('ascii') + b'\n')
+        for key,(offset,skip) in zip(keys,positions):
+            index_file.write('{0} {1} '.format(offset,skip).encode('ascii') + key + b'\n')
+        index_file.close()
+
+        return cls(filename,keys,positions)
+
+
+    @classmethod
+    def load(cls,filename):
+        """load the index of a table, or return None if there is none, or if the table has changed since the index was built"""
+
+        index_filename = filename + '.index'
+        if not os.path.exists(index_filename):
+            return None
+
+        index_file = open(index_filename,'rb')
+        header = json.loads(index_file.readline().decode('ascii'))
+        status = os.stat(filename)
+        if header.get('version') != cls.version or header['size'] != status.st_size or header['mtime'] != status.st_mtime:
+            sys.stderr.write('Warning: index of ' + filename + ' is out of date. Ignoring it (rebuild it with the action index_tables)\n')
+            index_file.close()
+            return None
+
+        keys = []
+        positions = []
+        for line in index_file:
+            offset,skip,key = line[:-1].split(b' ',2)
+            keys.append(key)
+            positions.append((int(offset),int(skip)))
+        index_file.close()
+
+        return cls(filename,keys,positions)
+
+
+    def _read(self,i):
+        """iterate over the lines of the table, starting at the i-th position of the index"""
+
+        offset,skip = self.positions[i]
+        fobj = open(self.filename,'rb')
+        try:
+            fobj.seek(offset)
+            if not self.filename.endswith('.gz'):
+                for line in fobj:
+                    yield line
+                return
+
+            partial = b''
+            for member,block in _gzip_blocks(fobj):
+                if skip:
+                    if len(block) <= skip:
+                        skip -= len(block)
+                        continue
+                    block = block[skip:]
+                    skip = 0
+                lines = (partial + block).split(b'\n')
+                partial = lines.pop()
+                for line in lines:
+                    yield line + b'\n'
+            if partial:
+                yield partial
+        finally:
+            fobj.close()
+
+
+    def lines(self,start=None,end=None):
+        """iterate over the lines of the table with start <= key < end (None: no limit)"""
+
+        i = max(bisect_right(self.keys,start)-1,0) if start is not None else 0
+        for line in self._read(i):
+            if start is not None:
+                if _phrase_key(line) < start:
+                    continue
+                start = None
+            if end is not None and _phrase_key(line) >= end:
+                break
+            yield line
+
+
+    def lookup(self,sources):
+        """iterate over the lines of all source phrases in sources, in the order of the table.
+           only the intervals of the index that contain them are read; reading continues (instead of seeking) within a gzip member.
+        """
+
+        reader = None
+        line = None # next line of reader that has not been consumed
+
+        for key in sorted(src + b' |' for src in sources):
+            i = bisect_right(self.keys,key) - 1
+            if i < 0:
+                continue
+
+            if reader is None:
+                seek = True
+            elif line is None:
+                break
+            else:
+                j = bisect_right(self.keys,_phrase_key(line)) - 1
+                seek = i > j and self.positions[i][0] != self.positions[j][0]
+
+            if seek:
+                if reader is not None:
+                    reader.close()
+                reader = self._read(i)
+                line = next(reader,None)
+
+            while line is not None and _phrase_key(line) < key:
+                line = next(reader,None)
+            while line is not None and _phrase_key(line) == key:
+                yield line
+                line = next(reader,None)
+
+        if reader is not None:
+            reader.close()
+
+
+    def split_keys(self,shards):
+        """boundary keys that split the table into (at most) the given number of source phrase ranges, taken from evenly spaced positions of the index"""
+
+        keys = []
+        for k in range(1,shards):
+            key = self.keys[len(self.keys)*k//shards]
+            if key != self.keys[0] and (not keys or key > keys[-1]):
+                keys.append(key)
+        return keys
+
+
+def recompress_table(filename,threads=1):
+    """rewrite a gzipped table (with the same content) as a file with many small gzip members (see GzipWriter), so that it can be read from positions of its index"""
+
+    sys.stderr.write('Recompressing ' + filename + ' into seekable blocks...')
+    tmp_filename = filename + '.tmp.gz'
+    reader = GzipReader(filename)
+    writer = GzipWriter(tmp_filename,threads)
+    for line in reader:
+        writer.write(line)
+    reader.close()
+    writer.close()
+    os.rename(tmp_filename,filename)
+    sys.stderr.write('done\n')
+
+
+# number of bytes written to temporary files (sorted runs, inverted tables, indexes, partial tables ...) by this process; see PhaseStats
+_temp_bytes = [0]
+
+def _add_temp_bytes(filename):
+    """count the size of a temporary file that has been written (by this process or a worker process)"""
+    try:
+        _temp_bytes[0] += os.path.getsize(filename)
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    """peak resident set size (in bytes) of this process or any of its finished worker processes, or None if it is unknown"""
+
+    if resource is None:
+        return None
+
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # kilobytes on Linux, bytes on Mac OS X
+    if sys.platform != 'darwin':
+        peak *= 1024
+
+    return peak
+
+
+def _current_rss():
+    """current resident set size (in bytes) of this process, or its peak resident set size if the current one is unknown (see _peak_rss)"""
+
+    try:
+        fobj = open('/proc/self/statm')
+        pages = int(fobj.read().split()[1])
+        fobj.close()
+        return pages * os.sysconf(str('SC_PAGE_SIZE'))
+    except (IOError,OSError,ValueError,IndexError,AttributeError):
+        return _peak_rss()
+
+
+def _near_memory_limit(flags):
+    """True if a memory limit is set (flags['memory_limit'], in MB), and this process uses more than 80% of it"""
+
+    if not flags or not flags.get('memory_limit'):
+        return False
+
+    rss = _current_rss()
+    return rss is not None and rss > 0.8 * flags['memory_limit'] * 1024 * 1024
+
+
+def _cpu_time():
+    """user and system time (in seconds) of this process and its finished worker processes"""
+    return sum(os.times()[:4])
+
+
+class PhaseStats():
+    """time and memory instrumentation of the phases of a task (loading, inversion, sorting, traversal, scoring, writing, optimization ...)
+       Each phase produces a record (a dictionary) with the fields:
+         phase: name of the phase
+         wall, cpu: elapsed wall-clock and CPU time in seconds (CPU time includes worker processes that have finished during the phase)
+         lines, pairs: number of lines read/written and phrase pairs processed (if counted), and lines_per_second, pairs_per_second
+         peak_rss: peak resident set size in bytes (since the start of the process; None if unknown)
+         temp_bytes: bytes written to temporary files during the phase
+         time: time (seconds since the epoch) at which the phase ended (or, for optimizer iterations, the iteration ended)
+       and possibly further fields that are specific to the phase.
+       Records are appended as JSON lines to a file, and/or passed to a callback function.
+       Only the process that created the object emits records. Worker processes that combine shards of a table (see _combine_shard) collect their records instead,
+       and the parent process emits one record per phase with the sums of wall, cpu, temp_bytes, lines and pairs over all shards (see merge).
+    """
+
+    # fields that are added up when the records of several shards are merged
+    summed = ['wall','cpu','temp_bytes','lines','pairs']
+
+    def __init__(self,filename=None,callback=None):
+        self.filename = filename
+        self.callback = callback
+        self.pid = os.getpid()
+        self.collected = None
+
+
+    def phase(self,name,**fields):
+        """return a Phase that measures everything between start() and stop(), and is emitted when used as a context manager"""
+        return Phase(self,name,**fields)
+
+
+    def emit(self,record):
+        """complete record (throughput, peak memory, end time), and write it to the file and/or pass it to the callback"""
+
+        if self.filename is None and self.callback is None:
+            return
+
+        if self.collected is not None:
+            self.collected.append(dict(record))
+            return
+
+        if os.getpid() != self.pid:
+            return
+
+        record = dict(record)
+        for counter in ['lines','pairs']:
+            if counter in record:
+                record[counter + '_per_second'] = record[counter] / record['wall'] if record['wall'] else None
+        record['peak_rss'] = _peak_rss()
+        record.setdefault('time',time.time())
+
+        if self.filename is not None:
+            fobj = open(self.filename,'a')
+            fobj.write(json.dumps(record,sort_keys=True) + '\n')
+            fobj.close()
+
+        if self.callback is not None:
+            self.callback(record)
+
+
+    def start_collecting(self):
+        """keep the records of all following phases (e.g. in a worker process) instead of emitting them, until stop_collecting() returns them"""
+        self.collected = []
+
+
+    def stop_collecting(self):
+        records = self.collected
+        self.collected = None
+        return records
+
+
+    def merge(self,records):
+        """emit one record for each phase (and other fields, e.g. table) in records, with the sums of the summed fields"""
+
+        merged = {}
+        keys = []
+        for record in records:
+            key = tuple(sorted((field,value) for (field,value) in record.items() if field not in self.summed))
+            if key not in merged:
+                merged[key] = dict(record)
+                keys.append(key)
+                continue
+            for field in self.summed:
+                if field in record:
+                    merged[key][field] = merged[key].get(field,0) + record[field]
+
+        for key in keys:
+            self.emit(merged[key])
+
+
+class Phase(dict):
+    """record of one phase (see PhaseStats). Time and temporary disk usage are accumulated over all start()/stop() intervals,
+       so that interleaved phases (e.g. traversal, scoring and writing of the blocks of a table) can be measured separately.
+    """
+
+    def __init__(self,stats,name,**fields):
+        dict.__init__(self,fields)
+        self.stats = stats
+        self['phase'] = name
+        self['wall'] = 0
+        self['cpu'] = 0
+        self['temp_bytes'] = 0
+        self.started = None
+
+
+    def start(self):
+        self.started = (time.time(),_cpu_time(),_temp_bytes[0])
+
+
+    def stop(self):
+        wall,cpu,temp_bytes = self.started
+        self['wall'] += time.time() - wall
+        self['cpu'] += _cpu_time() - cpu
+        self['temp_bytes'] += _temp_bytes[0] - temp_bytes
+        self.started = None
+
+
+    def count(self,lines=0,pairs=0):
+        """increase the number of processed lines and/or phrase pairs"""
+        if lines:
+            self['lines'] = self.get('lines',0) + lines
+        if pairs:
+            self['pairs'] = self.get('pairs',0) + pairs
+
+
+    def emit(self):
+        self.stats.emit(self)
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.stop()
+        if exc_type is None:
+            self.emit()
+
+
+def _reopen_output(filename,offset,threads=1):
+    """open an output file that is continued from a Checkpoint: it is truncated to offset, and writing continues there"""
+
+    if filename.endswith('.gz'):
+        return GzipWriter(filename,threads,offset=offset)
+
+    fileobj = open(filename,'r+b')
+    fileobj.truncate(offset)
+    fileobj.seek(offset)
+    return fileobj
+
+
+class Checkpoint():
+    """progress of a long combination (see option checkpoint_interval), which is saved periodically to a JSON file, so that a restarted combination can continue where the last one stopped.
+       The file has a record for each stage of the combination ('phrase-table'; or 'half1', 'inverse' and 'half2' with lowmem_strategy 'invert', see Combine_TMs._inverse_wrapper).
+       A stage in progress records the key after the last completed source phrase (see _phrase_key), the corresponding byte offsets in the input tables (None for gzipped tables, which are read from the key),
+       and the name and byte offset of each output. A completed stage records the files that it has written.
+       The temporary files of all stages are removed with the checkpoint, and the checkpoint is ignored if the configuration or the input tables have changed.
+    """
+
+    version = 1
+
+    def __init__(self,filename,config,interval):
+        """config: everything that the output depends on (including the size and modification time of the input tables).
+           interval: minimal time (in seconds) between two saves.
+        """
+
+        self.filename = filename
+        self.config = config
+        self.interval = interval
+        self.stages = {}
+        self.temp_files = []
+        self.last_save = time.time()
+
+        if not os.path.exists(filename):
+            return
+
+        try:
+            fobj = open(filename)
+            state = json.load(fobj)
+            fobj.close()
+        except ValueError:
+            sys.stderr.write('Warning: checkpoint {0} is corrupt. Starting over...\n'.format(filename))
+            return
+
+        self.temp_files = state.get('temp_files',[])
+        if state.get('version') != self.version or state['config'] != config:
+            sys.stderr.write('Configuration or input tables have changed since checkpoint {0}. Starting over...\n'.format(filename))
+            self.remove()
+            return
+
+        self.stages = state['stages']
+        sys.stderr.write('Continuing from checkpoint {0}\n'.format(filename))
+
+
+    def due(self):
+        """True if the last save is at least interval seconds ago"""
+        return time.time() - self.last_save >= self.interval
+
+
+    def resume(self,stage):
+        """position from which a stage in progress continues: (key,input offsets,outputs), with a (name,offset) pair per output; or None"""
+
+        record = self.stages.get(stage)
+        if record is None or record.get('files') is not None:
+            return None
+
+        for name,offset in record['outputs']:
+            if not os.path.exists(name) or os.path.getsize(name) < offset:
+                sys.stderr.write('Warning: output {0} has been truncated since the checkpoint. Starting over...\n'.format(name))
+                del self.stages[stage]
+                return None
+
+        return record['key'].encode('latin-1'),record['inputs'],record['outputs']
+
+
+    def save(self,stage,key,filenames,output_objects):
+        """record that all source phrases with a key < key have been combined (from the tables filenames into output_objects)"""
+
+        for output_object in output_objects:
+            output_object.flush()
+
+        self.stages[stage] = {'key':key.decode('latin-1'),
+                              'inputs':[table_offsets[1] for table_offsets in _key_offsets(filenames,[key])],
+                              'outputs':[(output_object.name,output_object.tell()) for output_object in output_objects]}
+        self._write()
+
+
+    def complete(self,stage,files):
+        """record that a stage is complete, and the files that it has written"""
+
+        self.stages[stage] = {'files':files}
+        self._write()
+
+
+    def completed(self,stage):
+        """files of a completed stage, or None if the stage is not complete (or its files no longer exist)"""
+
+        record = self.stages.get(stage)
+        if record is None or record.get('files') is None or not all(os.path.exists(name) for name in record['files']):
+            return None
+        return record['files']
+
+
+    def add_temp_file(self,name):
+        """register a temporary file that is removed with the checkpoint"""
+        self.temp_files.append(name)
+
+
+    def _write(self):
+
+        fobj = open(self.filename + '.tmp','w')
+        json.dump({'version':self.version,'config':self.config,'stages':self.stages,'temp_files':self.temp_files},fobj)
+        fobj.close()
+        os.rename(self.filename + '.tmp',self.filename)
+        self.last_save = time.time()
+
 
+    def remove(self):
+        """remove the checkpoint and the remaining temporary files (when the combination has finished, or the checkpoint is obsolete)"""
 
-def handle_file(filename,action,fileobj=None,mode='r'):
-    """support reading/writing either from/to file, stdout or gzipped file"""
+        for name in self.temp_files:
+            if os.path.exists(name):
+                os.remove(name)
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
 
-    if action == 'open':
+        self.stages = {}
+        self.temp_files = []
 
-        if mode == 'r':
-            mode = 'rb'
-        elif mode == 'w':
-            mode = 'wb'
 
-        if mode == 'rb' and not filename == '-' and not os.path.exists(filename):
-            if os.path.exists(filename+'.gz'):
-                filename = filename+'.gz'
-            else:
-                sys.stderr.write('Error: unable to open file. ' + filename + ' - aborting.\n')
-                
-                if 'counts' in filename and os.path.exists(os.path.dirname(filename)):
-                    sys.stderr.write('For a weighted counts combination, we need statistics that Moses doesn\'t write to disk by default.\n')
-                    sys.stderr.write('Repeat step 4 of Moses training for all models with the option -write-lexical-counts.\n')
-                
-                exit(1)
+def _range_checksums(filename,offsets,chunk_size=1024*1024):
+    """MD5 checksums (hex) of the consecutive byte ranges of a file that are delimited by offsets. The file is read once."""
 
-        if filename.endswith('.gz'):
-            fileobj = gzip.open(filename,mode)
-            
-        elif filename == '-' and mode == 'wb':
-            fileobj = sys.stdout
-                    
-        else:
-                fileobj = open(filename,mode)
-        
-        return fileobj
-    
-    elif action == 'close' and filename != '-':
-        fileobj.close()   
+    checksums = []
+    fobj = open(filename,'rb')
+    for start,end in zip(offsets,offsets[1:]):
+        checksum = hashlib.md5()
+        remaining = end - start
+        while remaining:
+            data = fobj.read(min(chunk_size,remaining))
+            if not data:
+                break
+            checksum.update(data)
+            remaining -= len(data)
+        checksums.append(checksum.hexdigest())
+    fobj.close()
 
+    return checksums
 
-def sort_file(filename,tempdir=None):
-    """Sort a file and return temporary file"""
 
-    cmd = ['sort', filename]
-    env = {}
-    env['LC_ALL'] = 'C'
-    if tempdir:
-        cmd.extend(['-T',tempdir])
-    
-    outfile = NamedTemporaryFile(delete=False,dir=tempdir)
-    sys.stderr.write('LC_ALL=C ' + ' '.join(cmd) + ' > ' + outfile.name + '\n')
-    p = Popen(cmd,env=env,stdout=outfile.file)
-    p.wait()
-    
-    outfile.seek(0)
+def _copy_range(fobj,start,end,output_object,chunk_size=1024*1024):
+    """copy the bytes between two offsets of fobj to output_object, without parsing them"""
+
+    fobj.seek(start)
+    remaining = end - start
+    while remaining:
+        data = fobj.read(min(chunk_size,remaining))
+        if not data:
+            raise IOError('unexpected end of file: {0}'.format(fobj.name))
+        output_object.write(data)
+        remaining -= len(data)
+
+
+def _fork_pool(processes):
+    """multiprocessing.Pool with forked worker processes, which inherit the state of the parent process (e.g. _shard_state and all loaded data),
+       independently of the default start method of the platform ('spawn' on Windows and macOS, 'forkserver' on Linux from Python 3.14).
+       returns None if processes can't be forked; the caller then does all the work in the parent process.
+    """
+
+    if hasattr(multiprocessing,'get_context'):
+        try:
+            return multiprocessing.get_context('fork').Pool(processes)
+        except ValueError:
+            return None
+
+    # Python 2 forks worker processes on all platforms except Windows
+    if sys.platform == 'win32':
+        return None
+    return multiprocessing.Pool(processes)
+
+
+# state of the parent process, inherited by forked worker processes (see Combine_TMs._write_parallel)
+_shard_state = {}
+
+def _combine_shard(shard):
+    """worker function: combine one shard (a source phrase range) and write it to temporary files (one per output; see Combine_TMs._write_parallel).
+       returns the names of the temporary files, and the records of the phases of the combination (see PhaseStats.merge).
+    """
+
+    combiner = _shard_state['combiner']
+    models = [(read_range(filename,start,end),priority,i) for ((filename,priority,i),(start,end)) in zip(_shard_state['tables'],shard)]
+
+    output_objects = [NamedTemporaryFile(prefix='shard',delete=False,dir=combiner.flags['tempdir']) for k in range(_shard_state['outputs'])]
+    combiner.stats.start_collecting()
+    try:
+        _shard_state['process'](models,*output_objects)
+    except SystemExit:
+        # don't let sys.exit() kill the worker silently; the parent should know
+        raise RuntimeError('combination of shard failed (see error message above)')
+    records = combiner.stats.stop_collecting()
+    for output_object in output_objects:
+        output_object.close()
+
+    return [output_object.name for output_object in output_objects],records
 
-    return outfile
-        
 
 class Combine_TMs():
     
@@ -1333,6 +4469,22 @@ class Combine_TMs():
             'add_origin_features':False,
             'write_phrase_penalty':False,
             'lowmem': False,
+            'lowmem_strategy': 'index',
+            'tempdir': None,
+            'processes': 1,
+            'sort_buffer_size': 1024,
+            'block_size': 1000,
+            'cache_dir': None,
+            'stats_file': None,
+            'stats_callback': None,
+            'incremental': False,
+            'incremental_block_size': 16,
+            'index_interval': 1000,
+            'index_recompress': False,
+            'table_limit': 0,
+            'memory_limit': None,
+            'checkpoint_interval': 0,
+            'table_limit_feature': None,
             'i_e2f':0,
             'i_e2f_lex':1,
             'i_f2e':2,
@@ -1386,7 +4538,10 @@ class Combine_TMs():
            i_e2f,i_e2f_lex,i_f2e,i_f2e_lex: Index of the (Moses) phrase table features p(s|t), lex(s|t), p(t|s) and lex(t|s). 
                 Relevant for mode 'counts', and if 'recompute_lexweights' is True in mode 'interpolate'. In mode 'counts', any additional features are combined through linear interpolation.
            
-           model_interface: class that handles reading phrase tables and lexical tables, and writing phrase tables. Currently only Moses is implemented.
+           model_interface: class that handles reading phrase tables and lexical tables, and writing phrase tables.
+                Moses: text tables in the canonical Moses model structure
+                Moses_Binary: like Moses, but the data relevant for a reference set is looked up in binary phrase tables (model/phrase-table.binphr.*) instead of read from the text tables.
+                              Requires moses.dictree (contrib/python).
                  default: Moses
            
            reference_interace: class that deals with reading in reference phrase pairs for cross-entropy computation
@@ -1396,6 +4551,8 @@ class Combine_TMs():
                 default: Moses_Alignment
            
            reference_file: path to reference file. Required for every operation except combination of models with given weights.
+                A list of paths loads several reference sets (e.g. the tuning sets of different domains; see MultiReference), and the model data that is relevant for any of them, in a single pass.
+                compute_cross_entropies and return_best_cross_entropies then return the results of each reference set; all other methods use the union of the reference sets.
            
            lang_src: source language. Only required if reference_interface is TigerXML. Identifies which language in XML file we should treat as source language.
            
@@ -1408,9 +4565,82 @@ class Combine_TMs():
            add_origin_features: For each model that is being combined, add a binary feature to the final phrase table, with values of 1 (phrase pair doesn't occur in model) and 2.718 (it does).
                                 This indicates which model(s) a phrase pair comes from and can be used during MERT to additionally reward/penalize translation models
 
-           lowmem: low memory mode: instead of loading target phrase counts / probability (when required), process the original table and its inversion (source and target swapped) incrementally, then merge the two halves.
-
-           tempdir: temporary directory (for low memory mode).
+           lowmem: low memory mode: don't load target phrase counts / probability (when required) into memory. See lowmem_strategy.
+
+           lowmem_strategy: how target phrase counts are obtained in low memory mode:
+                'index': build an on-disk index of target phrase counts in one pass over the tables (see PhraseCountIndex), then combine the tables in a single pass.
+                'invert': process the original table and its inversion (source and target swapped) incrementally, then merge the two halves.
+                default: 'index'
+
+           memory_limit: memory budget (in MB) for a combination that is not in low memory mode. The resident memory of the process is monitored while the target phrase counts are loaded;
+                when it exceeds 80% of the budget, the counts loaded so far are moved to an on-disk index (as with lowmem_strategy 'index'), which collects the remaining ones.
+                Close to the budget, the blocks of source phrases that are scored together (see block_size) are also made smaller.
+                The combination thus runs in memory if it fits, and otherwise continues in low memory mode without starting over. The output is the same in either case.
+                Lexical tables are always kept in memory (but count towards the budget).
+                default: None (no limit)
+
+           checkpoint_interval: if > 0, the progress of a phrase table combination with combine_given_weights is saved in a checkpoint (output_file + '.checkpoint'; see Checkpoint) at most every checkpoint_interval seconds:
+                the key after the last completed source phrase, the corresponding positions in the input tables and the output, and the temporary files of completed stages of the two-pass combination with lowmem_strategy 'invert'.
+                If the combination is interrupted (e.g. because the disk is full), a restarted combination with the same configuration and input tables continues from the checkpoint.
+                Requires uncompressed or indexed input tables (see index_interval) and an output file (not stdout). The second table half of the two-pass combination is always combined completely.
+                default: 0 (no checkpoints)
+
+           tempdir: temporary directory (for low memory mode and for the partial tables written by parallel processes).
+
+           sort_buffer_size: memory (in MB) used for sorting in low memory mode (inverted tables, or the records of the target phrase index). Larger inputs are sorted in runs that are written to compressed temporary files and merged.
+                      default: 1024
+
+           processes: number of worker processes for phrase table and reordering table combination. The (sorted) input tables are split into source phrase ranges,
+                      which are combined in parallel and concatenated. Output is identical to that of a single process.
+                      Requires uncompressed input tables, or gzipped tables with an index (see index_interval); other gzipped tables are processed by a single process.
+                      Also used for sorting in low memory mode, to optimize the weights of different features concurrently,
+                      and as the number of threads that compress gzipped output.
+                      default: 1
+
+           cache_dir: directory for a persistent cache of the data that is loaded for a reference set (filtered phrase tables and lexical tables).
+                      The cache is specific to the models (paths and modification times of their files), the reference file and the mode,
+                      and is re-used by later tuning or cross-entropy computations with the same configuration.
+                      default: None (no cache)
+
+           block_size: number of source phrases whose phrase pairs are scored together during combination (of phrase tables and reordering tables).
+                       If NumPy is available, the scores of a block are computed with vectorized operations; without NumPy, each phrase pair is scored separately.
+                       default: 1000
+
+           stats_file: if defined, time and memory statistics of each phase of a task (loading, inversion, sorting, traversal, scoring, writing, optimizer iterations) are appended to this file as JSON lines. See PhaseStats for the fields of a record.
+                       default: None
+
+           stats_callback: function that is called with each record of phase statistics (a dictionary; see PhaseStats).
+                       default: None
+
+           incremental: incremental combination, e.g. for repeated combinations in which only one model has changed.
+                        The input tables are split into blocks of source phrases, and a manifest (output_file + '.manifest') stores a checksum of each block of each table,
+                        and the offset of each block in the output. The next combination (with the same configuration and output file) only combines the blocks whose input has changed,
+                        and copies all other blocks from the previous output. The output is identical to that of a full combination.
+                        Requires uncompressed input tables and output file, and a configuration in which each source phrase is combined independently of the rest of the tables
+                        (reordering tables; phrase tables in mode 'interpolate', unless recompute_lexweights is used or normalize_s_given_t is 't'). Otherwise, all tables are combined (without manifest).
+                        default: False
+
+           incremental_block_size: approximate size (in MB of the biggest input table) of a block for incremental combination. Only used when there is no manifest yet;
+                        later combinations keep the block boundaries of the manifest.
+                        default: 16
+
+           index_interval: the action index_tables records the position of every Nth source phrase of each table in a sidecar index (table + '.index'; see TableIndex).
+                        Loading the data for a reference set (tuning and cross-entropy computation) then only reads the parts of indexed tables that contain its source phrases,
+                        and parallel combination (processes) can split indexed gzipped tables. Indexes of tables that have changed since indexing are ignored.
+                        default: 1000
+
+           index_recompress: when indexing gzipped tables, first rewrite them (with the same content) as many small gzip members, which can be decompressed independently.
+                        gzip writes a single member, which can only be decompressed from its start; tables written by tmcombine already consist of small members.
+                        default: False
+
+           table_limit: maximal number of translations per source phrase in the combined phrase table (0: no limit). For each source phrase, a bounded heap keeps
+                        the translations with the highest value of table_limit_feature in the combined table, and only those are written (in their usual order).
+                        Of translations with equal values, the first ones are kept. With several weight configurations (combine_weight_sweep), each table is pruned separately.
+                        With lowmem_strategy 'invert', the table is pruned when the two table halves are merged, based on the feature values as written.
+                        default: 0
+
+           table_limit_feature: index of the feature by which translations are ranked for table_limit.
+                        default: None (i_f2e, i.e. p(e|f))
 
            there are a number of further configuration options that you can define, which modify the algorithm for linear interpolation. They have no effect in mode 'counts'
 
@@ -1449,8 +4679,13 @@ class Combine_TMs():
         self.flags['i_e2f_lex'] = int(self.flags['i_e2f_lex'])
         self.flags['i_f2e'] = int(self.flags['i_f2e'])
         self.flags['i_f2e_lex'] = int(self.flags['i_f2e_lex'])
+        if self.flags['table_limit_feature'] is None:
+            self.flags['table_limit_feature'] = self.flags['i_f2e']
 
-        if reference_interface:
+        self.reference_file = reference_file
+        if reference_interface and isinstance(reference_file,(list,tuple)):
+            self.reference_interface = MultiReference([reference_interface(filename) for filename in reference_file])
+        elif reference_interface:
             self.reference_interface = reference_interface(reference_file)
 
         if mode not in ['interpolate','loglinear','counts']:
@@ -1458,6 +4693,10 @@ class Combine_TMs():
             sys.exit(1)
 
         models,number_of_features,weights = self._sanity_checks(models,number_of_features,weights)
+
+        if not 0 <= self.flags['table_limit_feature'] < number_of_features:
+            sys.stderr.write('Error: table_limit_feature must be the index of one of the ' + str(number_of_features) + ' features\n')
+            sys.exit(1)
         
         self.weights = weights
         self.models = models
@@ -1466,10 +4705,19 @@ class Combine_TMs():
 
         if mode == 'interpolate':
             self.score = score_interpolate
+            self.score_block = score_interpolate_block
         elif mode == 'loglinear':
             self.score = score_loglinear
+            self.score_block = score_loglinear_block
         elif mode == 'counts':
             self.score = score_counts
+            self.score_block = score_counts_block
+
+        # vectorized scoring requires NumPy
+        if numpy is None:
+            self.score_block = None
+
+        self.stats = PhaseStats(self.flags['stats_file'],self.flags['stats_callback'])
             
 
     def _sanity_checks(self,models,number_of_features,weights):
@@ -1484,23 +4732,31 @@ class Combine_TMs():
         models = [(model,self._priorities[p]) for (model,p) in models]
             
 
+        weights = self._check_weights(weights,number_of_features,len(models))
+            
+        return models,number_of_features,weights
+
+
+    def _check_weights(self,weights,number_of_features,number_of_models):
+        """check a weight declaration, and return the (normalized) weights with one list of weights per feature"""
+
         # accept two types of weight declarations: one weight per model, and one weight per model and feature
         # type one is internally converted to type two: [0.1,0.9] -> [[0.1,0.9],[0.1,0.9],[0.1,0.9],[0.1,0.9]]
         if weights:
             if type(weights[0]) == list:
                 assert(len(weights)==number_of_features)
                 for sublist in weights:
-                    assert(len(sublist)==len(models))
+                    assert(len(sublist)==number_of_models)
                 
             else:
-                assert(len(models) == len(weights))
+                assert(number_of_models == len(weights))
                 weights = [weights for i in range(number_of_features)]
 
         else:
             if self.mode == 'loglinear' or self.mode == 'interpolate':
-                weights = [[1/len(models)]*len(models) for i in range(number_of_features)]
+                weights = [[1/number_of_models]*number_of_models for i in range(number_of_features)]
             elif self.mode == 'counts':
-                weights = [[1]*len(models) for i in range(number_of_features)]
+                weights = [[1]*number_of_models for i in range(number_of_features)]
             sys.stderr.write('Warning: No weights defined: initializing with uniform weights\n')
 
 
@@ -1513,7 +4769,7 @@ class Combine_TMs():
             sys.stderr.write('normalizing to: '+ str(new_weights) +'\n')
             weights = new_weights
             
-        return models,number_of_features,weights
+        return weights
 
 
     def _ensure_loaded(self,data):
@@ -1525,20 +4781,34 @@ class Combine_TMs():
         if 'reference' in data and not self.loaded['reference']:
             
             sys.stderr.write('Loading word pairs from reference set...')
-            self.reference_interface.load_word_pairs(self.lang_src,self.lang_target)
+            with self.stats.phase('load-reference') as phase:
+                self.reference_interface.load_word_pairs(self.lang_src,self.lang_target)
+                phase.count(pairs=sum(len(targets) for targets in self.reference_interface.word_pairs.values()))
             sys.stderr.write('done\n')
             self.loaded['reference'] = 1
 
         if 'lexical' in data and not self.loaded['lexical']:
             
             sys.stderr.write('Loading lexical tables...')
-            self.model_interface.load_lexical_tables(self.models,self.mode)
+            with self.stats.phase('load-lexical') as phase:
+                self.model_interface.load_lexical_tables(self.models,self.mode)
+                phase.count(pairs=len(self.model_interface.word_pairs_e2f))
             sys.stderr.write('done\n')
             self.loaded['lexical'] = 1
             
+        if 'pt-filtered' in data and not self.loaded['pt-filtered']:
+            phase = self.stats.phase('load-cache',data='pt-filtered')
+            phase.start()
+            if self._load_from_cache('pt-filtered'):
+                self.loaded['pt-filtered'] = 1
+                phase.stop()
+                phase.emit()
+
         if 'pt-filtered' in data and not self.loaded['pt-filtered']:
             
-            models_prioritized = [(self.model_interface.open_table(model,'phrase-table'),priority,i) for (model,priority,i) in priority_sort_models(self.models)]
+            phase = self.stats.phase('load-phrase-table-filtered')
+            phase.start()
+            models_prioritized = [(self.model_interface.filtered_phrase_table(model,self.reference_interface.word_pairs,self.mode,self.flags),priority,i) for (model,priority,i) in priority_sort_models(self.models)]
             
             for model,priority,i in models_prioritized:
                 sys.stderr.write('Loading phrase table ' + str(i) + ' (only data relevant for reference set)')
@@ -1550,74 +4820,589 @@ class Combine_TMs():
                     line = line.rstrip().split(b' ||| ')
                     if line[-1].endswith(b' |||'):
                         line[-1] = line[-1][:-4]
-                        line.append('')
+                        line.append(b'')
                     self.model_interface.load_phrase_features(line,priority,i,store='all',mode=self.mode,filter_by=self.reference_interface.word_pairs,filter_by_src=self.reference_interface.word_source,filter_by_target=self.reference_interface.word_target,flags=self.flags)
                 sys.stderr.write(' done\n')
+                phase.count(lines=j)
+            phase.count(pairs=len(self.model_interface.phrase_pairs))
+            phase.stop()
+            phase.emit()
 
+            self._save_to_cache('pt-filtered')
             self.loaded['pt-filtered'] = 1
 
+        if 'lexical-filtered' in data and not self.loaded['lexical-filtered']:
+            phase = self.stats.phase('load-cache',data='lexical-filtered')
+            phase.start()
+            if self._load_from_cache('lexical-filtered'):
+                self.loaded['lexical-filtered'] = 1
+                phase.stop()
+                phase.emit()
+
         if 'lexical-filtered' in data and not self.loaded['lexical-filtered']:
             e2f_filter, f2e_filter = _get_lexical_filter(self.reference_interface,self.model_interface)
             
             sys.stderr.write('Loading lexical tables (only data relevant for reference set)...')
-            self.model_interface.load_lexical_tables(self.models,self.mode,e2f_filter=e2f_filter,f2e_filter=f2e_filter)
+            with self.stats.phase('load-lexical-filtered') as phase:
+                self.model_interface.load_lexical_tables(self.models,self.mode,e2f_filter=e2f_filter,f2e_filter=f2e_filter)
+                phase.count(pairs=len(self.model_interface.word_pairs_e2f))
             sys.stderr.write('done\n')
+            self._save_to_cache('lexical-filtered')
             self.loaded['lexical-filtered'] = 1
 
         if 'pt-target' in data and not self.loaded['pt-target']:
-            
-            models_prioritized = [(self.model_interface.open_table(model,'phrase-table'),priority,i) for (model,priority,i) in priority_sort_models(self.models)]
-            
-            for model,priority,i in models_prioritized:
-                sys.stderr.write('Loading target information from phrase table ' + str(i))
-                j = 0
-                for line in model:
-                    if not j % 1000000:
-                        sys.stderr.write('...'+str(j))
-                    j += 1
-                    line = line.rstrip().split(b' ||| ')
-                    if line[-1].endswith(b' |||'):
-                        line[-1] = line[-1][:-4]
-                        line.append('')
-                    self.model_interface.load_phrase_features(line,priority,i,mode=self.mode,store='target',flags=self.flags)
-                sys.stderr.write(' done\n')
-
+            with self.stats.phase('load-target-phrases') as phase:
+                phase.count(lines=self._load_target_phrases())
+            # target phrase counts are moved to an on-disk index if they approach the memory limit while they are loaded (see _spill_target_phrases)
+            if isinstance(self.model_interface.phrase_target,PhraseCountIndex):
+                with self.stats.phase('sort-target-index') as phase:
+                    self.model_interface.phrase_target.finish()
+                    phase.count(pairs=len(self.model_interface.phrase_target))
             self.loaded['pt-target'] = 1
 
+        if 'pt-target-index' in data and not self.loaded['pt-target'] and not self.loaded['pt-target-index']:
+            # low memory mode: target phrase counts are collected in an on-disk index that replaces the in-memory store
+            self.model_interface.phrase_target = PhraseCountIndex(len(self.models),tempdir=self.flags['tempdir'],buffer_size=self.flags['sort_buffer_size'],processes=self.flags['processes'])
+            with self.stats.phase('load-target-phrases') as phase:
+                phase.count(lines=self._load_target_phrases())
+            with self.stats.phase('sort-target-index') as phase:
+                self.model_interface.phrase_target.finish()
+                phase.count(pairs=len(self.model_interface.phrase_target))
+            self.loaded['pt-target-index'] = 1
+
+
+    def _load_target_phrases(self):
+        """pass over all phrase tables, and store target phrase counts (or which model a target phrase occurs in) in self.model_interface.phrase_target.
+           returns the number of lines read.
+        """
+
+        lines = 0
+
+        models_prioritized = [(self.model_interface.open_table(model,'phrase-table'),priority,i) for (model,priority,i) in priority_sort_models(self.models)]
+
+        for model,priority,i in models_prioritized:
+            sys.stderr.write('Loading target information from phrase table ' + str(i))
+            j = 0
+            for line in model:
+                if not j % 1000000:
+                    sys.stderr.write('...'+str(j))
+                j += 1
+                line = line.rstrip().split(b' ||| ')
+                if line[-1].endswith(b' |||'):
+                    line[-1] = line[-1][:-4]
+                    line.append(b'')
+                self.model_interface.load_phrase_features(line,priority,i,mode=self.mode,store='target',flags=self.flags)
+                if not j % 10000 and isinstance(self.model_interface.phrase_target,PhraseCountStore) and _near_memory_limit(self.flags):
+                    self._spill_target_phrases()
+            # also check after each table, so that the remaining tables are loaded into the index if the limit is reached
+            if isinstance(self.model_interface.phrase_target,PhraseCountStore) and _near_memory_limit(self.flags):
+                self._spill_target_phrases()
+            sys.stderr.write(' done\n')
+            lines += j
+
+        return lines
+
+
+    def _spill_target_phrases(self):
+        """move the target phrase counts that have been loaded so far from memory to an on-disk index (PhraseCountIndex), which then collects the rest of them.
+           This switches a combination to the strategy of low memory mode (lowmem_strategy 'index') without starting over.
+        """
+
+        sys.stderr.write('\nWarning: close to the memory limit ({0} MB). Moving target phrase counts to an on-disk index...'.format(self.flags['memory_limit']))
+
+        with self.stats.phase('spill-target-phrases') as phase:
+            store = self.model_interface.phrase_target
+            # the sort buffer has to fit into the memory limit as well
+            buffer_size = max(1,min(self.flags['sort_buffer_size'],self.flags['memory_limit']//5))
+            index = PhraseCountIndex(len(self.models),tempdir=self.flags['tempdir'],buffer_size=buffer_size,processes=self.flags['processes'])
+            for key in store:
+                for i,value in enumerate(store[key]):
+                    index.set(key,i,value)
+            phase.count(pairs=len(store))
+            store.clear()
+            self.model_interface.phrase_target = index
+
+
+    def _cache_prefix(self,data):
+        """path prefix of the cache files for data ('pt-filtered' or 'lexical-filtered'), or None if there is no cache.
+           the name contains a hash of everything that the data depends on: models (paths and size/modification time of their files), reference file, mode and feature configuration.
+        """
+
+        if not self.flags['cache_dir'] or not self.reference_file:
+            return None
+
+        key = [data,self.mode,self.model_interface.__class__.__name__,self.reference_interface.__class__.__name__,self.lang_src,self.lang_target,
+               self.model_interface.number_of_features,self.flags['i_e2f'],self.flags['i_e2f_lex'],self.flags['i_f2e'],self.flags['i_f2e_lex']]
+
+        for model,priority in self.models:
+            key.append((os.path.abspath(model),priority))
+            model_dir = os.path.join(model,'model')
+            if os.path.isdir(model_dir):
+                for filename in sorted(os.listdir(model_dir)):
+                    status = os.stat(os.path.join(model_dir,filename))
+                    key.append((filename,status.st_size,status.st_mtime))
+
+        for reference_file in self._reference_files():
+            # like handle_file, accept the path of a gzipped reference file without '.gz'
+            if not os.path.exists(reference_file) and os.path.exists(reference_file + '.gz'):
+                reference_file += '.gz'
+            status = os.stat(reference_file)
+            key.append((os.path.abspath(reference_file),status.st_size,status.st_mtime))
+
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.flags['cache_dir'],'tmcombine-' + digest + '.' + data)
+
+
+    def _reference_files(self):
+        """list of the reference files (one, unless there are several reference sets; see MultiReference)"""
+
+        if isinstance(self.reference_file,(list,tuple)):
+            return list(self.reference_file)
+        return [self.reference_file]
+
+
+    def _reference_sets(self):
+        """list of the reference interfaces of the individual reference sets"""
+
+        if isinstance(self.reference_interface,MultiReference):
+            return self.reference_interface.references
+        return [self.reference_interface]
+
+
+    def _load_from_cache(self,data):
+        """load data ('pt-filtered' or 'lexical-filtered') from cache. Returns False if there is no cache for the current configuration"""
+
+        prefix = self._cache_prefix(data)
+        if not prefix or not os.path.exists(prefix + '.done'):
+            return False
+
+        # cached data replaces the data structures; only use it if nothing else has been loaded
+        if data == 'pt-filtered' and (self.loaded['pt-target'] or self.loaded['pt-target-index'] or self.model_interface.phrase_pairs):
+            return False
+        if data == 'lexical-filtered' and (self.model_interface.word_pairs_e2f or self.model_interface.word_pairs_f2e):
+            return False
+
+        sys.stderr.write('Loading ' + data + ' data from cache ' + prefix + '...')
+        if data == 'pt-filtered':
+            self.model_interface.load_phrase_data(prefix)
+        else:
+            self.model_interface.load_lexical_data(prefix)
+        sys.stderr.write('done\n')
+
+        return True
+
+
+    def _save_to_cache(self,data):
+        """write data ('pt-filtered' or 'lexical-filtered') to cache (if cache_dir is set)"""
+
+        prefix = self._cache_prefix(data)
+        if not prefix or (data == 'pt-filtered' and (self.loaded['pt-target'] or self.loaded['pt-target-index'])):
+            return
+
+        if not os.path.isdir(self.flags['cache_dir']):
+            os.makedirs(self.flags['cache_dir'])
+
+        sys.stderr.write('Writing ' + data + ' data to cache ' + prefix + '...')
+        if data == 'pt-filtered':
+            self.model_interface.save_phrase_data(prefix)
+        else:
+            self.model_interface.save_lexical_data(prefix)
+
+        # mark cache as complete
+        open(prefix + '.done','w').close()
+        sys.stderr.write('done\n')
+
 
     def _inverse_wrapper(self,weights,tempdir=None):
         """if we want to invert the phrase table to better calcualte p(s|t) and lex(s|t), manage creation, sorting and merging of inverted phrase tables"""
 
-        sys.stderr.write('Processing first table half\n')
-        models = [(self.model_interface.open_table(model,'phrase-table'),priority,i) for (model,priority,i) in priority_sort_models(self.model_interface.models)]
-        pt_half1 = NamedTemporaryFile(prefix='half1',delete=False,dir=tempdir)
-        self._write_phrasetable(models,pt_half1,weights)
-        pt_half1.seek(0)
-
-        sys.stderr.write('Inverting tables\n')
-        models = [(self.model_interface.create_inverse(self.model_interface.open_table(model,'phrase-table'),tempdir=tempdir),priority,i) for (model,priority,i) in priority_sort_models(self.model_interface.models)]
-        sys.stderr.write('Processing second table half\n')
-        pt_half2_inverted = NamedTemporaryFile(prefix='half2',delete=False,dir=tempdir)
-        self._write_phrasetable(models,pt_half2_inverted,weights,inverted=True)
-        pt_half2_inverted.close()
-        for model,priority,i in models:
-            model.close()
-            os.remove(model.name)
-        pt_half2 = sort_file(pt_half2_inverted.name,tempdir=tempdir)
-        os.remove(pt_half2_inverted.name)
+        sort_options = {'tempdir':tempdir,'buffer_size':self.flags['sort_buffer_size'],'processes':self.flags['processes']}
+
+        # with checkpoints, completed stages are skipped when the combination is restarted, and the first table half continues from its last checkpoint
+        checkpoint = self._checkpoint(weights)
+        completed = checkpoint.completed if checkpoint is not None else lambda stage: None
+
+        half1 = completed('half1')
+        if half1 is None:
+            sys.stderr.write('Processing first table half\n')
+            with self.stats.phase('combine-first-half'):
+                models = [(self.model_interface.open_table(model,'phrase-table'),priority,i) for (model,priority,i) in priority_sort_models(self.model_interface.models)]
+                if checkpoint is not None and checkpoint.resume('half1'):
+                    pt_half1 = self._open_output(None,checkpoint,'half1')
+                else:
+                    pt_half1 = NamedTemporaryFile(prefix='half1',delete=False,dir=tempdir)
+                    if checkpoint is not None:
+                        checkpoint.add_temp_file(pt_half1.name)
+                # both halves contain all phrase pairs; table_limit is applied when they are merged
+                self._write_phrasetable(models,pt_half1,weights,limit=0,checkpoint=checkpoint,stage='half1')
+                _temp_bytes[0] += pt_half1.tell()
+                pt_half1.close()
+                half1 = [pt_half1.name]
+                if checkpoint is not None:
+                    checkpoint.complete('half1',half1)
+
+        half2 = completed('half2')
+        if half2 is None:
+            inverse = completed('inverse')
+            if inverse is None:
+                sys.stderr.write('Inverting tables\n')
+                with self.stats.phase('invert'):
+                    inverse = []
+                    for model,priority,i in priority_sort_models(self.model_interface.models):
+                        fobj = self.model_interface.create_inverse(self.model_interface.open_table(model,'phrase-table'),**sort_options)
+                        fobj.close()
+                        inverse.append(fobj.name)
+                        if checkpoint is not None:
+                            checkpoint.add_temp_file(fobj.name)
+                    if checkpoint is not None:
+                        checkpoint.complete('inverse',inverse)
+
+            sys.stderr.write('Processing second table half\n')
+            # second half is sorted on the fly
+            with self.stats.phase('combine-second-half'):
+                models = [(open(name,'rb'),priority,i) for (name,(model,priority,i)) in zip(inverse,priority_sort_models(self.model_interface.models))]
+                pt_half2_sorter = ExternalSort(**sort_options)
+                self._write_phrasetable(models,pt_half2_sorter,weights,inverted=True)
+                for model,priority,i in models:
+                    model.close()
+                    os.remove(model.name)
+            with self.stats.phase('sort-second-half'):
+                pt_half2 = pt_half2_sorter.finish()
+                pt_half2.close()
+                half2 = [pt_half2.name]
+                if checkpoint is not None:
+                    checkpoint.add_temp_file(pt_half2.name)
+                    checkpoint.complete('half2',half2)
+
+        pt_half1 = open(half1[0],'rb')
+        pt_half2 = open(half2[0],'rb')
 
         sys.stderr.write('Merging tables: first half: {0} ; second half: {1} ; final table: {2}\n'.format(pt_half1.name,pt_half2.name,self.output_file))
-        output_object = handle_file(self.output_file,'open',mode='w')
-        self.model_interface.merge(pt_half1,pt_half2,output_object,self.mode)
-        os.remove(pt_half1.name)
-        os.remove(pt_half2.name)
-        
-        handle_file(self.output_file,'close',output_object,mode='w')
+        with self.stats.phase('merge'):
+            output_object = handle_file(self.output_file,'open',mode='w',threads=self.flags['processes'])
+            self.model_interface.merge(pt_half1,pt_half2,output_object,self.mode,self.flags['table_limit'],self.flags['table_limit_feature'])
+            os.remove(pt_half1.name)
+            os.remove(pt_half2.name)
+
+            handle_file(self.output_file,'close',output_object,mode='w')
+
+        if checkpoint is not None:
+            checkpoint.remove()
         
 
-    def _write_phrasetable(self,models,output_object,weights,inverted=False):
+    def _checkpoint(self,weights):
+        """Checkpoint of the combination of the phrase tables into output_file with weights (see checkpoint_interval), or None if checkpoints are disabled"""
+
+        if not self.flags['checkpoint_interval'] or not self.output_file or self.output_file == '-':
+            return None
+
+        config = self._manifest_config('phrase-table',weights)
+
+        # the checkpoint is only valid for the same input tables
+        config['inputs'] = []
+        for model,priority in self.models:
+            filename = self.model_interface.table_path(model,'phrase-table')
+            if not os.path.exists(filename) and os.path.exists(filename + '.gz'):
+                filename += '.gz'
+            if os.path.exists(filename):
+                status = os.stat(filename)
+                config['inputs'].append((os.path.abspath(filename),status.st_size,status.st_mtime))
+
+        return Checkpoint(self.output_file + '.checkpoint',json.loads(json.dumps(config)),self.flags['checkpoint_interval'])
+
+
+    def _open_output(self,filename,checkpoint,stage):
+        """open an output file for writing, or reopen it at the position of the last checkpoint of stage (if the stage is in progress)"""
+
+        resumed = checkpoint.resume(stage) if checkpoint is not None else None
+        if resumed:
+            name,offset = resumed[2][0]
+            return _reopen_output(name,offset,threads=self.flags['processes'])
+
+        return handle_file(filename,'open',mode='w',threads=self.flags['processes'])
+
+
+    def _write_phrasetable(self,models,output_object,weights,inverted=False,limit=None,checkpoint=None,stage='phrase-table'):
         """Incrementally load phrase tables, calculate score for increment and write it to output_object"""
 
+        self._write_phrasetables(models,[(output_object,weights)],inverted,limit,checkpoint,stage)
+
+
+    def _write_phrasetables(self,models,outputs,inverted=False,limit=None,checkpoint=None,stage='phrase-table'):
+        """same as _write_phrasetable, but scores the phrase pairs with several weight configurations during the same traversal of the tables.
+           outputs is a list of (output_object,weights).
+           checkpoint: Checkpoint in which the progress of the combination is recorded (as stage), and from which it continues.
+                       When continuing, the output objects must have been reopened at the offsets of the checkpoint (see _reopen_output).
+        """
+
+        sys.stderr.write('Incrementally loading and processing phrase tables...')
+
+        filenames = [_seekable_table(model) for (model,priority,i) in models]
+        output_objects = [output_object for (output_object,weights) in outputs]
+
+        start = None
+        if checkpoint is not None:
+            if None in filenames or not all(hasattr(output_object,'tell') for output_object in output_objects):
+                sys.stderr.write('Warning: checkpoints require uncompressed or indexed phrase tables, and output files. Not writing checkpoints...')
+                checkpoint = None
+            elif checkpoint.resume(stage):
+                start,inputs = checkpoint.resume(stage)[:2]
+
+        if self.flags['processes'] > 1:
+            if None in filenames:
+                sys.stderr.write('Warning: parallel processing requires uncompressed or indexed phrase tables. Using a single process...')
+            else:
+                # readers of gzipped tables have background threads, which must not be running while worker processes are forked
+                for model,priority,i in models:
+                    model.close()
+                tables = [(filename,priority,i) for (filename,(model,priority,i)) in zip(filenames,models)]
+                weight_configurations = [weights for (output_object,weights) in outputs]
+                self._write_parallel(tables,output_objects,lambda models,*shard_outputs: self._process_phrasetables(models,list(zip(shard_outputs,weight_configurations)),inverted=inverted,limit=limit),start,checkpoint,stage)
+                sys.stderr.write('done\n')
+                return
+
+        if start is not None:
+            for model,priority,i in models:
+                model.close()
+            models = [(_read_from(filename,start,offset),priority,i) for (filename,offset,(model,priority,i)) in zip(filenames,inputs,models)]
+
+        progress = None
+        if checkpoint is not None:
+            def progress(src):
+                if checkpoint.due():
+                    # the smallest key that is greater than the keys of all lines of src
+                    checkpoint.save(stage,src + b' |\x00',filenames,output_objects)
+
+        self._process_phrasetables(models,outputs,inverted,verbose=True,limit=limit,progress=progress)
+        sys.stderr.write('done\n')
+
+
+    def _write_parallel(self,tables,output_objects,process,start=None,checkpoint=None,stage=None):
+        """split tables into source phrase ranges, process them in worker processes with process(models,*output_objects) (with one temporary output object per output object),
+           and concatenate the results in order.
+           start: only combine the source phrases from this key on (when continuing from a checkpoint). checkpoint: Checkpoint in which the progress is recorded (as stage)
+           If worker processes can't be forked (see _fork_pool), the shards are processed one after the other by this process.
+        """
+
+        processes = self.flags['processes']
+        keys,shards = split_tables([filename for (filename,priority,i) in tables],processes*4,start)
+
+        # workers are forked, and share (copy-on-write) all data that is already loaded (e.g. lexical tables, target phrase counts)
+        _shard_state.update(combiner=self,tables=tables,process=process,outputs=len(output_objects))
+        pool = _fork_pool(processes)
+        if pool is None:
+            _shard_state.clear()
+            sys.stderr.write('Warning: parallel processing requires that worker processes can be forked, which is not possible on this platform. Using a single process...')
+            self.stats.start_collecting()
+            for j,shard in enumerate(shards):
+                process([(read_range(filename,start,end),priority,i) for ((filename,priority,i),(start,end)) in zip(tables,shard)],*output_objects)
+                if checkpoint is not None and j < len(keys) and checkpoint.due():
+                    checkpoint.save(stage,keys[j],[filename for (filename,priority,i) in tables],output_objects)
+            self.stats.merge(self.stats.stop_collecting())
+            return
+
+        records = []
+        try:
+            for j,(filenames,shard_records) in enumerate(pool.imap(_combine_shard,shards)):
+                sys.stderr.write(str(j+1) + '/' + str(len(shards)) + '...')
+                records += shard_records
+                for filename,output_object in zip(filenames,output_objects):
+                    fobj = open(filename,'rb')
+                    shutil.copyfileobj(fobj,output_object)
+                    fobj.close()
+                    _add_temp_bytes(filename)
+                    os.remove(filename)
+                if checkpoint is not None and j < len(keys) and checkpoint.due():
+                    checkpoint.save(stage,keys[j],[filename for (filename,priority,i) in tables],output_objects)
+        except:
+            pool.terminate()
+            raise
+        finally:
+            _shard_state.clear()
+        pool.close()
+        pool.join()
+        # the phases of all shards are emitted as if the tables had been combined by this process
+        self.stats.merge(records)
+
+
+    def _write_incremental(self,models,table,process,weights):
+        """incremental combination (option 'incremental'): combine only the blocks (source phrase ranges) whose input lines have changed
+           since the last combination, and copy all other blocks from the previous output, using the manifest of the output (output_file + '.manifest').
+           The manifest stores the boundary keys of the blocks, a checksum of each block of each input table, and the byte offset of each block in the output.
+           process(models,output_object) combines the lines of a block. Returns False (without writing any output) if the tables can't be combined incrementally.
+        """
+
+        filenames = [_seekable_table(model) for (model,priority,i) in models]
+        if None in filenames or any(filename.endswith('.gz') for filename in filenames) or not self.output_file or self.output_file == '-' or self.output_file.endswith('.gz'):
+            sys.stderr.write('Warning: incremental combination requires uncompressed input tables and an uncompressed output file. Combining all blocks...\n')
+            return False
+
+        for model,priority,i in models:
+            model.close()
+
+        manifest_file = self.output_file + '.manifest'
+        config = self._manifest_config(table,weights)
+        manifest = self._load_manifest(manifest_file,config)
+
+        if manifest:
+            keys = [key.encode('latin-1') for key in manifest['boundaries']]
+        else:
+            biggest = max(os.path.getsize(filename) for filename in filenames)
+            keys = _split_keys(filenames,int(-(-biggest // (self.flags['incremental_block_size']*1024*1024))))
+        offsets = _key_offsets(filenames,keys)
+        blocks = len(keys) + 1
+
+        # checksums of tables that haven't been modified since the last combination are taken from the manifest
+        with self.stats.phase('checksum'):
+            model_entries = []
+            for j,(filename,table_offsets) in enumerate(zip(filenames,offsets)):
+                status = os.stat(filename)
+                entry = {'path':os.path.abspath(filename),'size':status.st_size,'mtime':status.st_mtime}
+                if manifest and all(manifest['models'][j][key] == entry[key] for key in ['path','size','mtime']):
+                    entry['checksums'] = manifest['models'][j]['checksums']
+                else:
+                    entry['checksums'] = _range_checksums(filename,table_offsets)
+                model_entries.append(entry)
+
+        if manifest:
+            changed = [j for j in range(blocks) if any(entry['checksums'][j] != old_entry['checksums'][j] for (entry,old_entry) in zip(model_entries,manifest['models']))]
+            if not changed:
+                sys.stderr.write('Output is up to date ({0} blocks)\n'.format(blocks))
+                return True
+        else:
+            changed = list(range(blocks))
+        changed_blocks = set(changed)
+
+        sys.stderr.write('Combining {0} of {1} blocks...'.format(len(changed),blocks))
+
+        tables = [(filename,priority,i) for (filename,(model,priority,i)) in zip(filenames,models)]
+        shards = [[(table_offsets[j],table_offsets[j+1]) for table_offsets in offsets] for j in changed]
+
+        pool = None
+        if self.flags['processes'] > 1 and len(changed) > 1:
+            # workers are forked, and share (copy-on-write) all data that is already loaded
+            _shard_state.update(combiner=self,tables=tables,process=process,outputs=1)
+            pool = _fork_pool(self.flags['processes'])
+            if pool is None:
+                _shard_state.clear()
+                sys.stderr.write('Warning: parallel processing requires that worker processes can be forked, which is not possible on this platform. Using a single process...')
+            else:
+                combined = pool.imap(_combine_shard,shards)
+
+        old_output = open(self.output_file,'rb') if manifest else None
+        output_object = open(self.output_file + '.tmp','wb')
+        output_offsets = [0]
+        shards = iter(shards)
+        # the phases of all blocks (combined by workers or by this process) are emitted as one record per phase
+        self.stats.start_collecting()
+        records = []
+        try:
+            for j in range(blocks):
+                if manifest and j not in changed_blocks:
+                    _copy_range(old_output,manifest['offsets'][j],manifest['offsets'][j+1],output_object)
+                elif pool is not None:
+                    (filename,),shard_records = next(combined)
+                    records += shard_records
+                    fobj = open(filename,'rb')
+                    shutil.copyfileobj(fobj,output_object)
+                    fobj.close()
+                    _add_temp_bytes(filename)
+                    os.remove(filename)
+                else:
+                    process([(read_range(filename,start,end),priority,i) for ((filename,priority,i),(start,end)) in zip(tables,next(shards))],output_object)
+                output_offsets.append(output_object.tell())
+        except:
+            if pool is not None:
+                pool.terminate()
+            output_object.close()
+            os.remove(output_object.name)
+            raise
+        finally:
+            _shard_state.clear()
+            records = self.stats.stop_collecting() + records
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        self.stats.merge(records)
+        if old_output is not None:
+            old_output.close()
+        output_object.close()
+        os.rename(output_object.name,self.output_file)
+        sys.stderr.write('done\n')
+
+        status = os.stat(self.output_file)
+        manifest = {'version':1,
+                    'config':config,
+                    'boundaries':[key.decode('latin-1') for key in keys],
+                    'models':model_entries,
+                    'offsets':output_offsets,
+                    'output':{'size':status.st_size,'mtime':status.st_mtime}}
+        fobj = open(manifest_file + '.tmp','w')
+        json.dump(manifest,fobj)
+        fobj.close()
+        os.rename(manifest_file + '.tmp',manifest_file)
+
+        return True
+
+
+    def _manifest_config(self,table,weights):
+        """everything (except for the content of the input tables) that the output of an incremental combination depends on"""
+
+        # options that don't change the output
+        ignored = ['processes','tempdir','sort_buffer_size','block_size','cache_dir','stats_file','stats_callback','incremental','incremental_block_size','index_interval','index_recompress','lowmem','lowmem_strategy','memory_limit','checkpoint_interval']
+
+        config = {'table':table,
+                  'mode':self.mode,
+                  'weights':weights,
+                  'number_of_features':self.model_interface.number_of_features,
+                  'models':[(os.path.abspath(model),priority) for (model,priority) in self.models],
+                  'flags':dict((key,value) for (key,value) in self.flags.items() if key not in ignored)}
+
+        # normalize types (tuples, numbers, unicode) as they are read back from the manifest
+        return json.loads(json.dumps(config,default=repr))
+
+
+    def _load_manifest(self,manifest_file,config):
+        """load the manifest of an earlier combination, or return None if there is none, or if it can't be used for an incremental combination"""
+
+        if not os.path.exists(manifest_file):
+            return None
+
+        try:
+            fobj = open(manifest_file)
+            manifest = json.load(fobj)
+            fobj.close()
+        except ValueError:
+            sys.stderr.write('Warning: manifest {0} is corrupt. Combining all blocks...\n'.format(manifest_file))
+            return None
+
+        if manifest.get('version') != 1 or manifest['config'] != config:
+            sys.stderr.write('Configuration has changed since the last combination. Combining all blocks...\n')
+            return None
+
+        if not os.path.exists(self.output_file) or os.stat(self.output_file).st_size != manifest['output']['size'] or os.stat(self.output_file).st_mtime != manifest['output']['mtime']:
+            sys.stderr.write('Output has been modified since the last combination. Combining all blocks...\n')
+            return None
+
+        return manifest
+
+
+    def _process_phrasetable(self,models,output_object,weights,inverted=False,verbose=False):
+        """traverse phrase tables, and score and write each phrase pair"""
+
+        self._process_phrasetables(models,[(output_object,weights)],inverted,verbose)
+
+
+    def _process_phrasetables(self,models,outputs,inverted=False,verbose=False,limit=None,progress=None):
+        """traverse phrase tables once, and score and write each phrase pair with each weight configuration. outputs is a list of (output_object,weights)
+           limit: maximal number of translations per source phrase (default: table_limit, unless the tables are inverted)
+           progress: function that is called with the last source phrase of each block, after the block has been written
+        """
+
+        if limit is None:
+            limit = 0 if inverted else self.flags['table_limit']
+
         # define which information we need to store from the phrase table
         # possible flags: 'all', 'target', 'source' and 'pairs'
         # interpolated models without re-normalization only need 'pairs', otherwise 'all' is the correct choice
@@ -1625,70 +5410,252 @@ class Combine_TMs():
         if self.mode == 'interpolate' and not self.flags['normalized']:
             store_flag = 'pairs'
 
+        if self.score_block is not None:
+            self._process_phrasetable_blocks(models,outputs,store_flag,inverted,verbose,limit,progress)
+            return
+
         i = 0
-        sys.stderr.write('Incrementally loading and processing phrase tables...')
 
         for block in self.model_interface.traverse_incrementally('phrase-table',models,self.model_interface.load_phrase_features,store_flag,mode=self.mode,inverted=inverted,lowmem=self.flags['lowmem'],flags=self.flags):
-            for src in sorted(self.model_interface.phrase_pairs, key = lambda x: x + b' |'):
-                for target in sorted(self.model_interface.phrase_pairs[src], key = lambda x: x + b' |'):
+            sources = sorted(self.model_interface.phrase_pairs.sources(), key = lambda x: x + b' |')
+            for src in sources:
+                targets = sorted(self.model_interface.phrase_pairs.targets(src), key = lambda x: x + b' |')
+
+                if limit:
+                    if verbose:
+                        for j in range(-(-i // 1000000) * 1000000, i + len(targets), 1000000):
+                            sys.stderr.write(str(j) + '...')
+                    i += len(targets)
+
+                    # score all translations of the source phrase, and only write the best ones
+                    for output_object,weights in outputs:
+                        features = [self.score(weights,src,target,self.model_interface,self.flags) for target in targets]
+                        candidates = [j for j in range(len(targets)) if 0 not in features[j]]
+                        values = [f[self.flags['table_limit_feature']] for f in features]
+                        for j in _top_translations(candidates,values,limit):
+                            outline = self.model_interface.write_phrase_table(src,targets[j],weights,features[j],self.mode, self.flags)
+                            output_object.write(outline)
+                    continue
+
+                for target in targets:
                     
-                    if not i % 1000000:
+                    if verbose and not i % 1000000:
                         sys.stderr.write(str(i) + '...')
                     i += 1
                     
-                    features = self.score(weights,src,target,self.model_interface,self.flags)
-                    outline = self.model_interface.write_phrase_table(src,target,weights,features,self.mode, self.flags)
-                    output_object.write(outline)
-        sys.stderr.write('done\n')
+                    for output_object,weights in outputs:
+                        features = self.score(weights,src,target,self.model_interface,self.flags)
+                        outline = self.model_interface.write_phrase_table(src,target,weights,features,self.mode, self.flags)
+                        output_object.write(outline)
 
+            if progress is not None and sources:
+                progress(sources[-1])
+
+
+    def _process_phrasetable_blocks(self,models,outputs,store_flag,inverted=False,verbose=False,limit=0,progress=None):
+        """same as _process_phrasetables, but loads block_size source phrases at a time, and scores all their phrase pairs with one call of self.score_block per weight configuration
+           (or a single call of score_interpolate_sweep_block for all configurations, if possible)
+        """
+
+        sweep = len(outputs) > 1 and self.score_block is score_interpolate_block and not self.flags['normalized'] and not self.flags['recompute_lexweights']
+
+        phrase_pairs = self.model_interface.phrase_pairs
+        i = 0
+
+        # traversal (reading and parsing the tables), scoring and writing are measured separately
+        traverse,score,write = [self.stats.phase(name,table='phrase-table',inverted=inverted) for name in ['traverse','score','write']]
+        traverse.start()
+
+        for block in self.model_interface.traverse_incrementally('phrase-table',models,self.model_interface.load_phrase_features,store_flag,mode=self.mode,inverted=inverted,lowmem=self.flags['lowmem'],flags=self.flags,block_size=self.flags['block_size']):
+
+            pairs = []
+            for src in sorted(phrase_pairs.sources(), key = lambda x: x + b' |'):
+                for target in sorted(phrase_pairs.targets(src), key = lambda x: x + b' |'):
+                    pairs.append((src,target))
+
+            if not pairs:
+                continue
+
+            if verbose:
+                for j in range(-(-i // 1000000) * 1000000, i + len(pairs), 1000000):
+                    sys.stderr.write(str(j) + '...')
+            i += len(pairs)
+
+            rows = [phrase_pairs.row(src,target) for (src,target) in pairs]
+            traverse.stop()
+            traverse.count(pairs=len(pairs))
+
+            score.start()
+            if sweep:
+                scores = score_interpolate_sweep_block([weights for (output_object,weights) in outputs],pairs,rows,self.model_interface,self.flags)
+            else:
+                scores = [self.score_block(weights,pairs,rows,self.model_interface,self.flags) for (output_object,weights) in outputs]
+            score.stop()
+            score.count(pairs=len(pairs)*len(outputs))
+
+            write.start()
+            for (output_object,weights),output_scores in zip(outputs,scores):
+                if limit:
+                    keep = _limit_block(pairs,output_scores,limit,self.flags['table_limit_feature'])
+                    if keep:
+                        output_object.writelines(self.model_interface.write_phrase_table_block([pairs[j] for j in keep],[rows[j] for j in keep],weights,output_scores[keep],self.mode,self.flags))
+                else:
+                    output_object.writelines(self.model_interface.write_phrase_table_block(pairs,rows,weights,output_scores,self.mode,self.flags))
+            write.stop()
+            write.count(lines=len(pairs)*len(outputs),pairs=len(pairs)*len(outputs))
+
+            if progress is not None:
+                progress(pairs[-1][0])
+
+            traverse.start()
+
+        traverse.stop()
+        for phase in [traverse,score,write]:
+            phase.emit()
+
+
+    def _combination_data(self):
+        """data that needs to be loaded before a phrase table combination (see _ensure_loaded),
+           and whether the combination needs the two-pass strategy of _inverse_wrapper (to get the target phrase counts in low memory mode)
+        """
 
-    def combine_given_weights(self,weights=None):
-        """write a new phrase table, based on existing weights"""
-        
-        if not weights:
-            weights = self.weights
-        
         data = []
     
+        target_data = 'pt-target'
+        if self.flags['lowmem']:
+            target_data = 'pt-target-index' if self.flags['lowmem_strategy'] == 'index' else None
+
         if self.mode == 'counts':
             data.append('lexical')
-            if not self.flags['lowmem']:
-                data.append('pt-target')
+            if target_data:
+                data.append(target_data)
             
         elif self.mode == 'interpolate':
             if self.flags['recompute_lexweights']:
                 data.append('lexical')
-            if self.flags['normalized'] and self.flags['normalize_s_given_t'] == 't' and not self.flags['lowmem']:
-                data.append('pt-target')
+            if self.flags['normalized'] and self.flags['normalize_s_given_t'] == 't' and target_data:
+                data.append(target_data)
+
+        inverse = self.flags['lowmem'] and not target_data and (self.mode == 'counts' or self.flags['normalized'] and self.flags['normalize_s_given_t'] == 't')
+
+        return data,inverse
+
+
+    def _reference_data(self):
+        """data that needs to be loaded for tuning and cross-entropy computation on the reference set (see _ensure_loaded)"""
+
+        data = ['reference','pt-filtered']
+
+        if self.mode == 'counts' or (self.mode == 'interpolate' and self.flags['recompute_lexweights']):
+            data.append('lexical-filtered')
+
+        return data
+
+
+    def combine_given_weights(self,weights=None):
+        """write a new phrase table, based on existing weights"""
+        
+        if not weights:
+            weights = self.weights
+        
+        data,inverse = self._combination_data()
+        self._ensure_loaded(data)
+
+        if inverse:
+            self._inverse_wrapper(weights,tempdir=self.flags['tempdir'])
+        else:
+            with self.stats.phase('combine-phrase-table'):
+                models = [(self.model_interface.open_table(model,'phrase-table'),priority,i) for (model,priority,i) in priority_sort_models(self.model_interface.models)]
+                # incremental combination requires that each source phrase is combined independently (i.e. no global data such as lexical tables or target phrase counts)
+                if self.flags['incremental'] and data:
+                    sys.stderr.write('Warning: incremental combination is not possible in this configuration (it requires global data: {0}). Combining all tables...\n'.format(', '.join(data)))
+                if not (self.flags['incremental'] and not data and self._write_incremental(models,'phrase-table',lambda models,output_object: self._process_phrasetable(models,output_object,weights),weights)):
+                    checkpoint = self._checkpoint(weights)
+                    output_object = self._open_output(self.output_file,checkpoint,'phrase-table')
+                    self._write_phrasetable(models,output_object,weights,checkpoint=checkpoint)
+                    handle_file(self.output_file,'close',output_object,mode='w')
+                    if checkpoint is not None:
+                        checkpoint.remove()
+
+        if self.output_lexical:
+            sys.stderr.write('Writing lexical tables\n')
+            self._ensure_loaded(['lexical'])
+            with self.stats.phase('write-lexical'):
+                self.model_interface.write_lexical_file('e2f',self.output_lexical,weights[1],self.mode)
+                self.model_interface.write_lexical_file('f2e',self.output_lexical,weights[3],self.mode)
+
     
+    def combine_weight_sweep(self,weight_configurations,output_files=None):
+        """write one phrase table per weight configuration, with a single traversal of the models (instead of one call of combine_given_weights per configuration).
+           each table is identical to the one that combine_given_weights writes with the same weights.
+
+           weight_configurations: list of weight declarations, in either of the formats of the argument weights of __init__.
+           output_files: one path per weight configuration. default: output_file with a number (1 to K) before the extension .gz, if any (e.g. 'phrase-table.1.gz').
+                    With output_lexical, the lexical tables of each configuration are written to output_lexical + '.1', output_lexical + '.2' etc.
+
+           The phrase pairs of each block of source phrases are loaded once, and scored with each configuration
+           (with a single vectorized operation in mode 'interpolate' without normalization or recomputed lexical weights).
+           Configurations that need the two passes of low memory mode with lowmem_strategy 'invert' are combined one after the other.
+        """
+
+        if not weight_configurations:
+            sys.stderr.write('Error: no weight configurations given for weight sweep\n')
+            sys.exit(1)
+
+        weight_configurations = [self._check_weights(weights,self.model_interface.number_of_features,len(self.models)) for weights in weight_configurations]
+
+        if output_files is None:
+            if not self.output_file or self.output_file == '-':
+                sys.stderr.write('Error: a weight sweep writes one table per weight configuration, and needs an output file (not standard output)\n')
+                sys.exit(1)
+            stem,extension = (self.output_file[:-3],'.gz') if self.output_file.endswith('.gz') else (self.output_file,'')
+            output_files = ['{0}.{1}{2}'.format(stem,k+1,extension) for k in range(len(weight_configurations))]
+
+        if len(output_files) != len(weight_configurations):
+            sys.stderr.write('Error: a weight sweep needs one output file per weight configuration\n')
+            sys.exit(1)
+
+        if self.flags['incremental']:
+            sys.stderr.write('Warning: incremental combination is not possible in a weight sweep. Combining all tables...\n')
+
+        data,inverse = self._combination_data()
         self._ensure_loaded(data)
 
-        if self.flags['lowmem'] and (self.mode == 'counts' or self.flags['normalized'] and self.flags['normalize_s_given_t'] == 't'):
-            self._inverse_wrapper(weights,tempdir=self.flags['tempdir'])
-        else:
+        if inverse:
+            output_file,output_lexical = self.output_file,self.output_lexical
+            try:
+                for k,(weights,filename) in enumerate(zip(weight_configurations,output_files)):
+                    self.output_file = filename
+                    if output_lexical:
+                        self.output_lexical = output_lexical + '.' + str(k+1)
+                    self.combine_given_weights(weights=weights)
+            finally:
+                self.output_file,self.output_lexical = output_file,output_lexical
+            return
+
+        with self.stats.phase('combine-phrase-table',configurations=len(weight_configurations)):
             models = [(self.model_interface.open_table(model,'phrase-table'),priority,i) for (model,priority,i) in priority_sort_models(self.model_interface.models)]
-            output_object = handle_file(self.output_file,'open',mode='w')
-            self._write_phrasetable(models,output_object,weights)
-            handle_file(self.output_file,'close',output_object,mode='w')
+            output_objects = [handle_file(filename,'open',mode='w',threads=self.flags['processes']) for filename in output_files]
+            self._write_phrasetables(models,list(zip(output_objects,weight_configurations)))
+            for filename,output_object in zip(output_files,output_objects):
+                handle_file(filename,'close',output_object,mode='w')
 
         if self.output_lexical:
             sys.stderr.write('Writing lexical tables\n')
             self._ensure_loaded(['lexical'])
-            self.model_interface.write_lexical_file('e2f',self.output_lexical,weights[1],self.mode)
-            self.model_interface.write_lexical_file('f2e',self.output_lexical,weights[3],self.mode)
+            with self.stats.phase('write-lexical'):
+                for k,weights in enumerate(weight_configurations):
+                    self.model_interface.write_lexical_file('e2f',self.output_lexical + '.' + str(k+1),weights[1],self.mode)
+                    self.model_interface.write_lexical_file('f2e',self.output_lexical + '.' + str(k+1),weights[3],self.mode)
+
 
-    
     def combine_given_tuning_set(self):
         """write a new phrase table, using the weights that minimize cross-entropy on a tuning set"""
         
-        data = ['reference','pt-filtered']
-    
-        if self.mode == 'counts' or (self.mode == 'interpolate' and self.flags['recompute_lexweights']):
-            data.append('lexical-filtered')
-    
-        self._ensure_loaded(data)
+        self._ensure_loaded(self._reference_data())
         
-        best_weights,best_cross_entropy = optimize_cross_entropy(self.model_interface,self.reference_interface,self.weights,self.score,self.mode,self.flags)
+        with self.stats.phase('optimize'):
+            best_weights,best_cross_entropy = optimize_cross_entropy(self.model_interface,self.reference_interface,self.weights,self.score,self.mode,self.flags,stats=self.stats)
         sys.stderr.write('Best weights: ' + str(best_weights) + '\n')
         sys.stderr.write('Cross entropies: ' + str(best_cross_entropy) + '\n')
         sys.stderr.write('Executing action combine_given_weights with -w "{0}"\n'.format('; '.join([', '.join(str(w) for w in item) for item in best_weights])))
@@ -1709,27 +5676,119 @@ class Combine_TMs():
         if self.mode != 'interpolate':
             sys.stderr.write('Error: only linear interpolation is supported for reordering model combination')
             
-        output_object = handle_file(self.output_file,'open',mode='w')
-        models = [(self.model_interface.open_table(model,'reordering-table'),priority,i) for (model,priority,i) in priority_sort_models(self.models)]
+        with self.stats.phase('combine-reordering-table'):
+            models = [(self.model_interface.open_table(model,'reordering-table'),priority,i) for (model,priority,i) in priority_sort_models(self.models)]
+
+            if self.flags['incremental'] and self._write_incremental(models,'reordering-table',lambda models,output_object: self._process_reordering_table(models,output_object,weights),weights):
+                return
+
+            output_object = handle_file(self.output_file,'open',mode='w',threads=self.flags['processes'])
+
+            sys.stderr.write('Incrementally loading and processing phrase tables...')
+
+            parallel = False
+            if self.flags['processes'] > 1:
+                tables = [_seekable_table(model) for (model,priority,i) in models]
+                if None in tables:
+                    sys.stderr.write('Warning: parallel processing requires uncompressed or indexed reordering tables. Using a single process...')
+                else:
+                    for model,priority,i in models:
+                        model.close()
+                    tables = [(table,priority,i) for (table,(model,priority,i)) in zip(tables,models)]
+                    self._write_parallel(tables,[output_object],lambda models,shard_output: self._process_reordering_table(models,shard_output,weights))
+                    parallel = True
+
+            if not parallel:
+                self._process_reordering_table(models,output_object,weights,verbose=True)
+            sys.stderr.write('done\n')
+
+            handle_file(self.output_file,'close',output_object,mode='w')
+
+
+    def _process_reordering_table(self,models,output_object,weights,verbose=False):
+        """traverse reordering tables, and score and write each phrase pair.
+           With NumPy, block_size source phrases are loaded at a time, and their phrase pairs are scored with vectorized operations.
+        """
 
         i = 0
-        
-        sys.stderr.write('Incrementally loading and processing phrase tables...')
 
-        for block in self.model_interface.traverse_incrementally('reordering-table',models,self.model_interface.load_reordering_probabilities,'pairs',mode=self.mode,lowmem=self.flags['lowmem'],flags=self.flags):
-            for src in sorted(self.model_interface.reordering_pairs):
-                for target in sorted(self.model_interface.reordering_pairs[src]):
-                    if not i % 1000000:
-                        sys.stderr.write(str(i) + '...')
-                    i += 1
-                    
-                    features = score_interpolate_reordering(weights,src,target,self.model_interface)
-                    outline = self.model_interface.write_reordering_table(src,target,features)
-                    output_object.write(outline)
-        sys.stderr.write('done\n')
+        if numpy is None:
+            for block in self.model_interface.traverse_incrementally('reordering-table',models,self.model_interface.load_reordering_probabilities,'pairs',mode=self.mode,lowmem=self.flags['lowmem'],flags=self.flags):
+                for src in sorted(self.model_interface.reordering_pairs):
+                    for target in sorted(self.model_interface.reordering_pairs[src]):
+                        if verbose and not i % 1000000:
+                            sys.stderr.write(str(i) + '...')
+                        i += 1
+
+                        features = score_interpolate_reordering(weights,src,target,self.model_interface)
+                        outline = self.model_interface.write_reordering_table(src,target,features)
+                        output_object.write(outline)
+            return
+
+        phrase_pairs = self.model_interface.phrase_pairs
+
+        traverse,score,write = [self.stats.phase(name,table='reordering-table') for name in ['traverse','score','write']]
+        traverse.start()
+
+        # within a block, source phrases are in table order (see traverse_incrementally), and sorting them by key restores that order
+        for block in self.model_interface.traverse_incrementally('reordering-table',models,self.model_interface.load_reordering_features,'pairs',mode=self.mode,lowmem=self.flags['lowmem'],flags=self.flags,block_size=self.flags['block_size']):
+
+            pairs = []
+            for src in sorted(phrase_pairs.sources(), key = lambda x: x + b' |'):
+                for target in sorted(phrase_pairs.targets(src)):
+                    pairs.append((src,target))
+
+            if not pairs:
+                continue
+
+            if verbose:
+                for j in range(-(-i // 1000000) * 1000000, i + len(pairs), 1000000):
+                    sys.stderr.write(str(j) + '...')
+            i += len(pairs)
+
+            rows = [phrase_pairs.row(src,target) for (src,target) in pairs]
+            traverse.stop()
+            traverse.count(pairs=len(pairs))
+
+            score.start()
+            scores = score_interpolate_reordering_block(weights,pairs,rows,self.model_interface)
+            score.stop()
+            score.count(pairs=len(pairs))
 
+            write.start()
+            output_object.writelines(self.model_interface.write_reordering_table_block(pairs,scores))
+            write.stop()
+            write.count(lines=len(pairs),pairs=len(pairs))
 
-        handle_file(self.output_file,'close',output_object,mode='w')
+            traverse.start()
+
+        traverse.stop()
+        for phase in [traverse,score,write]:
+            phase.emit()
+
+
+    def index_tables(self):
+        """build the index (see TableIndex) of the phrase table and reordering table (if it exists) of each model.
+           With the option index_recompress, gzipped tables are first rewritten as many small gzip members, so that reading can start close to any position of the index.
+        """
+
+        for model,priority in self.models:
+            for table in ['phrase-table','reordering-table']:
+                filename = self.model_interface.table_path(model,table)
+                if not os.path.exists(filename) and os.path.exists(filename + '.gz'):
+                    filename += '.gz'
+                elif not os.path.exists(filename):
+                    continue
+
+                with self.stats.phase('index-table',table=filename):
+                    if self.flags['index_recompress'] and filename.endswith('.gz'):
+                        recompress_table(filename,self.flags['processes'])
+                    sys.stderr.write('Indexing ' + filename + '...')
+                    index = TableIndex.build(filename,self.flags['index_interval'])
+                    sys.stderr.write('done\n')
+
+                if filename.endswith('.gz') and not self.flags['index_recompress'] and len(set(offset for offset,skip in index.positions)) == 1 < len(index.positions):
+                    sys.stderr.write('Warning: ' + filename + ' consists of a single gzip member, and has to be decompressed from its start. Use the option index_recompress to make it seekable\n')
 
 
     def compare_cross_entropies(self):
@@ -1739,12 +5798,7 @@ class Combine_TMs():
         
         self.flags['compare_cross-entropies'] = True
         
-        data = ['reference','pt-filtered']
-
-        if self.mode == 'counts' or (self.mode == 'interpolate' and self.flags['recompute_lexweights']):
-            data.append('lexical-filtered')
-
-        self._ensure_loaded(data)
+        self._ensure_loaded(self._reference_data())
         
         results, (intersection,total_pairs,oov2) = cross_entropy(self.model_interface,self.reference_interface,self.weights,self.score,self.mode,self.flags)
         
@@ -1779,12 +5833,7 @@ class Combine_TMs():
            analysis tool.
         """
         
-        data = ['reference','pt-filtered']
-    
-        if self.mode == 'counts' or (self.mode == 'interpolate' and self.flags['recompute_lexweights']):
-            data.append('lexical-filtered')
-    
-        self._ensure_loaded(data)
+        self._ensure_loaded(self._reference_data())
         
         current_cross_entropy = cross_entropy(self.model_interface,self.reference_interface,self.weights,self.score,self.mode,self.flags)
         sys.stderr.write('Cross entropy: ' + str(current_cross_entropy) + '\n')
@@ -1794,21 +5843,239 @@ class Combine_TMs():
     def return_best_cross_entropy(self):
         """return the set of weights and cross-entropy that is optimal for a tuning set and a set of models."""
         
-        data = ['reference','pt-filtered']
-    
-        if self.mode == 'counts' or (self.mode == 'interpolate' and self.flags['recompute_lexweights']):
-            data.append('lexical-filtered')
-    
-        self._ensure_loaded(data)
+        self._ensure_loaded(self._reference_data())
         
-        best_weights,best_cross_entropy = optimize_cross_entropy(self.model_interface,self.reference_interface,self.weights,self.score,self.mode,self.flags)
+        with self.stats.phase('optimize'):
+            best_weights,best_cross_entropy = optimize_cross_entropy(self.model_interface,self.reference_interface,self.weights,self.score,self.mode,self.flags,stats=self.stats)
 
         sys.stderr.write('Best weights: ' + str(best_weights) + '\n')
         sys.stderr.write('Cross entropies: ' + str(best_cross_entropy) + '\n')
         sys.stderr.write('You can apply these weights with the action combine_given_weights and the option -w "{0}"\n'.format('; '.join([', '.join(str(w) for w in item) for item in best_weights])))
         return best_weights,best_cross_entropy
 
+
+    def compute_cross_entropies(self):
+        """return the cross-entropy of each reference set (see reference_file) for a set of models and a set of weights.
+           the model data that is relevant for all reference sets is loaded in a single pass. Returns a list with one result (as in compute_cross_entropy) per reference file.
+        """
+
+        self._ensure_loaded(self._reference_data())
+
+        results = []
+        for reference_file,reference_interface in zip(self._reference_files(),self._reference_sets()):
+            current_cross_entropy = cross_entropy(self.model_interface,reference_interface,self.weights,self.score,self.mode,self.flags)
+            sys.stderr.write('Cross entropy ({0}): {1}\n'.format(reference_file,current_cross_entropy))
+            results.append(current_cross_entropy)
+
+        return results
+
+
+    def return_best_cross_entropies(self):
+        """return the set of weights and cross-entropy that is optimal for each reference set (see reference_file).
+           the model data that is relevant for all reference sets is loaded in a single pass, and the weights of all reference sets are optimized together.
+           Returns a list with one pair (weights,cross-entropies) per reference file.
+        """
+
+        self._ensure_loaded(self._reference_data())
+
+        with self.stats.phase('optimize'):
+            results = optimize_cross_entropies(self.model_interface,self._reference_sets(),self.weights,self.score,self.mode,self.flags,stats=self.stats)
+
+        for reference_file,(best_weights,best_cross_entropy) in zip(self._reference_files(),results):
+            sys.stderr.write('Best weights ({0}): {1}\n'.format(reference_file,best_weights))
+            sys.stderr.write('Cross entropies ({0}): {1}\n'.format(reference_file,best_cross_entropy))
+        return results
+
         
+class CombinationService():
+    """keeps the data of a set of models in memory, and answers repeated queries (usually from XML-RPC clients; see serve) without loading the models again.
+       Each reference set that is used for cross-entropy computation or tuning is loaded once, with the model data that is relevant for it,
+       and kept in memory until it is removed. Combinations (with different weights) share the lexical tables and target phrase counts.
+
+       models and options are the arguments of Combine_TMs (except weights, reference_file and output_file, which are given per query).
+       Weights are accepted in either of the formats of Combine_TMs; if they are missing, uniform weights are used.
+    """
+
+    def __init__(self,models,**options):
+
+        self.models = models
+        self.options = options
+        self.combiner = Combine_TMs(models,**options)
+        self.references = {}
+        self.stopped = False
+
+
+    def _reference(self,reference_file):
+
+        if reference_file not in self.references:
+            self.add_reference(reference_file)
+        return self.references[reference_file]
+
+
+    def _weights(self,combiner,weights):
+
+        return combiner._check_weights(weights,combiner.model_interface.number_of_features,len(combiner.models))
+
+
+    def add_reference(self,reference_file):
+        """load a reference set (or reload it, if it has been loaded before), and the model data that is relevant for it. returns the number of phrase pairs in memory"""
+
+        combiner = Combine_TMs(self.models,reference_file=reference_file,**self.options)
+        combiner._ensure_loaded(combiner._reference_data())
+        self.references[reference_file] = combiner
+        return len(combiner.model_interface.phrase_pairs)
+
+
+    def remove_reference(self,reference_file):
+        """release the data of a reference set. returns whether it was loaded"""
+
+        return self.references.pop(reference_file,None) is not None
+
+
+    def loaded_references(self):
+        """list of the reference sets in memory"""
+
+        return sorted(self.references)
+
+
+    def compute_cross_entropy(self,reference_file,weights=None):
+        """cross-entropy of the reference set with the given weights (see Combine_TMs.compute_cross_entropy)"""
+
+        combiner = self._reference(reference_file)
+        combiner.weights = self._weights(combiner,weights)
+        return _plain(combiner.compute_cross_entropy())
+
+
+    def return_best_cross_entropy(self,reference_file,weights=None):
+        """weights that minimize the cross-entropy of the reference set (starting from the given weights), and the cross-entropies (see Combine_TMs.return_best_cross_entropy)"""
+
+        combiner = self._reference(reference_file)
+        combiner.weights = self._weights(combiner,weights)
+        return _plain(combiner.return_best_cross_entropy())
+
+
+    def combine_given_weights(self,output_file,weights=None):
+        """write a combined phrase table to output_file. returns the path of the output file"""
+
+        self.combiner.output_file = output_file
+        self.combiner.combine_given_weights(self._weights(self.combiner,weights))
+        return output_file
+
+
+    def combine_weight_sweep(self,weight_configurations,output_files):
+        """write one combined phrase table per weight configuration (see Combine_TMs.combine_weight_sweep). returns the paths of the output files"""
+
+        self.combiner.combine_weight_sweep(weight_configurations,output_files)
+        return output_files
+
+
+    def stop(self):
+        """stop the server after this request"""
+
+        self.stopped = True
+        return True
+
+
+def _plain(value):
+    """convert NumPy numbers (in nested lists/tuples) to Python numbers, which XML-RPC can transmit"""
+
+    if isinstance(value,(list,tuple)):
+        return [_plain(item) for item in value]
+    elif numpy is not None and isinstance(value,(numpy.generic,numpy.ndarray)):
+        return value.tolist()
+    return value
+
+
+class _UnixRequestHandler(SimpleXMLRPCRequestHandler):
+
+    # TCP options are not supported by Unix sockets
+    disable_nagle_algorithm = False
+
+    def address_string(self):
+        # clients of a Unix socket have no (host,port) address
+        return 'unix socket'
+
+
+class UnixXMLRPCServer(SimpleXMLRPCServer):
+    """XML-RPC server that listens on a Unix socket (which is only accessible to local users with permission to the socket file)"""
+
+    address_family = socket.AF_UNIX
+
+    def __init__(self,path,**kwargs):
+
+        if os.path.exists(path):
+            os.remove(path)
+        SimpleXMLRPCServer.__init__(self,path,requestHandler=_UnixRequestHandler,**kwargs)
+
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self,path):
+
+        httplib.HTTPConnection.__init__(self,'localhost')
+        self.socket_path = path
+
+
+    def connect(self):
+
+        self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class UnixStreamTransport(xmlrpclib.Transport):
+    """XML-RPC client transport for a server on a Unix socket (see connect)"""
+
+    def __init__(self,path):
+
+        xmlrpclib.Transport.__init__(self)
+        self.socket_path = path
+
+
+    def make_connection(self,host):
+        return _UnixHTTPConnection(self.socket_path)
+
+
+def _unix_socket_address(address):
+    """whether address is the path of a Unix socket (and not host:port)"""
+
+    host,sep,port = address.rpartition(':')
+    return not (sep and port.isdigit())
+
+
+def serve(address,models,**options):
+    """serve a CombinationService for models (and the options of Combine_TMs) over XML-RPC, until a client calls stop().
+       address is either host:port (e.g. localhost:8765), or the path of a Unix socket. Clients can connect with connect(address).
+    """
+
+    service = CombinationService(models,**options)
+
+    if _unix_socket_address(address):
+        server = UnixXMLRPCServer(address,logRequests=False,allow_none=True)
+    else:
+        host,port = address.rsplit(':',1)
+        server = SimpleXMLRPCServer((host,int(port)),logRequests=False,allow_none=True)
+
+    server.register_introspection_functions()
+    server.register_instance(service)
+
+    sys.stderr.write('Serving models on ' + address + '\n')
+    try:
+        while not service.stopped:
+            server.handle_request()
+    finally:
+        server.server_close()
+        if _unix_socket_address(address) and os.path.exists(address):
+            os.remove(address)
+
+
+def connect(address):
+    """XML-RPC client of a server started with serve(address). Example: connect('localhost:8765').compute_cross_entropy('dev/extract',[0.5,0.5])"""
+
+    if _unix_socket_address(address):
+        return xmlrpclib.ServerProxy('http://localhost/',transport=UnixStreamTransport(address),allow_none=True)
+    return xmlrpclib.ServerProxy('http://' + address + '/',allow_none=True)
+
+
 def test():
     """test (and illustrate) the functionality of the program based on two test phrase tables and a small reference set,"""
     
@@ -1880,14 +6147,389 @@ def test():
     Combiner = Combine_TMs([[os.path.join('test','model5'),'primary'],[os.path.join('test','model6'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],os.path.join('test','phrase-table_test11'),mode='counts')
     Combiner.combine_given_weights()
 
+    # count-based combination of two models with fixed weights, split among two processes. output should be identical to test 3
+    # command line: python tmcombine.py combine_given_weights test/model1 test/model2 -w "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" -o test/phrase-table_test12 -m counts --processes 2
+    sys.stderr.write('Regression test 12\n')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],os.path.join('test','phrase-table_test12'),mode='counts',processes=2)
+    Combiner.combine_given_weights()
+
+    # cross-entropy of a reference set with words that occur on both sides (names, punctuation), without and with the cache for lexical weights that is used during weight optimization (see cross_entropy_light)
+    # both lines should be identical; the lexical weights of the two directions are cached separately
+    # command line: (currently not possible through command line)
+    sys.stderr.write('Regression test 13\n')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model7'),'primary']],[[0.2,0.8],[0.2,0.8],[0.2,0.8],[0.2,0.8]],mode='counts',reference_file='test/extract')
+    f = open(os.path.join('test','phrase-table_test13'),'w')
+    f.write(' '.join('{0:.10f}'.format(x) for x in Combiner.compute_cross_entropy()[:4]) + '\n')
+    cache,n = _get_reference_cache(Combiner.reference_interface,Combiner.model_interface)
+    f.write(' '.join('{0:.10f}'.format(x/n) for x in cross_entropy_light(Combiner.model_interface,Combiner.reference_interface,Combiner.weights,Combiner.score,Combiner.mode,Combiner.flags,cache)) + '\n')
+    f.close()
+
+    # analytic gradient of the cross-entropy of each feature (see cross_entropy_gradient) in mode 'counts', including the lexical weights, and its central finite difference
+    # both lines should be identical
+    # command line: (currently not possible through command line)
+    sys.stderr.write('Regression test 14\n')
+    Combiner = Combine_TMs([[os.path.join('test','model7'),'primary'],[os.path.join('test','model8'),'primary']],mode='counts',reference_file='test/extract')
+    Combiner._ensure_loaded(Combiner._reference_data())
+    cache,n = _get_reference_cache(Combiner.reference_interface,Combiner.model_interface)
+    number_of_features = Combiner.model_interface.number_of_features
+    analytic = []
+    numeric = []
+    h = 1e-6
+    for i in range(number_of_features):
+        analytic += cross_entropy_gradient(Combiner.model_interface,Combiner.reference_interface,[[1,3] for j in range(number_of_features)],Combiner.score,Combiner.mode,Combiner.flags,cache,i)[1]
+        for k in range(2):
+            values = []
+            for step in [h,-h]:
+                weights = [1,3]
+                weights[k] += step
+                values.append(cross_entropy_gradient(Combiner.model_interface,Combiner.reference_interface,[list(weights) for j in range(number_of_features)],Combiner.score,Combiner.mode,Combiner.flags,cache,i)[0])
+            numeric.append((values[0]-values[1])/(2*h))
+    f = open(os.path.join('test','phrase-table_test14'),'w')
+    f.write(' '.join('{0:.5f}'.format(x) for x in analytic) + '\n')
+    f.write(' '.join('{0:.5f}'.format(x) for x in numeric) + '\n')
+    f.close()
+
+    # count-based combination of two models with fixed weights in low memory mode, with inverted tables. output should be identical to test 3
+    # the sort buffer is tiny (about 200 bytes), so the inverted tables are sorted in many runs (by two processes) that are merged
+    # command line: (sort buffers smaller than 1 MB are currently not possible through command line)
+    sys.stderr.write('Regression test 15\n')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],os.path.join('test','phrase-table_test15'),mode='counts',lowmem=True,lowmem_strategy='invert',sort_buffer_size=0.0002,processes=2)
+    Combiner.combine_given_weights()
+
+
+    # cross-entropy with fixed weights and a cache for the data that is loaded for the reference set: the first run writes the cache, the second run loads it
+    # this is repeated with a gzipped copy of the reference set (DIR/extract.gz), which is given without '.gz'
+    # the cross-entropies of all runs should be identical; after each result, the phases in which data was loaded are listed (see PhaseStats)
+    # command line: python tmcombine.py compute_cross_entropy test/model1 test/model2 -w "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" -m counts -r test/extract --cache-dir DIR
+    sys.stderr.write('Regression test 16\n')
+    cache_dir = mkdtemp()
+    f = gzip.open(os.path.join(cache_dir,'extract.gz'),'wb')
+    f.write(open(os.path.join('test','extract'),'rb').read())
+    f.close()
+    f = open(os.path.join('test','phrase-table_test16'),'w')
+    for reference_file in [os.path.join('test','extract'),os.path.join(cache_dir,'extract')]:
+        for run in range(2):
+            phases = []
+            Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],mode='counts',reference_file=reference_file,cache_dir=cache_dir,stats_callback=lambda record: phases.append(record['phase']))
+            f.write(str(Combiner.compute_cross_entropy()) + '\n')
+            f.write(' '.join(phase for phase in phases if phase.startswith('load')) + '\n')
+    f.close()
+    shutil.rmtree(cache_dir)
+
+
+    # count-based combination of two models with fixed weights in low memory mode, with an on-disk index of the target phrase counts. output should be identical to test 3
+    # command line: python tmcombine.py combine_given_weights test/model1 test/model2 -w "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" -o test/phrase-table_test17 -m counts --lowmem
+    sys.stderr.write('Regression test 17\n')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],os.path.join('test','phrase-table_test17'),mode='counts',lowmem=True,lowmem_strategy='index')
+    Combiner.combine_given_weights()
+
+
+    # linear interpolation of two reordering tables, with fixed weights
+    # command line: python tmcombine.py combine_reordering_tables test/model1 test/model2 -w "0.1,0.9" -o test/phrase-table_test18 --number_of_features 6
+    sys.stderr.write('Regression test 18\n')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[0.1,0.9],os.path.join('test','phrase-table_test18'),number_of_features=6)
+    Combiner.combine_reordering_tables()
+
+    # linear interpolation of two reordering tables, with fixed weights, split among two processes. output should be identical to test 18
+    # command line: python tmcombine.py combine_reordering_tables test/model1 test/model2 -w "0.1,0.9" -o test/phrase-table_test19 --number_of_features 6 --processes 2
+    sys.stderr.write('Regression test 19\n')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[0.1,0.9],os.path.join('test','phrase-table_test19'),number_of_features=6,processes=2)
+    Combiner.combine_reordering_tables()
+
+
+    # incremental combination: a combined table is updated after one of the input tables has changed, by combining only the blocks (source phrase ranges) whose input lines have changed
+    # the models are copied to a temporary directory, in which model2 first has a modified phrase table. output should be identical to test 2
+    # command line: python tmcombine.py combine_given_weights test/model1 test/model2 -w "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" -o test/phrase-table_test20 --incremental
+    sys.stderr.write('Regression test 20\n')
+    tempdir = mkdtemp()
+    for model in ['model1','model2']:
+        shutil.copytree(os.path.join('test',model),os.path.join(tempdir,model))
+    phrase_table = os.path.join(tempdir,'model2','model','phrase-table')
+    f = open(os.path.join('test','model2','model','phrase-table'),'rb')
+    lines = f.readlines()
+    f.close()
+    f = open(phrase_table,'wb')
+    f.writelines([line.replace(b'0.784521',b'0.5') for line in lines])
+    f.close()
+    for run in range(2):
+        Combiner = Combine_TMs([[os.path.join(tempdir,'model1'),'primary'],[os.path.join(tempdir,'model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],os.path.join(tempdir,'phrase-table'),incremental=True,incremental_block_size=0.0002)
+        Combiner.combine_given_weights()
+        shutil.copy(os.path.join('test','model2','model','phrase-table'),phrase_table)
+    shutil.copy(os.path.join(tempdir,'phrase-table'),os.path.join('test','phrase-table_test20'))
+    shutil.rmtree(tempdir)
+
+
+    # cross-entropy with fixed weights, computed with text phrase tables (first line) and with the data for the reference set looked up in binary phrase tables (see Moses_Binary). both lines should be identical to test 33.2
+    # requires the Python interface to Moses (contrib/python) and processPhraseTable (../../bin), which creates the binary tables in a temporary directory. Otherwise, the test is skipped (and its output is not part of the repository; see test 33 for a test with simulated binary tables)
+    # command line: python tmcombine.py compute_cross_entropy test/model1 test/model2 -w "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" -r test/extract --binary-tables
+    process_phrase_table = os.path.join('..','..','bin','processPhraseTable')
+    if PhraseDictionaryTree is None or not os.path.exists(process_phrase_table):
+        sys.stderr.write('Regression test 21 skipped (requires the Python interface to Moses and processPhraseTable)\n')
+    else:
+        sys.stderr.write('Regression test 21\n')
+        tempdir = mkdtemp()
+        for model in ['model1','model2']:
+            shutil.copytree(os.path.join('test',model),os.path.join(tempdir,model))
+            phrase_table = os.path.join(tempdir,model,'model','phrase-table')
+            subprocess.check_call([process_phrase_table,'-ttable','0','0',phrase_table,'-nscores','5','-out',phrase_table])
+        f = open(os.path.join('test','phrase-table_test21'),'w')
+        for model_interface in [Moses,Moses_Binary]:
+            Combiner = Combine_TMs([[os.path.join(tempdir,'model1'),'primary'],[os.path.join(tempdir,'model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],reference_file='test/extract',model_interface=model_interface)
+            result = Combiner.compute_cross_entropy()
+            f.write(' '.join(['{0:.4f}'.format(x) for x in result[:4]] + [str(x) for x in result[4:]]) + '\n')
+        f.close()
+        shutil.rmtree(tempdir)
+
+
+    # count-based combination of two models with fixed weights, split among two processes, with gzipped and indexed phrase tables (see index_tables). output should be identical to test 3
+    # the models are copied to a temporary directory. The phrase table of model1 is compressed in many small gzip members, that of model2 in a single member, which is recompressed before indexing
+    # command line: python tmcombine.py index_tables DIR/model1 ; python tmcombine.py index_tables DIR/model2 --recompress ; python tmcombine.py combine_given_weights DIR/model1 DIR/model2 -w "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" -o test/phrase-table_test22 -m counts --processes 2
+    sys.stderr.write('Regression test 22\n')
+    tempdir = mkdtemp()
+    for model in ['model1','model2']:
+        shutil.copytree(os.path.join('test',model),os.path.join(tempdir,model))
+        phrase_table = os.path.join(tempdir,model,'model','phrase-table')
+        if model == 'model1':
+            f = GzipWriter(phrase_table + '.gz',block_size=64)
+        else:
+            f = gzip.open(phrase_table + '.gz','wb')
+        for line in open(phrase_table,'rb'):
+            f.write(line)
+        f.close()
+        os.remove(phrase_table)
+        Combiner = Combine_TMs([[os.path.join(tempdir,model),'primary']],index_interval=1,index_recompress=model == 'model2')
+        Combiner.index_tables()
+    Combiner = Combine_TMs([[os.path.join(tempdir,'model1'),'primary'],[os.path.join(tempdir,'model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],os.path.join('test','phrase-table_test22'),mode='counts',processes=2)
+    Combiner.combine_given_weights()
+    shutil.rmtree(tempdir)
+
+
+    # weight sweep: linear interpolation of two models with two sets of fixed weights, with a single traversal of the models. The first output (test/phrase-table_test23.1) should be identical to test 1
+    # command line: (currently not possible to define supplementary models through command line)
+    sys.stderr.write('Regression test 23\n')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'supplementary']],output_file=os.path.join('test','phrase-table_test23'))
+    Combiner.combine_weight_sweep([[0.5,0.5],[0.1,0.9]])
+
+    # weight sweep: count-based combination of two models with two sets of fixed weights, with a single traversal of the models. The first output (test/phrase-table_test24.1) should be identical to test 3
+    # command line: python tmcombine.py combine_weight_sweep test/model1 test/model2 --sweep "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" --sweep "0.5,0.5" -o test/phrase-table_test24 -m counts
+    sys.stderr.write('Regression test 24\n')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],output_file=os.path.join('test','phrase-table_test24'),mode='counts')
+    Combiner.combine_weight_sweep([[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],[0.5,0.5]])
+
+
+    # word pairs of a reference set loaded from a TigerXML alignment file (see TigerXML), written as "source ||| target ||| count"
+    # the alignment of 'und ... der Pass' to 'col' is discarded because the source words are not contiguous
+    # command line: (currently not possible through command line)
+    sys.stderr.write('Regression test 25\n')
+    reference = TigerXML(os.path.join('test','tigerxml','alignment.xml'))
+    reference.load_word_pairs('de','fr')
+    f = open(os.path.join('test','phrase-table_test25'),'wb')
+    for src in sorted(reference.word_pairs):
+        for target in sorted(reference.word_pairs[src]):
+            f.write(u'{0} ||| {1} ||| {2}\n'.format(src,target,reference.word_pairs[src][target]).encode('utf-8'))
+    f.close()
+
+
+    # queries answered by a CombinationService (without an XML-RPC server): a cross-entropy on test/extract, then two count-based combinations with different weights from the same loaded models.
+    # the output of the second combination should be identical to test 3
+    # command line: python tmcombine.py serve test/model1 test/model2 -m counts --address ADDRESS (then send the queries through connect(ADDRESS))
+    sys.stderr.write('Regression test 26\n')
+    service = CombinationService([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],mode='counts')
+    service.compute_cross_entropy(os.path.join('test','extract'),[0.5,0.5])
+    tempdir = mkdtemp()
+    service.combine_given_weights(os.path.join(tempdir,'phrase-table'),[0.5,0.5])
+    service.combine_given_weights(os.path.join('test','phrase-table_test26'),[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]])
+    shutil.rmtree(tempdir)
+
+
+    # count-based combination of two models with fixed weights, keeping only the best translation of each source phrase (by p(t|s), see table_limit).
+    # output should be identical to test 3, minus the lines of all other translations
+    # command line: python tmcombine.py combine_given_weights test/model1 test/model2 -w "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" -o test/phrase-table_test27 -m counts --table-limit 1
+    sys.stderr.write('Regression test 27\n')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],os.path.join('test','phrase-table_test27'),mode='counts',table_limit=1)
+    Combiner.combine_given_weights()
+
+
+    # count-based combination of two models with fixed weights and a memory budget of 1 MB, which this process always exceeds:
+    # the target phrase counts of model1 are moved to an on-disk index after it has been loaded, and those of model2 are added to the index (see memory_limit). output should be identical to test 3
+    # command line: python tmcombine.py combine_given_weights test/model1 test/model2 -w "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" -o test/phrase-table_test28 -m counts --memory-limit 1
+    sys.stderr.write('Regression test 28\n')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],os.path.join('test','phrase-table_test28'),mode='counts',memory_limit=1)
+    Combiner.combine_given_weights()
+
+
+    # count-based combination of two models with fixed weights, continued from a checkpoint (see checkpoint_interval). output should be identical to test 3
+    # the interruption is simulated: a combination that is written completely is cut off after the third source phrase, and in the middle of a line, and the checkpoint records the position after the third source phrase
+    # command line: python tmcombine.py combine_given_weights test/model1 test/model2 -w "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" -o test/phrase-table_test29 -m counts --checkpoint-interval 3600 (after an interrupted run with the same options)
+    sys.stderr.write('Regression test 29\n')
+    output_file = os.path.join('test','phrase-table_test29')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],output_file,mode='counts')
+    Combiner.combine_given_weights()
+    f = open(output_file,'rb')
+    lines = f.readlines()
+    f.close()
+    sources = sorted(set(line.split(b' ||| ',1)[0] for line in lines))
+    completed = [line for line in lines if line.split(b' ||| ',1)[0] <= sources[2]]
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],output_file,mode='counts',checkpoint_interval=3600)
+    checkpoint = Combiner._checkpoint(Combiner.weights)
+    f = open(output_file,'wb')
+    f.writelines(completed)
+    checkpoint.save('phrase-table',sources[2] + b' |\x00',[Combiner.model_interface.table_path(model,'phrase-table') for (model,priority) in Combiner.models],[f])
+    f.write(lines[len(completed)][:20])
+    f.close()
+    Combiner.combine_given_weights()
+
+
+    # cross-entropy of a reference set in count-based mode, for which the lexical tables are filtered (see _get_lexical_filter).
+    # the models are copied to a temporary directory, in which model7 translates 'michel' as 'piola' and vice versa. Its lexical table has an entry 'piola michel' that model8 lacks:
+    # the word count of 'michel' in model8 must nevertheless be loaded for the lexical weights of 'michel ||| piola' (it is on the line 'michel michel', which is not in the filter)
+    # command line: python tmcombine.py compute_cross_entropy DIR/model7 DIR/model8 -w "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" -r DIR/extract -m counts
+    sys.stderr.write('Regression test 30\n')
+    tempdir = mkdtemp()
+    for model in ['model7','model8']:
+        shutil.copytree(os.path.join('test',model),os.path.join(tempdir,model))
+    for table,lines in [('phrase-table',[b'michel ||| piola ||| 0.1 0.05 0.1 0.05 2.718 ||| 0-0 ||| 4 3\n',b'piola ||| michel ||| 0.1 0.05 0.1 0.05 2.718 ||| 0-0 ||| 3 4\n']),('lex.counts.f2e',[b'piola michel 2 40\n',b'michel piola 2 12\n']),('lex.counts.e2f',[b'michel piola 2 12\n',b'piola michel 2 38\n'])]:
+        filename = os.path.join(tempdir,'model7','model',table)
+        f = open(filename,'rb')
+        lines += f.readlines()
+        f.close()
+        f = open(filename,'wb')
+        f.writelines(sorted(lines))
+        f.close()
+    f = open(os.path.join(tempdir,'extract'),'wb')
+    f.write(b'michel ||| piola ||| 0-0\npiola ||| michel ||| 0-0\n')
+    f.close()
+    Combiner = Combine_TMs([[os.path.join(tempdir,'model7'),'primary'],[os.path.join(tempdir,'model8'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],reference_file=os.path.join(tempdir,'extract'),mode='counts')
+    result = Combiner.compute_cross_entropy()
+    f = open(os.path.join('test','phrase-table_test30'),'w')
+    f.write(' '.join(['{0:.4f}'.format(x) for x in result[:4]] + [str(x) for x in result[4:]]) + '\n')
+    f.close()
+    shutil.rmtree(tempdir)
+
+
+    # cross-entropies of two reference sets (test/extract and test/extract2) with fixed weights, and the weights that minimize the cross-entropies of each of them, with the model data for both loaded in a single pass
+    # the results for each reference set should be the same as those for the reference set alone (with compute_cross_entropy and return_best_cross_entropy). The first line should be identical to the lines of test 33.2
+    # the optimized weights (rounded to two decimals) and cross-entropies (rounded to three decimals) are written to the last two lines
+    # command line: python tmcombine.py compute_cross_entropies test/model1 test/model2 -w "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" -r test/extract -r test/extract2 ; python tmcombine.py return_best_cross_entropies test/model1 test/model2 -r test/extract -r test/extract2
+    sys.stderr.write('Regression test 31\n')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],reference_file=[os.path.join('test','extract'),os.path.join('test','extract2')])
+    f = open(os.path.join('test','phrase-table_test31'),'w')
+    for result in Combiner.compute_cross_entropies():
+        f.write(' '.join(['{0:.4f}'.format(x) for x in result[:4]] + [str(x) for x in result[4:]]) + '\n')
+    Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],reference_file=[os.path.join('test','extract'),os.path.join('test','extract2')])
+    for best_weights,best_cross_entropy in Combiner.return_best_cross_entropies():
+        f.write(';'.join([','.join(['{0:.2f}'.format(w) for w in weights]) for weights in best_weights]) + ' ' + ' '.join(['{0:.3f}'.format(x) for x in best_cross_entropy[:4]]) + '\n')
+    f.close()
+
+
+    # external sort (see ExternalSort) of the lines of two phrase tables and of a line with a carriage return inside a phrase, which are written in chunks that do not end at line boundaries.
+    # the sort buffer is small, so that the lines are sorted in several runs, which are then merged. output should be identical to that of LC_ALL=C sort (which does not split the line at the carriage return)
+    # command line: (currently not possible through command line)
+    sys.stderr.write('Regression test 32\n')
+    data = b''
+    for model in ['model1','model2']:
+        f = open(os.path.join('test',model,'model','phrase-table'),'rb')
+        data += f.read()
+        f.close()
+        data += b'zz ||| a\rb ||| 1\n'
+    sorter = ExternalSort(buffer_size=0.0002)
+    for i in range(0,len(data),100):
+        sorter.write(data[i:i+100])
+    sorted_file = sorter.finish()
+    f = open(os.path.join('test','phrase-table_test32'),'wb')
+    shutil.copyfileobj(sorted_file,f)
+    f.close()
+    sorted_file.close()
+    os.remove(sorted_file.name)
+
+
+    # phrase table lookups in binary phrase tables (see Moses_Binary), which are simulated with the text tables, so that the test doesn't require the Python interface to Moses:
+    # TextPhraseDictionaryTree has the interface of PhraseDictionaryTree (moses.dictree) that Moses_Binary uses. query() returns the translations of a source phrase in no particular order, with their scores and word alignment
+    # the lines that are looked up for all source phrases of model2 (test/phrase-table_test33.1) should be identical to its phrase table, without the phrase counts (which binary tables don't store)
+    # the cross-entropies with fixed weights with the text tables and the (simulated) binary tables (test/phrase-table_test33.2) should be identical, and identical to the first line of test 31
+    # command line: (currently not possible through command line)
+    sys.stderr.write('Regression test 33\n')
+
+    class TextTargetProduction():
+
+        def __init__(self,target,scores,alignment):
+            self.rhs = tuple(target.split())
+            self.scores = [float(score) for score in scores.split()]
+            self.alignment = alignment.strip().decode('ascii')
+
+    class TextPhraseDictionaryTree():
+
+        def __init__(self,stem,table_limit,number_of_scores,wa):
+            self.wa = wa
+            self.translations = defaultdict(list)
+            for line in open(stem,'rb'):
+                src,target,scores,alignment = line.split(b' ||| ')[:4]
+                self.translations[src].append(TextTargetProduction(target,scores,alignment))
+
+        @staticmethod
+        def canLoad(stem,wa):
+            return os.path.exists(stem)
+
+        def query(self,line,converter=None,cmp=None):
+            return reversed(self.translations[line])
+
+    binary_table_class = PhraseDictionaryTree
+    globals()['PhraseDictionaryTree'] = TextPhraseDictionaryTree
+    try:
+        model_interface = Moses_Binary([[os.path.join('test','model2'),'primary']],5)
+        f = open(os.path.join('test','model2','model','phrase-table'),'rb')
+        sources = set(line.split(b' ||| ',1)[0] for line in f)
+        f.close()
+        f = open(os.path.join('test','phrase-table_test33.1'),'wb')
+        f.writelines(model_interface.filtered_phrase_table(os.path.join('test','model2'),sources))
+        f.close()
+
+        f = open(os.path.join('test','phrase-table_test33.2'),'w')
+        for model_interface in [Moses,Moses_Binary]:
+            Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],reference_file=os.path.join('test','extract'),model_interface=model_interface)
+            result = Combiner.compute_cross_entropy()
+            f.write(' '.join(['{0:.4f}'.format(x) for x in result[:4]] + [str(x) for x in result[4:]]) + '\n')
+        f.close()
+    finally:
+        globals()['PhraseDictionaryTree'] = binary_table_class
+
+
+    # time and memory statistics (see PhaseStats) of a count-based combination of two models with fixed weights, by a single process and by two processes.
+    # the records of the worker processes are merged, so both runs should list the same phases, with the same numbers of phrase pairs and lines (test/phrase-table_test34 lists them for each run)
+    # requires NumPy (without it, phrase pairs are not scored in blocks, and traversal, scoring and writing are not measured separately). Otherwise, the test is skipped
+    # command line: python tmcombine.py combine_given_weights test/model1 test/model2 -w "0.1,0.9;0.1,1;0.2,0.8;0.5,0.5" -o DIR/phrase-table -m counts --processes 2 --stats-file DIR/stats
+    if numpy is None:
+        sys.stderr.write('Regression test 34 skipped (requires NumPy)\n')
+    else:
+        sys.stderr.write('Regression test 34\n')
+        tempdir = mkdtemp()
+        f = open(os.path.join('test','phrase-table_test34'),'w')
+        for processes in [1,2]:
+            stats_file = os.path.join(tempdir,'stats{0}'.format(processes))
+            Combiner = Combine_TMs([[os.path.join('test','model1'),'primary'],[os.path.join('test','model2'),'primary']],[[0.1,0.9],[0.1,1],[0.2,0.8],[0.5,0.5]],os.path.join(tempdir,'phrase-table'),mode='counts',processes=processes,stats_file=stats_file)
+            Combiner.combine_given_weights()
+            for line in open(stats_file):
+                record = json.loads(line)
+                f.write(' '.join([str(processes),record['phase']] + ['{0}={1}'.format(counter,record[counter]) for counter in ['lines','pairs'] if counter in record]) + '\n')
+        f.close()
+        shutil.rmtree(tempdir)
+
 #convert weight vector passed as a command line argument
+def _parse_weights(weights):
+    if ';' in weights:
+        return [[float(x) for x in vector.split(',')] for vector in weights.split(';')]
+    else:
+        return [float(x) for x in weights.split(',')]
+
+
 class to_list(argparse.Action):
      def __call__(self, parser, namespace, weights, option_string=None):
-         if ';' in weights:
-             values = [[float(x) for x in vector.split(',')] for vector in weights.split(';')]
-         else:
-             values = [float(x) for x in weights.split(',')]
-         setattr(namespace, self.dest, values)
+         setattr(namespace, self.dest, _parse_weights(weights))
+
+
+class append_list(argparse.Action):
+     def __call__(self, parser, namespace, weights, option_string=None):
+         setattr(namespace, self.dest, (getattr(namespace, self.dest) or []) + [_parse_weights(weights)])
 
 
 def parse_command_line():
@@ -1896,7 +6538,7 @@ def parse_command_line():
     group1 = parser.add_argument_group('Main options')
     group2 = parser.add_argument_group('More model combination options')
     
-    group1.add_argument('action', metavar='ACTION', choices=["combine_given_weights","combine_given_tuning_set","combine_reordering_tables","compute_cross_entropy","return_best_cross_entropy","compare_cross_entropies"],
+    group1.add_argument('action', metavar='ACTION', choices=["combine_given_weights","combine_given_tuning_set","combine_reordering_tables","compute_cross_entropy","return_best_cross_entropy","compute_cross_entropies","return_best_cross_entropies","compare_cross_entropies","index_tables","combine_weight_sweep","serve"],
                     help='What you want to do with the models. One of %(choices)s.')
     
     group1.add_argument('model', metavar='DIRECTORY', nargs='+',
@@ -1906,14 +6548,22 @@ def parse_command_line():
                     default=None,
                     help='weight vector. Format 1: single vector, one weight per model. Example: \"0.1,0.9\" ; format 2: one vector per feature, one weight per model: \"0.1,0.9;0.5,0.5;0.4,0.6;0.2,0.8\"')
 
+    group1.add_argument('--sweep', dest='sweep_weights', action=append_list,
+                    default=None, metavar='WEIGHTS',
+                    help='For the action combine_weight_sweep: a weight vector (in the format of --weights). Repeat the option for each weight configuration. One table per configuration is written to OUTPUT.1, OUTPUT.2 etc. (before the extension .gz), with a single pass over the models.')
+
+    group1.add_argument('--address', type=str,
+                    default='localhost:8765',
+                    help='For the action serve: keep the models in memory, and answer queries (cross-entropy, tuning, combination) of XML-RPC clients on ADDRESS (HOST:PORT, or the path of a Unix socket) until a client calls stop(). (default: %(default)s)')
+
     group1.add_argument('-m', '--mode', type=str,
                     default="interpolate",
                     choices=["counts","interpolate","loglinear"],
                     help='basic mixture-model algorithm. Default: %(default)s. Note: depending on mode and additional configuration, additional statistics are needed. Check docstring documentation of Combine_TMs() for more info.')
 
-    group1.add_argument('-r', '--reference', type=str,
+    group1.add_argument('-r', '--reference', type=str, action='append',
                     default=None,
-                    help='File containing reference phrase pairs for cross-entropy calculation. Default interface expects \'path/model/extract.gz\' that is produced by training a model on the reference (i.e. development) corpus.')
+                    help='File containing reference phrase pairs for cross-entropy calculation. Default interface expects \'path/model/extract.gz\' that is produced by training a model on the reference (i.e. development) corpus. Repeat the option to give several files (e.g. one per domain) for the actions compute_cross_entropies and return_best_cross_entropies.')
 
     group1.add_argument('-o', '--output', type=str,
                     default="-",
@@ -1926,9 +6576,58 @@ def parse_command_line():
     group1.add_argument('--lowmem', action="store_true",
                     help=('Low memory mode: requires two passes (and sorting in between) to combine a phrase table, but loads less data into memory. Only relevant for mode "counts" and some configurations of mode "interpolate".'))
 
+    group1.add_argument('--lowmem-strategy', type=str,
+                    default='index', choices=['index','invert'],
+                    help=('How target phrase counts are obtained in --lowmem mode. "index": build an on-disk index of target phrase counts, then combine tables in a single pass. "invert": combine the original and the inverted tables, and merge the two halves. (default: %(default)s)'))
+
+    group1.add_argument('--memory-limit', type=int,
+                    default=None, metavar='MB',
+                    help=('Memory budget (in MB). Target phrase counts are loaded into memory, and moved to an on-disk index (as in --lowmem mode) if the process comes close to the budget while loading them.'))
+
+    group1.add_argument('--checkpoint-interval', type=int,
+                    default=0, metavar='SECONDS',
+                    help=('Save the progress of a phrase table combination to OUTPUT.checkpoint every SECONDS seconds. A restarted combination with the same options continues from the checkpoint. Requires uncompressed or indexed tables. (default: %(default)s: no checkpoints)'))
+
     group1.add_argument('--tempdir', type=str,
                     default=None,
-                    help=('Temporary directory in --lowmem mode.'))
+                    help=('Temporary directory in --lowmem mode, and for partial tables of parallel processes.'))
+
+    group1.add_argument('--sort-buffer-size', type=int,
+                    default=1024, metavar='MB',
+                    help=('Memory for sorting in --lowmem mode (in MB). Larger inputs are sorted in runs that are stored in compressed temporary files. (default: %(default)s)'))
+
+    group1.add_argument('--cache-dir', type=str,
+                    default=None, metavar='DIR',
+                    help=('Directory for a persistent cache of the model data that is relevant for the reference set. Speeds up repeated tuning/cross-entropy computations with the same models, reference file and mode.'))
+
+    group1.add_argument('--processes', type=int,
+                    default=1, metavar='N',
+                    help=('Number of processes for phrase table and reordering table combination. Input tables are split into source phrase ranges that are combined in parallel (requires uncompressed tables, or gzipped tables with an index). Also used to optimize the weights of different features concurrently, and to compress gzipped output. (default: %(default)s)'))
+
+    group1.add_argument('--stats-file', type=str,
+                    default=None, metavar='FILE',
+                    help=('Append time and memory statistics of each phase (loading, inversion, sorting, traversal, scoring, writing, optimizer iterations) to FILE, as JSON lines.'))
+
+    group1.add_argument('--binary-tables', action="store_true",
+                    help=('Look up the phrase pairs that are relevant for the reference set in binary phrase tables (DIRECTORY/model/phrase-table.binphr.*, created with processPhraseTable) instead of reading the text tables (for tuning and cross-entropy computation). Requires moses.dictree from contrib/python.'))
+
+    group1.add_argument('--incremental', action="store_true",
+                    help=('Incremental combination: only recombine the blocks of source phrases whose input has changed since the last combination into the same output file, and copy the rest from the previous output (see OUTPUT.manifest). Requires uncompressed tables, and a configuration in which source phrases are combined independently (e.g. mode "interpolate" without --recompute_lexweights).'))
+
+    group1.add_argument('--index-interval', type=int,
+                    default=1000, metavar='N',
+                    help=('For the action index_tables: record the position of every Nth source phrase of each table in TABLE.index. Indexed tables are read only partially for tuning and cross-entropy computation, and gzipped tables with an index can be combined in parallel. (default: %(default)s)'))
+
+    group1.add_argument('--recompress', action="store_true",
+                    help=('For the action index_tables: rewrite gzipped tables as many small gzip members, so that they can be decompressed from (almost) any position of the index.'))
+
+    group1.add_argument('--table-limit', type=int,
+                    default=0, metavar='N',
+                    help=('Only write the N best translations of each source phrase to the combined phrase table, ranked by the combined value of the feature --table-limit-feature. 0: no limit. (default: %(default)s)'))
+
+    group1.add_argument('--table-limit-feature', type=int,
+                    default=None, metavar='N',
+                    help=('Index of the feature by which translations are ranked for --table-limit. (default: same as --i_f2e, i.e. p(e|f))'))
 
     group2.add_argument('--i_e2f', type=int,
                     default=0, metavar='N',
@@ -1971,23 +6670,48 @@ if __name__ == "__main__":
         
     else:
         args = parse_command_line()
-        #initialize
-        combiner = Combine_TMs([(m,'primary') for m in args.model],
-                               weights=args.weights,
-                               mode=args.mode,
-                               output_file=args.output,
-                               reference_file=args.reference,
-                               output_lexical=args.output_lexical,
-                               lowmem=args.lowmem,
-                               normalized=args.normalized,
-                               recompute_lexweights=args.recompute_lexweights,
-                               tempdir=args.tempdir,
-                               number_of_features=args.number_of_features,
-                               i_e2f=args.i_e2f,
-                               i_e2f_lex=args.i_e2f_lex,
-                               i_f2e=args.i_f2e,
-                               i_f2e_lex=args.i_f2e_lex,
-                               write_phrase_penalty=args.write_phrase_penalty)
-        # execute right method
-        f_string = "combiner."+args.action+'()'
-        exec(f_string)
+        options = dict(model_interface=Moses_Binary if args.binary_tables else Moses,
+                       mode=args.mode,
+                       lowmem=args.lowmem,
+                       lowmem_strategy=args.lowmem_strategy,
+                       memory_limit=args.memory_limit,
+                       checkpoint_interval=args.checkpoint_interval,
+                       normalized=args.normalized,
+                       recompute_lexweights=args.recompute_lexweights,
+                       tempdir=args.tempdir,
+                       processes=args.processes,
+                       cache_dir=args.cache_dir,
+                       stats_file=args.stats_file,
+                       incremental=args.incremental,
+                       index_interval=args.index_interval,
+                       index_recompress=args.recompress,
+                       table_limit=args.table_limit,
+                       table_limit_feature=args.table_limit_feature,
+                       sort_buffer_size=args.sort_buffer_size,
+                       number_of_features=args.number_of_features,
+                       i_e2f=args.i_e2f,
+                       i_e2f_lex=args.i_e2f_lex,
+                       i_f2e=args.i_f2e,
+                       i_f2e_lex=args.i_f2e_lex,
+                       write_phrase_penalty=args.write_phrase_penalty)
+
+        if args.action == 'serve':
+            serve(args.address,[(m,'primary') for m in args.model],**options)
+
+        else:
+            #initialize
+            reference_file = args.reference
+            if reference_file and len(reference_file) == 1:
+                reference_file = reference_file[0]
+            combiner = Combine_TMs([(m,'primary') for m in args.model],
+                                   weights=args.weights,
+                                   output_file=args.output,
+                                   reference_file=reference_file,
+                                   output_lexical=args.output_lexical,
+                                   **options)
+            # execute right method
+            if args.action == 'combine_weight_sweep':
+                combiner.combine_weight_sweep(args.sweep_weights or [])
+            else:
+                f_string = "combiner."+args.action+'()'
+                exec(f_string)